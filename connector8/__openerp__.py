@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 {'name': 'Connector8',
- 'version': '0.1',
+ 'version': '0.2',
  'author': 'Odoo Connector Core Editors',
  'license': 'AGPL-3',
  'category': 'Generic Modules',
@@ -14,7 +14,9 @@ from openerp.tools import config
 
 _logger = logging.getLogger(__name__)
 
-MAX_JOBS = 50
+# the jobs are assigned as soon as they are notified, polling the
+# databases is only a safety net for the missed notifications
+POLL_INTERVAL = 60  # seconds
 
 
 class Multicornnector(workers.PreforkServer):
@@ -68,8 +70,7 @@ class WorkerConnector(workers.Worker):
                 if registry:
                     queue_worker = registry['queue.worker']
                     queue_worker.assign_then_enqueue(cr,
-                                                     openerp.SUPERUSER_ID,
-                                                     max_jobs=MAX_JOBS)
+                                                     openerp.SUPERUSER_ID)
                 RegistryManager.signal_caches_change(db_name)
 
     def process_work(self):
@@ -92,7 +93,8 @@ class WorkerConnector(workers.Worker):
     def sleep(self):
         # Really sleep once all the databases have been processed.
         if self.db_index == 0:
-            interval = 15 + self.pid % self.multi.population  # chorus effect
+            # chorus effect
+            interval = POLL_INTERVAL + self.pid % self.multi.population
             time.sleep(interval)
 
     def start(self):
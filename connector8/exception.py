@@ -53,7 +53,18 @@ class FailedJobError(JobError):
 
 
 class RetryableJobError(JobError):
-    """ A job had an error but can be retried. """
+    """ A job had an error but can be retried.
+
+    The keyword argument ``seconds`` is the delay before the retry, for
+    instance the ``Retry-After`` sent by a remote service. When given,
+    it overrides the retry policy of the job.
+    """
+
+    seconds = None
+
+    def __init__(self, *args, **kwargs):
+        self.seconds = kwargs.pop('seconds', None)
+        super(RetryableJobError, self).__init__(*args, **kwargs)
 
 
 class NetworkRetryableError(RetryableJobError):
@@ -61,6 +72,13 @@ class NetworkRetryableError(RetryableJobError):
     later. """
 
 
+class JobTimeoutError(RetryableJobError):
+    """ A job exceeded its time limit, its executor has been replaced.
+
+    The job is retried later, it fails once its max. retries is reached.
+    """
+
+
 class NothingToDoJob(JobError):
     """ The Job has nothing to do. """
 
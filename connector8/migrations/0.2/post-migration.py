@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """ Move the large values of the jobs to ``queue_job_detail`` and
+    fill the name of their function """
+    if not version:
+        return
+    _move_details(cr)
+    cr.execute("UPDATE queue_job j "
+               "SET func_name = split_part(d.func_string, '(', 1) "
+               "FROM queue_job_detail d "
+               "WHERE d.job_id = j.id "
+               "AND j.func_name IS NULL")
+    _logger.info('function name filled on %d jobs', cr.rowcount)
+
+
+def _move_details(cr):
+    cr.execute("SELECT 1 FROM information_schema.columns "
+               "WHERE table_name = 'queue_job' AND column_name = 'func'")
+    if not cr.fetchone():
+        return
+    cr.execute("INSERT INTO queue_job_detail "
+               "  (job_id, func, func_string, result, exc_info) "
+               "SELECT j.id, j.func, j.func_string, j.result, j.exc_info "
+               "FROM queue_job j "
+               "WHERE NOT EXISTS (SELECT 1 FROM queue_job_detail d "
+               "                  WHERE d.job_id = j.id)")
+    _logger.info('%d jobs details moved to queue_job_detail', cr.rowcount)
+    cr.execute("ALTER TABLE queue_job "
+               "DROP COLUMN func, "
+               "DROP COLUMN func_string, "
+               "DROP COLUMN result, "
+               "DROP COLUMN exc_info")
+    _logger.warning('The columns moved out of queue_job still take their '
+                    'space, run "VACUUM FULL queue_job" manually to '
+                    'reclaim it')
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Cold storage of the jobs removed from ``queue_job``.
+
+The jobs are written as JSON lines in gzip files, one file per day
+(according to the date done of the jobs), in the ``queue_job_archive``
+directory of the filestore of the database. Appending to a file adds a
+new gzip member, a file is always read as a whole stream.
+"""
+
+import gzip
+import json
+import os
+
+from openerp.tools import config
+
+ARCHIVE_DIRECTORY = 'queue_job_archive'
+FILE_SUFFIX = '.jsonl.gz'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class JobArchive(object):
+    """ Read and write the archive files of the jobs
+
+    :param path: directory of the archive files
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_db(cls, db_name):
+        """ Archive located in the filestore of the database """
+        return cls(os.path.join(config.filestore(db_name),
+                                ARCHIVE_DIRECTORY))
+
+    def _file_path(self, day):
+        return os.path.join(self.path, day + FILE_SUFFIX)
+
+    def write(self, jobs):
+        """ Append jobs to the archive files of their day
+
+        :param jobs: dicts of values of the jobs, ``date_done`` is used to
+                     choose the file, ``date_created`` when empty
+        """
+        by_day = {}
+        for job in jobs:
+            date = job.get('date_done') or job['date_created']
+            by_day.setdefault(unicode(date)[:10], []).append(job)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for day, day_jobs in sorted(by_day.iteritems()):
+            archive_file = gzip.open(self._file_path(day), 'ab')
+            try:
+                for job in day_jobs:
+                    archive_file.write(json.dumps(job, default=unicode))
+                    archive_file.write('\n')
+            finally:
+                archive_file.close()
+
+    def days(self, date_from=None, date_to=None):
+        """ Days having an archive file, sorted, between the two dates
+        (strings or dates) if given """
+        if not os.path.isdir(self.path):
+            return []
+        days = sorted(name[:-len(FILE_SUFFIX)]
+                      for name in os.listdir(self.path)
+                      if name.endswith(FILE_SUFFIX))
+        if date_from:
+            date_from = _day(date_from)
+            days = [day for day in days if day >= date_from]
+        if date_to:
+            date_to = _day(date_to)
+            days = [day for day in days if day <= date_to]
+        return days
+
+    def search(self, uuid=None, func_name=None, date_from=None,
+               date_to=None):
+        """ Iterate over the archived jobs matching the criteria
+
+        The files are read line by line, a line is decoded only when the
+        searched values are found in its raw text.
+
+        :param uuid: uuid of the job
+        :param func_name: name of the function of the jobs
+        :param date_from: first day of the files to read
+        :param date_to: last day of the files to read
+        """
+        needles = [needle for needle in (uuid, func_name) if needle]
+        for day in self.days(date_from=date_from, date_to=date_to):
+            archive_file = gzip.open(self._file_path(day), 'rb')
+            try:
+                for line in archive_file:
+                    if not all(needle in line for needle in needles):
+                        continue
+                    job = json.loads(line)
+                    if uuid and job.get('uuid') != uuid:
+                        continue
+                    if func_name and job.get('func_name') != func_name:
+                        continue
+                    yield job
+                    if uuid:
+                        return
+            finally:
+                archive_file.close()
+
+
+def _day(value):
+    """ Day of a date, datetime or string as 'YYYY-MM-DD' """
+    if hasattr(value, 'strftime'):
+        return value.strftime(DATE_FORMAT)
+    return value[:10]
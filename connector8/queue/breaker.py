@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Circuit breakers of the jobs.
+
+A circuit breaker stops the execution of the jobs calling a backend
+which is down. It is declared on the function of the jobs with the
+``circuit_breaker`` argument of the ``@job`` decorator, the functions
+sharing a :py:class:`CircuitBreaker` share its circuits::
+
+    AMAZON_BREAKER = CircuitBreaker(failures=5, reset_timeout=60)
+
+    @job(circuit_breaker=AMAZON_BREAKER)
+    def export_stock_level(session, model_name, backend_id, product_id):
+        # call amazon
+
+As for the rate limits, the key of a job, by default its backend record
+(see :py:func:`~connector8.queue.ratelimit.record_key`), is computed when
+the job is created. Each worker keeps a circuit per key having failures:
+
+* closed: the jobs are executed, the consecutive failures are counted;
+* open: after ``failures`` consecutive failures, the waiting jobs of
+  the key are postponed at once to the end of ``reset_timeout`` without
+  being executed;
+* half-open: after ``reset_timeout``, a single job is executed as a
+  probe. Its success closes the circuit, its failure opens it again.
+"""
+
+from .ratelimit import record_key
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """ Opens the circuit of a key after consecutive failures
+
+    :param failures: number of consecutive failures opening the circuit
+    :param reset_timeout: seconds before a probe job is executed
+    :param key: function computing the key of a job, see
+                :py:func:`~connector8.queue.ratelimit.record_key`
+    """
+
+    def __init__(self, failures=5, reset_timeout=60, key=record_key):
+        assert failures > 0, "Invalid number of failures"
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.key = key
+
+    def key_for(self, job):
+        return self.key(job)
+
+
+class Circuit(object):
+    """ State of the circuit of a key """
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe = None  # uuid of the probe job
+
+    def __repr__(self):
+        return '<Circuit %s, failures:%d>' % (self.state, self.failures)
+
+    @property
+    def reopen_at(self):
+        """ Time when the circuit becomes half-open """
+        return self.opened_at + self.breaker.reset_timeout
+
+    def _update(self, now):
+        if self.state == OPEN and now >= self.reopen_at:
+            self.state = HALF_OPEN
+            self.probe = None
+
+
+class CircuitBreakers(object):
+    """ Circuits of the circuit breakers of a worker
+
+    The jobs are the jobs or the handles of the queue, their
+    ``circuit_breaker``, resolved from their function when the handle is
+    built, gives their :py:class:`CircuitBreaker` and their
+    ``circuit_key`` their circuit. A circuit is kept from the first
+    failure of its key until it is closed again, the keys without
+    circuit are closed. Not thread-safe, the queue calls it under its
+    lock.
+    """
+
+    def __init__(self):
+        self._circuits = {}
+
+    @staticmethod
+    def _key(job):
+        breaker = job.circuit_breaker
+        if breaker is None:
+            return None
+        return (breaker, job.circuit_key)
+
+    def circuit(self, job):
+        """ Circuit of the job, None when its function has no breaker or
+        when its circuit is closed without failure """
+        key = self._key(job)
+        if key is None:
+            return None
+        return self._circuits.get(key)
+
+    def can_start(self, job, now):
+        """ The circuit is closed, or half-open without probe running """
+        circuit = self.circuit(job)
+        if circuit is None:
+            return True
+        circuit._update(now)
+        if circuit.state == OPEN:
+            return False
+        return circuit.state == CLOSED or circuit.probe is None
+
+    def is_closed(self, job, now):
+        """ The job has no circuit or its circuit is closed """
+        circuit = self.circuit(job)
+        if circuit is None:
+            return True
+        circuit._update(now)
+        return circuit.state == CLOSED
+
+    def wait_time(self, job, now):
+        """ Seconds before the job can start, None when it waits for the
+        result of a probe """
+        circuit = self.circuit(job)
+        if circuit is None:
+            return 0
+        circuit._update(now)
+        if circuit.state == OPEN:
+            return max(circuit.reopen_at - now, 0)
+        if circuit.state == HALF_OPEN and circuit.probe is not None:
+            return None
+        return 0
+
+    def start(self, job, now):
+        """ A job starts, it is the probe when the circuit is
+        half-open """
+        circuit = self.circuit(job)
+        if circuit is not None:
+            circuit._update(now)
+            if circuit.state == HALF_OPEN:
+                circuit.probe = job.uuid
+
+    def done(self, job):
+        """ A job is done, if it was a probe without result another job
+        can be the probe """
+        circuit = self.circuit(job)
+        if circuit is not None and circuit.probe == job.uuid:
+            circuit.probe = None
+
+    def success(self, job):
+        """ Close the circuit of the job, it is dropped """
+        key = self._key(job)
+        if key is not None:
+            self._circuits.pop(key, None)
+
+    def failure(self, job, now):
+        """ Count a failure, return the circuit when it opens """
+        key = self._key(job)
+        if key is None:
+            return None
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = self._circuits[key] = Circuit(job.circuit_breaker)
+        circuit._update(now)
+        if circuit.state == OPEN:
+            return None
+        circuit.failures += 1
+        if (circuit.state == HALF_OPEN or
+                circuit.failures >= circuit.breaker.failures):
+            circuit.state = OPEN
+            circuit.opened_at = now
+            circuit.probe = None
+            return circuit
+        return None
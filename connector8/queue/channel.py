@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Channels of the jobs.
+
+A channel limits the number of its jobs running at once, its capacity.
+The channels form a tree whose root is ``root``: a job running in
+``root.images`` also counts in ``root``, so the subchannels share the
+capacity of their parents.
+
+The channels are configured with the ``connector_channels`` option of
+the configuration file, a list of ``name:capacity`` or
+``name:capacity:process``, the latter executing the jobs of the channel
+in child processes when the ``connector_processes`` option is set::
+
+    connector_channels = root:4,root.images:1,root.import:2:process
+    connector_processes = 2
+
+The capacity of ``root`` is by default the number of executor threads
+of the worker, plus its child processes. A channel without capacity
+(``root.export`` or ``root.export:``) is only limited by its parents.
+The jobs of a channel which is not configured run in its nearest
+configured parent.
+"""
+
+ROOT_CHANNEL = 'root'
+
+# execution modes of the jobs
+THREAD = 'thread'
+PROCESS = 'process'
+EXECUTIONS = (THREAD, PROCESS)
+
+
+def is_channel_name(name):
+    """ A channel name is a dotted path starting with ``root`` """
+    parts = name.split('.')
+    return parts[0] == ROOT_CHANNEL and all(parts)
+
+
+def parse_channels(value):
+    """ Parse the configuration of the channels
+
+    :param value: ``name:capacity[:execution]`` items separated by commas
+    :return: list of ``(name, capacity, execution)``, ``capacity`` and
+             ``execution`` are None when not given
+    """
+    channels = []
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        parts = [part.strip() for part in item.split(':')]
+        if len(parts) > 3 or not is_channel_name(parts[0]):
+            raise ValueError('Invalid channel configuration: %s' % item)
+        name = parts[0]
+        capacity = int(parts[1]) if len(parts) > 1 and parts[1] else None
+        execution = parts[2] if len(parts) > 2 and parts[2] else None
+        if execution is not None and execution not in EXECUTIONS:
+            raise ValueError('Invalid execution mode %r of channel %s, '
+                             'expected one of: %s' %
+                             (execution, name, ', '.join(EXECUTIONS)))
+        channels.append((name, capacity, execution))
+    return channels
+
+
+class Channel(object):
+    """ Node of the tree of channels
+
+    Keeps the heap of the ready jobs waiting in the channel, as
+    ``(priority, date_created, sequence, job)``, and counts the jobs
+    running in the channel and its subchannels.
+    """
+
+    def __init__(self, name, capacity=None, parent=None, execution=None):
+        self.name = name
+        self.capacity = capacity
+        self.parent = parent
+        self.execution = execution
+        self.running = 0
+        self.jobs = []
+
+    def __repr__(self):
+        return '<Channel %s, running:%d/%s, waiting:%d>' % (
+            self.name, self.running, self.capacity, len(self.jobs))
+
+    def path(self):
+        """ Iterate over the channel and its parents """
+        channel = self
+        while channel is not None:
+            yield channel
+            channel = channel.parent
+
+    def has_capacity(self):
+        """ A job can start when the channel and all its parents are not
+        full """
+        return all(channel.capacity is None or
+                   channel.running < channel.capacity
+                   for channel in self.path())
+
+    def load(self):
+        """ Ratio of the running jobs over the capacity of the channel,
+        or the capacity of the nearest parent having one """
+        for channel in self.path():
+            if channel.capacity:
+                return float(self.running) / channel.capacity
+        return float(self.running)
+
+    def start(self):
+        for channel in self.path():
+            channel.running += 1
+
+    def stop(self):
+        for channel in self.path():
+            channel.running -= 1
+
+
+class ChannelTree(object):
+    """ The configured channels
+
+    :param config: value of the ``connector_channels`` option
+    :param root_capacity: capacity of ``root`` when it is not configured,
+                          None for an unlimited capacity
+    """
+
+    def __init__(self, config=None, root_capacity=None):
+        self.channels = {}
+        configured = dict((name, (capacity, execution)) for
+                          name, capacity, execution in parse_channels(config))
+        configured.setdefault(ROOT_CHANNEL, (root_capacity, None))
+        # parents first
+        for name in sorted(configured, key=lambda name: name.count('.')):
+            capacity, execution = configured[name]
+            parent = None
+            if name != ROOT_CHANNEL:
+                parent = self.get(name.rsplit('.', 1)[0])
+            self.channels[name] = Channel(name, capacity=capacity,
+                                          parent=parent, execution=execution)
+
+    def get(self, name):
+        """ Return the channel ``name`` or its nearest configured parent """
+        while name not in self.channels:
+            if '.' not in name:
+                return self.channels[ROOT_CHANNEL]
+            name = name.rsplit('.', 1)[0]
+        return self.channels[name]
+
+    def __iter__(self):
+        return self.channels.itervalues()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Codecs for the payload of the jobs, the ``(func_name, args, kwargs)``
+tuple stored in ``queue.job.func``.
+
+An encoded payload starts with a version byte identifying the codec
+able to decode it. Payloads written before the codecs existed are raw
+pickles (protocol 0, starting with ``(``), they are decoded as such.
+
+Payloads bigger than ``COMPRESS_THRESHOLD`` bytes are compressed with
+lz4 when the ``lz4`` library is installed, zlib otherwise.
+
+New codecs can be added with :py:func:`register_codec`.
+"""
+
+import zlib
+from cPickle import loads, dumps, HIGHEST_PROTOCOL
+
+try:
+    from lz4.block import compress as lz4_compress
+    from lz4.block import decompress as lz4_decompress
+except ImportError:
+    try:
+        from lz4 import compress as lz4_compress
+        from lz4 import decompress as lz4_decompress
+    except ImportError:
+        lz4_compress = lz4_decompress = None
+
+COMPRESS_THRESHOLD = 1024  # bytes
+
+
+class PayloadCodec(object):
+    """ Encode and decode a payload, without the version byte """
+
+    version = None  # 1 byte, identifies the codec in the stored data
+
+    def encode(self, payload):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class PickleCodec(PayloadCodec):
+    """ Binary pickle protocol """
+
+    version = '\x01'
+
+    def encode(self, payload):
+        return dumps(payload, HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return loads(data)
+
+
+class CompressedPickleCodec(PickleCodec):
+    """ Binary pickle protocol, compressed """
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+    def encode(self, payload):
+        return self.compress(
+            super(CompressedPickleCodec, self).encode(payload))
+
+    def decode(self, data):
+        return super(CompressedPickleCodec, self).decode(
+            self.decompress(data))
+
+
+class ZlibPickleCodec(CompressedPickleCodec):
+    """ Binary pickle compressed with zlib """
+
+    version = '\x02'
+
+    def compress(self, data):
+        return zlib.compress(data, 1)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class Lz4PickleCodec(CompressedPickleCodec):
+    """ Binary pickle compressed with lz4 """
+
+    version = '\x03'
+
+    def compress(self, data):
+        return lz4_compress(data)
+
+    def decompress(self, data):
+        return lz4_decompress(data)
+
+
+_codecs = {}
+
+
+def register_codec(codec):
+    """ Register a codec instance so its payloads can be decoded """
+    assert codec.version and len(codec.version) == 1, (
+        "The version of a codec must be a single byte")
+    assert codec.version not in ('(', '\x80'), (
+        "The version of a codec cannot be the start of a pickle")
+    _codecs[codec.version] = codec
+    return codec
+
+
+plain_codec = register_codec(PickleCodec())
+register_codec(ZlibPickleCodec())
+if lz4_compress is not None:
+    compress_codec = register_codec(Lz4PickleCodec())
+else:
+    compress_codec = _codecs[ZlibPickleCodec.version]
+
+
+def encode_payload(payload, codec=None):
+    """ Encode a payload with ``codec`` or the plain pickle codec,
+    switching to the compression codec above ``COMPRESS_THRESHOLD``
+    """
+    if codec is not None:
+        return codec.version + codec.encode(payload)
+    data = plain_codec.encode(payload)
+    if len(data) <= COMPRESS_THRESHOLD:
+        return plain_codec.version + data
+    return compress_codec.version + compress_codec.compress(data)
+
+
+def decode_payload(data):
+    """ Decode a payload encoded by any registered codec or a legacy
+    pickle """
+    codec = _codecs.get(data[:1])
+    if codec is None:
+        return loads(data)
+    return codec.decode(data[1:])
@@ -2,16 +2,27 @@
 
 import inspect
 import functools
+import hashlib
+from itertools import islice
 import logging
 import uuid
 import sys
+import traceback
 from datetime import datetime, timedelta, MINYEAR
-from cPickle import loads, dumps, UnpicklingError
+import zlib
+from cPickle import UnpicklingError
+
+import psycopg2
 
 from openerp import SUPERUSER_ID
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.tools.translate import _
 
+from .channel import ROOT_CHANNEL, THREAD, PROCESS, is_channel_name
+from .codec import encode_payload, decode_payload
+from .breaker import CircuitBreaker
+from .ratelimit import RateLimit
+from .retry import FixedRetry, RetryPolicy, TableRetry
 from ..exception import (NotReadableJobError,
                          NoSuchJobError,
                          FailedJobError,
@@ -32,27 +43,143 @@ STATES = [(PENDING, 'Pending'),
 DEFAULT_PRIORITY = 10  # used by the PriorityQueue to sort the jobs
 DEFAULT_MAX_RETRIES = 5
 RETRY_INTERVAL = 10 * 60  # seconds
+DEFAULT_RETRY_POLICY = FixedRetry(RETRY_INTERVAL)
+ENQUEUE_CHUNK_SIZE = 1000  # rows inserted at once by enqueue_many
+DEFAULT_BATCH_SIZE = 50  # jobs executed at once by a batch handler
+# first key of the advisory locks taken on the identity keys
+IDENTITY_LOCK = 7301
+# a coalesced job is delayed by at most this number of windows after
+# its creation
+COALESCE_MAX_WINDOWS = 10
+
+# channel of the NOTIFY sent when jobs are ready to be assigned
+NOTIFY_CHANNEL = 'connector_queue_job'
+
+# keyword arguments of ``delay()`` which are options of the job
+# and not arguments for the job's function
+JOB_OPTIONS = ('priority', 'eta', 'model_name', 'max_retries',
+               'description', 'identity_key', 'coalesce', 'channel')
 
 _logger = logging.getLogger(__name__)
 
 
+def notify_new_jobs(cr):
+    """ Notify the workers of jobs to assign, for the versions of
+    PostgreSQL older than 10 only: the ``queue_job_notify`` triggers
+    which notify them need transition tables """
+    if cr._cnx.server_version < 100000:
+        cr.execute("SELECT pg_notify(%s, '')", (NOTIFY_CHANNEL,))
+
+
 def _unpickle(pickled):
-    """ Unpickles a string and catch all types of errors it can throw,
+    """ Decodes a payload and catch all types of errors it can throw,
     to raise only NotReadableJobError in case of error.
 
-    Odoo stores the text fields as 'utf-8', so we specify the encoding.
+    The payload is decoded by the codec identified by its version
+    byte, or unpickled if it has been stored before the codecs.
 
     `loads()` may raises many types of exceptions (AttributeError,
     IndexError, TypeError, KeyError, ...). They are all catched and
     raised as `NotReadableJobError`).
     """
     try:
-        unpickled = loads(pickled)
-    except (StandardError, UnpicklingError):
+        unpickled = decode_payload(pickled)
+    except (StandardError, UnpicklingError, zlib.error):
         raise NotReadableJobError('Could not unpickle.', pickled)
     return unpickled
 
 
+def _pop_job_options(kwargs, options=JOB_OPTIONS):
+    """ Extract the options of a job from the keyword arguments
+    given to ``delay()`` """
+    return dict((option, kwargs.pop(option, None)) for option in options)
+
+
+def identity_exact(job):
+    """ Identity key of a job computed from its function and arguments
+
+    Usage::
+
+        export_record.delay(session, 'a.model', record_id,
+                            identity_key=identity_exact)
+
+    """
+    hasher = hashlib.sha1()
+    hasher.update(job.func_name)
+    hasher.update(repr(job.args))
+    hasher.update(repr(sorted(job.kwargs.iteritems())))
+    return hasher.hexdigest()
+
+
+def _coalesce_key(job):
+    """ Identity key shared by the jobs which can be coalesced: same
+    function, model and record id (the first argument after the model)
+    """
+    hasher = hashlib.sha1()
+    hasher.update('coalesce')
+    hasher.update(job.func_name)
+    hasher.update(repr(job.args[:2]))
+    return hasher.hexdigest()
+
+
+def _merge_kwargs(kwargs, new_kwargs):
+    """ Merge the keyword arguments of coalesced jobs
+
+    The lists, tuples or sets (such as a list of fields) are unioned, a
+    ``None`` value (meaning 'all the fields') wins over a list. The
+    other values are replaced by the new ones.
+    """
+    collections = (list, tuple, set)
+    merged = dict(kwargs)
+    for key, value in new_kwargs.iteritems():
+        current = merged.get(key)
+        if ((current is None and key in merged and
+                isinstance(value, collections)) or
+                (value is None and isinstance(current, collections))):
+            merged[key] = None
+        elif (isinstance(current, collections) and
+                isinstance(value, collections)):
+            union = list(current)
+            union += [item for item in value if item not in union]
+            merged[key] = type(current)(union)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _params_sql(columns):
+    """ SQL named placeholders for ``columns``: ``%(col1)s, %(col2)s`` """
+    return ', '.join('%%(%s)s' % col for col in columns)
+
+
+def _assignments_sql(columns):
+    """ SQL assignments of named placeholders: ``col1 = %(col1)s, ...`` """
+    return ', '.join('%s = %%(%s)s' % (col, col) for col in columns)
+
+
+def _values_sql(columns):
+    """ SQL row of positional placeholders for ``VALUES`` """
+    return '(%s)' % ', '.join(['%s'] * len(columns))
+
+
+def _import_func(func_name):
+    """ Function of a job from its dotted name """
+    if func_name is None:
+        return None
+    module_name, func_name = func_name.rsplit('.', 1)
+    __import__(module_name)
+    module = sys.modules[module_name]
+    return getattr(module, func_name)
+
+
+def _to_datetime(value):
+    """ Convert a datetime read from the database, which can be a
+    string or a datetime according to the cursor's typecasters. """
+    if not value or isinstance(value, datetime):
+        return value or None
+    return datetime.strptime(value[:19], DEFAULT_SERVER_DATETIME_FORMAT)
+
+
 class JobStorage(object):
     """ Interface for the storage of jobs """
 
@@ -64,6 +191,10 @@ class JobStorage(object):
         """ Read the job's data from the storage """
         raise NotImplementedError
 
+    def load_many(self, job_uuids):
+        """ Read the data of several jobs from the storage """
+        return [self.load(job_uuid) for job_uuid in job_uuids]
+
     def exists(self, job_uuid):
         """Returns if a job still exists in the storage."""
         raise NotImplementedError
@@ -73,55 +204,266 @@ class OdooJobStorage(JobStorage):
     """ Store a job on Odoo """
 
     _job_model_name = 'queue.job'
+    _detail_model_name = 'queue.job.detail'
     _worker_model_name = 'queue.worker'
 
     def __init__(self, session):
         super(OdooJobStorage, self).__init__()
         self.session = session
         self.job_model = self.session.pool.get(self._job_model_name)
+        self.detail_model = self.session.pool.get(self._detail_model_name)
         self.worker_model = self.session.pool.get(self._worker_model_name)
         assert self.job_model is not None, (
             "Model %s not found" % self._job_model_name)
 
     def enqueue(self, func, model_name=None, args=None, kwargs=None,
-                priority=None, eta=None, max_retries=None, description=None):
+                priority=None, eta=None, max_retries=None, description=None,
+                identity_key=None, coalesce=None, channel=None):
         """Create a Job and enqueue it in the queue. Return the job uuid.
 
         This expects the arguments specific to the job to be already extracted
         from the ones to pass to the job function.
 
+        When the job has an ``identity_key`` and a pending or enqueued job
+        with the same key exists, no job is created and the uuid of the
+        existing job is returned. The key is locked until the end of the
+        transaction, see :py:meth:`_lock_identities`.
+
+        When ``coalesce`` is a number of seconds, the job is delayed by
+        this window and the jobs for the same function, model and record
+        id enqueued during the window are merged into it, see
+        :py:meth:`_coalesce`. The coalesced jobs are identified by their
+        own key, an ``identity_key`` cannot be given with ``coalesce``.
+
         """
+        if coalesce and identity_key:
+            raise ValueError('A job cannot have both an identity key and '
+                             'a coalesce window')
         job = Job(func=func, model_name=model_name, args=args, kwargs=kwargs,
                   priority=priority, eta=eta, max_retries=max_retries,
-                  description=description)
+                  description=description, identity_key=identity_key,
+                  channel=channel)
+        if coalesce:
+            job.identity_key = _coalesce_key(job)
+            self._lock_identities([job.identity_key])
+            window_end = datetime.now() + timedelta(seconds=coalesce)
+            if not job.eta or job.eta < window_end:
+                job.eta = window_end
+            coalesced_uuid = self._coalesce(job, coalesce)
+            if coalesced_uuid:
+                return coalesced_uuid
+        elif job.identity_key:
+            self._lock_identities([job.identity_key])
+            existing = self._uuids_by_identity([job.identity_key])
+            if existing:
+                _logger.debug('%s not enqueued, job %s has the same '
+                              'identity key', job, existing[job.identity_key])
+                return existing[job.identity_key]
         job.user_id = self.session.uid
-        if 'company_id' in self.session.context:
-            company_id = self.session.context['company_id']
-        else:
-            company_obj = self.session.pool['res.company']
-            company_id = company_obj._company_default_get(
-                self.session.cr, job.user_id,
-                object='queue.job',
-                field='company_id',
-                context=self.session.context)
-        job.company_id = company_id
+        job.company_id = self._company_id()
         self.store(job)
         return job.uuid
 
+    def _coalesce(self, job, window):
+        """ Merge ``job`` into a pending or enqueued job with the same
+        coalesce key whose ``eta`` is not reached yet.
+
+        The arguments of the existing job are replaced by the new ones and
+        its keyword arguments are merged with ``_merge_kwargs``. Its
+        ``eta`` is pushed back to the end of the ``window`` of ``job``,
+        but not later than ``COALESCE_MAX_WINDOWS`` windows after its
+        creation: a burst of jobs is executed once when it stops, or
+        at this limit when it goes on. Return the uuid of the existing
+        job or None if there is no job to coalesce with.
+        """
+        cr = self.session.cr
+        cr.execute("SELECT uuid FROM queue_job "
+                   "WHERE identity_key = %s "
+                   "AND state IN %s "
+                   "AND eta > %s "
+                   "ORDER BY eta LIMIT 1 FOR UPDATE",
+                   (job.identity_key, (PENDING, ENQUEUED),
+                    datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)))
+        row = cr.fetchone()
+        if not row:
+            return None
+        existing = self.load(row[0])
+        existing.args = job.args
+        existing.kwargs = _merge_kwargs(existing.kwargs, job.kwargs)
+        self._store_payload(existing)
+        latest = existing.date_created + timedelta(
+            seconds=window * COALESCE_MAX_WINDOWS)
+        eta = min(job.eta, latest)
+        if eta > existing.eta:
+            cr.execute("UPDATE queue_job SET eta = %s WHERE uuid = %s",
+                       (eta.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+                        existing.uuid))
+            self.job_model.invalidate_cache(cr, SUPERUSER_ID, ['eta'],
+                                            context=self.session.context)
+        _logger.debug('%s coalesced into %s', job, existing)
+        return existing.uuid
+
+    def _store_payload(self, job):
+        """ Update the function's arguments of a stored job """
+        params = self._sql_params(self._detail_create_values(job),
+                                  self.detail_model)
+        params['uuid'] = job.uuid
+        self.session.cr.execute("UPDATE queue_job_detail d "
+                                "SET func = %(func)s, "
+                                "    func_string = %(func_string)s "
+                                "FROM queue_job j "
+                                "WHERE j.id = d.job_id "
+                                "AND j.uuid = %(uuid)s", params)
+
+    def _lock_identities(self, identity_keys):
+        """ Take a transaction advisory lock per identity key
+
+        A concurrent transaction enqueuing a job with one of the keys
+        waits until this one ends, its lookup then finds the job created
+        here instead of creating a duplicate. The locks are taken in a
+        fixed order to prevent deadlocks.
+        """
+        self.session.cr.execute(
+            "SELECT pg_advisory_xact_lock(%s, k) "
+            "FROM (SELECT DISTINCT hashtext(key) AS k "
+            "      FROM unnest(%s::text[]) AS key "
+            "      ORDER BY k) AS keys",
+            (IDENTITY_LOCK, list(identity_keys)))
+
+    def _uuids_by_identity(self, identity_keys):
+        """ Return the uuids of the pending or enqueued jobs having one
+        of the identity keys, as a dict ``{identity_key: uuid}`` """
+        cr = self.session.cr
+        cr.execute("SELECT identity_key, uuid FROM queue_job "
+                   "WHERE identity_key IN %s "
+                   "AND state IN %s",
+                   (tuple(identity_keys), (PENDING, ENQUEUED)))
+        return dict(cr.fetchall())
+
+    def _company_id(self):
+        """ Company of the jobs created in the current session """
+        if 'company_id' in self.session.context:
+            return self.session.context['company_id']
+        company_obj = self.session.pool['res.company']
+        return company_obj._company_default_get(
+            self.session.cr, self.session.uid,
+            object='queue.job',
+            field='company_id',
+            context=self.session.context)
+
+    def enqueue_many(self, func, args_list, model_name=None, kwargs=None,
+                     priority=None, eta=None, max_retries=None,
+                     description=None, identity_key=None, coalesce=None,
+                     channel=None, chunk_size=None):
+        """Create one Job per arguments tuple of ``args_list`` and
+        enqueue them. Return the list of the jobs uuids.
+
+        The user and the company are resolved once for all the jobs and
+        the jobs are inserted with multi-rows ``INSERT`` statements of
+        ``chunk_size`` rows (default is ``ENQUEUE_CHUNK_SIZE``).
+
+        ``args_list`` can be any iterable, it is consumed chunk by chunk.
+
+        As in :py:meth:`enqueue`, the jobs having the ``identity_key`` of
+        a pending or enqueued job are not created, the uuid of the
+        existing job is returned in their place.
+
+        Coalesced jobs need to be merged one by one, when ``coalesce`` is
+        used, the jobs are enqueued with :py:meth:`enqueue`.
+        """
+        if coalesce and identity_key:
+            raise ValueError('A job cannot have both an identity key and '
+                             'a coalesce window')
+        if coalesce:
+            return [self.enqueue(func, model_name=model_name,
+                                 args=tuple(args), kwargs=kwargs,
+                                 priority=priority, eta=eta,
+                                 max_retries=max_retries,
+                                 description=description,
+                                 coalesce=coalesce, channel=channel)
+                    for args in args_list]
+        if chunk_size is None:
+            chunk_size = ENQUEUE_CHUNK_SIZE
+        user_id = self.session.uid
+        company_id = self._company_id()
+        uuids = []
+        args_iter = iter(args_list)
+        while True:
+            jobs = []
+            for args in islice(args_iter, chunk_size):
+                job = Job(func=func, model_name=model_name,
+                          args=tuple(args), kwargs=kwargs,
+                          priority=priority, eta=eta,
+                          max_retries=max_retries, description=description,
+                          identity_key=identity_key, channel=channel)
+                job.user_id = user_id
+                job.company_id = company_id
+                jobs.append(job)
+            if not jobs:
+                break
+            identity_keys = [new.identity_key for new in jobs
+                             if new.identity_key]
+            existing = {}
+            if identity_keys:
+                self._lock_identities(identity_keys)
+                existing = self._uuids_by_identity(identity_keys)
+            new_jobs = []
+            for job in jobs:
+                if job.identity_key in existing:
+                    uuids.append(existing[job.identity_key])
+                    continue
+                if job.identity_key:
+                    existing[job.identity_key] = job.uuid
+                new_jobs.append(job)
+                uuids.append(job.uuid)
+            if new_jobs:
+                self._insert_many(new_jobs)
+        return uuids
+
+    def enqueue_many_resolve_args(self, func, args_list, **kwargs):
+        """Create Jobs and enqueue them. Return the jobs uuids."""
+        options = _pop_job_options(kwargs, JOB_OPTIONS + ('chunk_size',))
+        return self.enqueue_many(func, args_list, kwargs=kwargs, **options)
+
+    def _insert_many(self, jobs):
+        """ Insert new jobs and their details with a single statement
+        using multi-rows ``VALUES`` """
+        rows = []
+        detail_rows = []
+        for job in jobs:
+            vals = dict(self._job_values(job), **self._job_create_values(job))
+            rows.append(self._sql_params(vals, self.job_model))
+            detail_vals = dict(self._detail_values(job),
+                               **self._detail_create_values(job))
+            detail_vals = self._sql_params(detail_vals, self.detail_model)
+            detail_vals['uuid'] = job.uuid
+            detail_rows.append(detail_vals)
+        columns = sorted(rows[0])
+        detail_columns = sorted(detail_rows[0])
+        sql = ("WITH inserted AS ("
+               "  INSERT INTO queue_job (%s) VALUES %s RETURNING id, uuid"
+               ") "
+               "INSERT INTO queue_job_detail (job_id, %s) "
+               "SELECT inserted.id, %s FROM inserted "
+               "JOIN (VALUES %s) AS detail (%s) "
+               "ON detail.uuid = inserted.uuid" % (
+                   ', '.join(columns),
+                   ', '.join([_values_sql(columns)] * len(rows)),
+                   ', '.join(col for col in detail_columns if col != 'uuid'),
+                   ', '.join('detail.%s' % col for col in detail_columns
+                             if col != 'uuid'),
+                   ', '.join([_values_sql(detail_columns)] * len(rows)),
+                   ', '.join(detail_columns)))
+        params = [row[column] for row in rows for column in columns]
+        params += [row[column] for row in detail_rows
+                   for column in detail_columns]
+        self.session.cr.execute(sql, params)
+        notify_new_jobs(self.session.cr)
+
     def enqueue_resolve_args(self, func, *args, **kwargs):
         """Create a Job and enqueue it in the queue. Return the job uuid."""
-        priority = kwargs.pop('priority', None)
-        eta = kwargs.pop('eta', None)
-        model_name = kwargs.pop('model_name', None)
-        max_retries = kwargs.pop('max_retries', None)
-        description = kwargs.pop('description', None)
-
-        return self.enqueue(func, model_name=model_name,
-                            args=args, kwargs=kwargs,
-                            priority=priority,
-                            max_retries=max_retries,
-                            eta=eta,
-                            description=description)
+        options = _pop_job_options(kwargs)
+        return self.enqueue(func, args=args, kwargs=kwargs, **options)
 
     def exists(self, job_uuid):
         """Returns if a job still exists in the storage."""
@@ -141,31 +483,19 @@ class OdooJobStorage(JobStorage):
     def odoo_id(self, job):
         return self._odoo_id(job.uuid)
 
-    def _worker_id(self, worker_uuid):
-        odoo_id = None
-        worker_ids = self.worker_model.search(self.session.cr,
-                                              SUPERUSER_ID,
-                                              [('uuid', '=', worker_uuid)],
-                                              context=self.session.context,
-                                              limit=1)
-        if worker_ids:
-            odoo_id = worker_ids[0]
-        return odoo_id
-
-    def store(self, job):
-        """ Store the Job """
+    def _job_values(self, job):
+        """ Values of the ``queue.job`` record written at each store """
         vals = {'state': job.state,
                 'priority': job.priority,
                 'retry': job.retry,
                 'max_retries': job.max_retries,
-                'exc_info': job.exc_info,
                 'user_id': job.user_id or self.session.uid,
                 'company_id': job.company_id,
-                'result': unicode(job.result) if job.result else False,
                 'date_enqueued': False,
                 'date_started': False,
                 'date_done': False,
                 'eta': False,
+                'active': not job.canceled,
                 }
 
         if job.date_enqueued:
@@ -179,91 +509,326 @@ class OdooJobStorage(JobStorage):
                 DEFAULT_SERVER_DATETIME_FORMAT)
         if job.eta:
             vals['eta'] = job.eta.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        return vals
+
+    def _job_create_values(self, job):
+        """ Values of the ``queue.job`` record written only on creation """
+        fmt = DEFAULT_SERVER_DATETIME_FORMAT
+        return {'uuid': job.uuid,
+                'name': job.description,
+                'func_name': job.func_name,
+                'date_created': job.date_created.strftime(fmt),
+                'model_name': job.model_name if job.model_name else False,
+                'identity_key': job.identity_key or False,
+                'channel': job.channel,
+                'rate_limit_key': job.rate_limit_key or False,
+                'circuit_key': job.circuit_key or False,
+                'timeout': job.timeout or False,
+                }
 
-        if job.canceled:
-            vals['active'] = False
+    def _detail_values(self, job):
+        """ Values of the ``queue.job.detail`` record written at each
+        store """
+        return {'exc_info': job.exc_info,
+                'result': unicode(job.result) if job.result else False,
+                }
 
-        if job.worker_uuid:
-            vals['worker_id'] = self._worker_id(job.worker_uuid)
-        else:
-            vals['worker_id'] = False
-
-        if self.exists(job.uuid):
-            self.job_model.write(self.session.cr,
-                                 self.session.uid,
-                                 self.odoo_id(job),
-                                 vals,
-                                 self.session.context)
-        else:
-            fmt = DEFAULT_SERVER_DATETIME_FORMAT
-            date_created = job.date_created.strftime(fmt)
-            vals.update({'uuid': job.uuid,
-                         'name': job.description,
-                         'func_string': job.func_string,
-                         'date_created': date_created,
-                         'model_name': (job.model_name if job.model_name
-                                        else False),
-                         })
-
-            vals['func'] = dumps((job.func_name,
-                                  job.args,
-                                  job.kwargs))
-
-            self.job_model.create(self.session.cr,
-                                  SUPERUSER_ID,
-                                  vals,
-                                  self.session.context)
+    def _detail_create_values(self, job):
+        """ Values of the ``queue.job.detail`` record written only on
+        creation """
+        return {'func_string': job.func_string,
+                'func': encode_payload((job.func_name,
+                                        job.args,
+                                        job.kwargs)),
+                }
+
+    def _sql_params(self, vals, model):
+        """ Convert ORM values to parameters for a SQL query
+
+        The ORM uses ``False`` for empty values, PostgreSQL wants NULL
+        (except for the boolean columns). Binary values are wrapped.
+        """
+        fields = model._fields
+        params = {}
+        for name, value in vals.iteritems():
+            field_type = fields[name].type
+            if field_type == 'binary':
+                value = psycopg2.Binary(value) if value else None
+            elif value is False and field_type != 'boolean':
+                value = None
+            params[name] = value
+        return params
+
+    def store(self, job):
+        """ Store the Job
+
+        The job and its details are inserted or updated according to its
+        UUID in a single SQL statement (the worker is resolved in a
+        sub-query). The details are only rewritten when the result or
+        the exception information changed.
+        """
+        vals = self._job_values(job)
+        create_vals = self._job_create_values(job)
+        detail_vals = self._detail_values(job)
+        detail_create_vals = self._detail_create_values(job)
+        params = self._sql_params(dict(vals, **create_vals), self.job_model)
+        params.update(self._sql_params(
+            dict(detail_vals, **detail_create_vals), self.detail_model))
+        params['worker_uuid'] = job.worker_uuid or None
+
+        insert_columns = sorted(dict(vals, **create_vals))
+        detail_insert_columns = sorted(dict(detail_vals,
+                                            **detail_create_vals))
+        worker_query = ("(SELECT id FROM queue_worker "
+                        " WHERE uuid = %(worker_uuid)s LIMIT 1)")
+        sql = ("WITH updated AS ("
+               "  UPDATE queue_job SET %(assignments)s, worker_id = %(worker)s"
+               "  WHERE uuid = %%(uuid)s RETURNING id"
+               "), inserted AS ("
+               "  INSERT INTO queue_job (%(columns)s, worker_id)"
+               "  SELECT %(values)s, %(worker)s"
+               "  WHERE NOT EXISTS (SELECT 1 FROM updated) RETURNING id"
+               "), detail_updated AS ("
+               "  UPDATE queue_job_detail SET %(detail_assignments)s"
+               "  WHERE job_id IN (SELECT id FROM updated)"
+               "  AND (%(detail_changed)s)"
+               "), detail_inserted AS ("
+               "  INSERT INTO queue_job_detail (job_id, %(detail_columns)s)"
+               "  SELECT id, %(detail_values)s FROM inserted"
+               ") "
+               "SELECT id FROM updated UNION ALL SELECT id FROM inserted" %
+               {'assignments': _assignments_sql(sorted(vals)),
+                'worker': worker_query,
+                'columns': ', '.join(insert_columns),
+                'values': _params_sql(insert_columns),
+                'detail_assignments': _assignments_sql(sorted(detail_vals)),
+                'detail_changed': ' OR '.join(
+                    '%s IS DISTINCT FROM %%(%s)s' % (col, col)
+                    for col in sorted(detail_vals)),
+                'detail_columns': ', '.join(detail_insert_columns),
+                'detail_values': _params_sql(detail_insert_columns),
+                })
+        cr = self.session.cr
+        cr.execute(sql, params)
+        job_id = cr.fetchone()[0]
+        # the record has been modified behind the ORM, only its own
+        # cache is invalidated, not the records of the caller
+        self.job_model.invalidate_cache(cr, SUPERUSER_ID, ids=[job_id],
+                                        context=self.session.context)
+        self.detail_model.invalidate_cache(cr, SUPERUSER_ID,
+                                           sorted(detail_vals),
+                                           context=self.session.context)
+        if job.state == FAILED:
+            self.job_model._notify_failed(cr, self.session.uid, [job_id],
+                                          context=self.session.context)
+        elif job.state == PENDING and not job.worker_uuid:
+            notify_new_jobs(cr)
 
     def load(self, job_uuid):
         """ Read a job from the Database"""
-        if not self.exists(job_uuid):
+        jobs = self.load_many([job_uuid])
+        if not jobs:
             raise NoSuchJobError(
                 '%s does no longer exist in the storage.' % job_uuid)
-        stored = self.job_model.browse(self.session.cr,
-                                       self.session.uid,
-                                       self._odoo_id(job_uuid),
-                                       context=self.session.context)
+        return jobs[0]
 
-        func = _unpickle(stored.func)
+    def load_many(self, job_uuids):
+        """ Read jobs from the Database with a single query
 
-        (func_name, args, kwargs) = func
+        The jobs which no longer exist are skipped, the others are
+        returned in the order of ``job_uuids``.
+        """
+        if not job_uuids:
+            return []
+        cr = self.session.cr
+        cr.execute("SELECT j.uuid, d.func, j.name, j.state, j.priority, "
+                   "       j.eta, j.date_created, j.date_enqueued, "
+                   "       j.date_started, j.date_done, d.result, "
+                   "       d.exc_info, j.user_id, j.company_id, j.active, "
+                   "       j.model_name, j.retry, j.max_retries, "
+                   "       j.identity_key, j.channel, j.rate_limit_key, "
+                   "       j.circuit_key, j.timeout, "
+                   "       w.uuid AS worker_uuid "
+                   "FROM queue_job j "
+                   "JOIN queue_job_detail d ON d.job_id = j.id "
+                   "LEFT JOIN queue_worker w ON w.id = j.worker_id "
+                   "WHERE j.uuid IN %s",
+                   (tuple(job_uuids),))
+        jobs = dict((row['uuid'], self._job_from_row(row))
+                    for row in cr.dictfetchall())
+        return [jobs[job_uuid] for job_uuid in job_uuids
+                if job_uuid in jobs]
+
+    def set_enqueued_many(self, job_uuids, worker_uuid):
+        """ Set the pending jobs assigned to a worker to enqueued with a
+        single ``UPDATE``.
+
+        The jobs which are no longer pending or assigned to the worker
+        are skipped. Their payload is not read, the job is loaded when
+        it is executed.
+
+        :param job_uuids: uuids of the jobs
+        :param worker_uuid: uuid of the worker of the jobs
+        :return: :py:class:`JobHandle` of the enqueued jobs, in the order
+                 of ``job_uuids``
+        """
+        if not job_uuids:
+            return []
+        cr = self.session.cr
+        now = datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cr.execute("UPDATE queue_job j "
+                   "SET state = %s, date_enqueued = %s, date_started = NULL "
+                   "FROM queue_worker w "
+                   "WHERE w.id = j.worker_id "
+                   "AND w.uuid = %s "
+                   "AND j.uuid IN %s "
+                   "AND j.state = %s "
+                   "RETURNING j.id, j.uuid, j.func_name, j.priority, "
+                   "          j.eta, j.date_created, j.channel, j.user_id, "
+                   "          j.rate_limit_key, j.circuit_key, j.timeout",
+                   (ENQUEUED, now, worker_uuid, tuple(job_uuids), PENDING))
+        rows = cr.fetchall()
+        self.job_model.invalidate_cache(
+            cr, SUPERUSER_ID, ['state', 'date_enqueued', 'date_started'],
+            [row[0] for row in rows], context=self.session.context)
+        handles = dict(
+            (job_uuid, JobHandle(job_uuid, func_name, priority=priority,
+                                 eta=_to_datetime(eta),
+                                 date_created=_to_datetime(date_created),
+                                 channel=channel, user_id=user_id,
+                                 rate_limit_key=rate_limit_key,
+                                 circuit_key=circuit_key, timeout=timeout))
+            for (__, job_uuid, func_name, priority, eta, date_created,
+                 channel, user_id, rate_limit_key, circuit_key,
+                 timeout) in rows)
+        return [handles[job_uuid] for job_uuid in job_uuids
+                if job_uuid in handles]
+
+    def release_many(self, job_uuids, worker_uuid, state=PENDING):
+        """ Unassign jobs from a worker and set them to pending, so any
+        worker can claim them again
+
+        :param job_uuids: uuids of the jobs
+        :param worker_uuid: uuid of the worker of the jobs
+        :param state: only the jobs in this state are released
+        """
+        if not job_uuids:
+            return
+        cr = self.session.cr
+        cr.execute("UPDATE queue_job j "
+                   "SET state = %s, worker_id = NULL, date_enqueued = NULL "
+                   "FROM queue_worker w "
+                   "WHERE w.id = j.worker_id "
+                   "AND w.uuid = %s "
+                   "AND j.uuid IN %s "
+                   "AND j.state = %s "
+                   "RETURNING j.id",
+                   (PENDING, worker_uuid, tuple(job_uuids), state))
+        job_ids = [row[0] for row in cr.fetchall()]
+        self.job_model.invalidate_cache(
+            cr, SUPERUSER_ID, ['state', 'worker_id', 'date_enqueued'],
+            job_ids, context=self.session.context)
+        if job_ids:
+            notify_new_jobs(cr)
+
+    def requeue_started(self, job_uuids, worker_uuid):
+        """ Set to enqueued the jobs still started by a worker, with a
+        single ``UPDATE``
+
+        The state is checked by the update itself, so a job set to done
+        by a transaction committed concurrently is never overwritten.
 
-        eta = None
-        if stored.eta:
-            eta = datetime.strptime(stored.eta, DEFAULT_SERVER_DATETIME_FORMAT)
+        :param job_uuids: uuids of the jobs
+        :param worker_uuid: uuid of the worker of the jobs
+        :return: uuids of the enqueued jobs, in the order of ``job_uuids``
+        """
+        if not job_uuids:
+            return []
+        cr = self.session.cr
+        now = datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cr.execute("UPDATE queue_job j "
+                   "SET state = %s, date_enqueued = %s, date_started = NULL "
+                   "FROM queue_worker w "
+                   "WHERE w.id = j.worker_id "
+                   "AND w.uuid = %s "
+                   "AND j.uuid IN %s "
+                   "AND j.state = %s "
+                   "RETURNING j.id, j.uuid",
+                   (ENQUEUED, now, worker_uuid, tuple(job_uuids), STARTED))
+        rows = cr.fetchall()
+        self.job_model.invalidate_cache(
+            cr, SUPERUSER_ID, ['state', 'date_enqueued', 'date_started'],
+            [row[0] for row in rows], context=self.session.context)
+        requeued = set(row[1] for row in rows)
+        return [job_uuid for job_uuid in job_uuids if job_uuid in requeued]
+
+    def postpone_circuit(self, circuit_key, eta):
+        """ Postpone to ``eta`` the pending and enqueued jobs having the
+        circuit key, in one ``UPDATE``, without changing their retries
+
+        :return: number of postponed jobs
+        """
+        cr = self.session.cr
+        eta_fmt = eta.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cr.execute("UPDATE queue_job SET eta = %s "
+                   "WHERE circuit_key = %s "
+                   "AND state IN %s "
+                   "AND (eta IS NULL OR eta < %s) "
+                   "RETURNING id",
+                   (eta_fmt, circuit_key, (PENDING, ENQUEUED), eta_fmt))
+        job_ids = [row[0] for row in cr.fetchall()]
+        self.job_model.invalidate_cache(cr, SUPERUSER_ID, ['eta'], job_ids,
+                                        context=self.session.context)
+        return len(job_ids)
+
+    def set_failed_unreadable(self, job_uuid, exc_info):
+        """ Set to failed a job which cannot be loaded, its payload
+        being unreadable """
+        cr = self.session.cr
+        cr.execute("UPDATE queue_job SET state = %s, worker_id = NULL "
+                   "WHERE uuid = %s RETURNING id",
+                   (FAILED, job_uuid))
+        job_ids = [row[0] for row in cr.fetchall()]
+        if not job_ids:
+            return
+        cr.execute("UPDATE queue_job_detail SET exc_info = %s "
+                   "WHERE job_id IN %s", (exc_info, tuple(job_ids)))
+        self.job_model.invalidate_cache(cr, SUPERUSER_ID,
+                                        context=self.session.context)
+        self.job_model._notify_failed(cr, self.session.uid, job_ids,
+                                      context=self.session.context)
+
+    def _job_from_row(self, row):
+        """ Build a Job from a row of the ``queue_job`` table """
+        func = _unpickle(str(row['func']))
+
+        (func_name, args, kwargs) = func
 
         job = Job(func=func_name, args=args, kwargs=kwargs,
-                  priority=stored.priority, eta=eta, job_uuid=stored.uuid,
-                  description=stored.name)
-
-        if stored.date_created:
-            job.date_created = datetime.strptime(
-                stored.date_created, DEFAULT_SERVER_DATETIME_FORMAT)
-
-        if stored.date_enqueued:
-            job.date_enqueued = datetime.strptime(
-                stored.date_enqueued, DEFAULT_SERVER_DATETIME_FORMAT)
-
-        if stored.date_started:
-            job.date_started = datetime.strptime(
-                stored.date_started, DEFAULT_SERVER_DATETIME_FORMAT)
-
-        if stored.date_done:
-            job.date_done = datetime.strptime(
-                stored.date_done, DEFAULT_SERVER_DATETIME_FORMAT)
-
-        job.state = stored.state
-        job.result = stored.result if stored.result else None
-        job.exc_info = stored.exc_info if stored.exc_info else None
-        job.user_id = stored.user_id.id if stored.user_id else None
-        job.canceled = not stored.active
-        job.model_name = stored.model_name if stored.model_name else None
-        job.retry = stored.retry
-        job.max_retries = stored.max_retries
-        if stored.worker_id:
-            job.worker_uuid = stored.worker_id.uuid
-        if stored.company_id:
-            job.company_id = stored.company_id.id
+                  priority=row['priority'], eta=_to_datetime(row['eta']),
+                  job_uuid=row['uuid'], description=row['name'],
+                  identity_key=row['identity_key'],
+                  channel=row['channel'],
+                  rate_limit_key=row['rate_limit_key'],
+                  circuit_key=row['circuit_key'],
+                  timeout=row['timeout'])
+
+        if row['date_created']:
+            job.date_created = _to_datetime(row['date_created'])
+        job.date_enqueued = _to_datetime(row['date_enqueued'])
+        job.date_started = _to_datetime(row['date_started'])
+        job.date_done = _to_datetime(row['date_done'])
+
+        job.state = row['state']
+        job.result = row['result'] if row['result'] else None
+        job.exc_info = row['exc_info'] if row['exc_info'] else None
+        job.user_id = row['user_id']
+        job.canceled = not row['active']
+        job.model_name = row['model_name'] if row['model_name'] else None
+        job.retry = row['retry']
+        job.max_retries = row['max_retries']
+        job.worker_uuid = row['worker_uuid']
+        job.company_id = row['company_id']
         return job
 
 
@@ -363,11 +928,39 @@ class Job(object):
 
         True if the job has been canceled.
 
+    .. attribute:: identity_key
+
+        Key identifying the job, a new job is not created when a pending
+        or enqueued job has the same key.
+
+    .. attribute:: channel
+
+        Name of the channel in which the job is executed, such as
+        ``root.images``. Default is the ``default_channel`` of the job's
+        function or ``root``.
+
+    .. attribute:: rate_limit_key
+
+        Key of the token bucket of the job when its function has a rate
+        limit (see :py:mod:`~connector8.queue.ratelimit`).
+
+    .. attribute:: circuit_key
+
+        Key of the circuit of the job when its function has a circuit
+        breaker (see :py:mod:`~connector8.queue.breaker`).
+
+    .. attribute:: timeout
+
+        Time limit of the execution of the job in seconds, given by its
+        function. The worker's default applies when it is empty.
+
     """
 
     def __init__(self, func=None, model_name=None,
                  args=None, kwargs=None, priority=None,
-                 eta=None, job_uuid=None, max_retries=None, description=None):
+                 eta=None, job_uuid=None, max_retries=None, description=None,
+                 identity_key=None, channel=None, rate_limit_key=None,
+                 circuit_key=None, timeout=None):
         """ Create a Job
 
         :param func: function to execute
@@ -389,6 +982,15 @@ class Job(object):
             the job state to 'failed'. A value of 0 means infinite retries.
         :param description: human description of the job. If None, description
             is computed from the function doc or name
+        :param identity_key: key identifying the job, or a function
+            computing it from the job, such as :py:func:`identity_exact`
+        :param channel: name of the channel of the job
+        :param rate_limit_key: key of the rate limit of the job, computed
+            by the rate limit of the function by default
+        :param circuit_key: key of the circuit of the job, computed by the
+            circuit breaker of the function by default
+        :param timeout: time limit of the job in seconds, the ``timeout``
+            of the function by default
         """
         if args is None:
             args = ()
@@ -447,6 +1049,25 @@ class Job(object):
         self.eta = eta
         self.canceled = False
         self.worker_uuid = None
+        if channel is None and inspect.isfunction(func):
+            channel = getattr(func, 'default_channel', None)
+        self.channel = channel or ROOT_CHANNEL
+        if callable(identity_key):
+            identity_key = identity_key(self)
+        self.identity_key = identity_key
+        if rate_limit_key is None and inspect.isfunction(func):
+            rate_limit = getattr(func, 'rate_limit', None)
+            if rate_limit is not None:
+                rate_limit_key = rate_limit.key_for(self)
+        self.rate_limit_key = rate_limit_key
+        if circuit_key is None and inspect.isfunction(func):
+            breaker = getattr(func, 'circuit_breaker', None)
+            if breaker is not None:
+                circuit_key = breaker.key_for(self)
+        self.circuit_key = circuit_key
+        if timeout is None and inspect.isfunction(func):
+            timeout = getattr(func, 'timeout', None)
+        self.timeout = timeout
 
     def __cmp__(self, other):
         if not isinstance(other, Job):
@@ -485,6 +1106,49 @@ class Job(object):
                 raise
         return self.result
 
+    def error_for_retry(self, err):
+        """ Return the exception to record when the job raised ``err``
+        outside of :py:meth:`perform`, as in a batch: a retryable error
+        is a failure once the max. retries is reached.
+        """
+        if (isinstance(err, RetryableJobError) and self.max_retries and
+                self.retry >= self.max_retries):
+            return FailedJobError("Max. retries (%d) reached: %s" %
+                                  (self.max_retries, err))
+        return err
+
+    @property
+    def batch_size(self):
+        """ Maximum number of jobs executed in one batch, 1 when the
+        function is not batchable """
+        if not hasattr(self.func, 'batch'):
+            return 1
+        return self.func.batch_size
+
+    @property
+    def retry_policy(self):
+        """ Retry policy of the function of the job, see
+        :py:mod:`~connector8.queue.retry` """
+        return getattr(self.func, 'retry_policy', DEFAULT_RETRY_POLICY)
+
+    @property
+    def execution(self):
+        """ Execution mode of the job: ``THREAD`` (in an executor thread
+        of the worker) or ``PROCESS`` (in a child process) """
+        return getattr(self.func, 'execution', THREAD)
+
+    @property
+    def rate_limit(self):
+        """ Rate limit of the function of the job, see
+        :py:mod:`~connector8.queue.ratelimit` """
+        return getattr(self.func, 'rate_limit', None)
+
+    @property
+    def circuit_breaker(self):
+        """ Circuit breaker of the function of the job, see
+        :py:mod:`~connector8.queue.breaker` """
+        return getattr(self.func, 'circuit_breaker', None)
+
     @property
     def func_string(self):
         if self.func_name is None:
@@ -508,14 +1172,7 @@ class Job(object):
 
     @property
     def func(self):
-        func_name = self.func_name
-        if func_name is None:
-            return None
-
-        module_name, func_name = func_name.rsplit('.', 1)
-        __import__(module_name)
-        module = sys.modules[module_name]
-        return getattr(module, func_name)
+        return _import_func(self.func_name)
 
     @property
     def eta(self):
@@ -580,9 +1237,10 @@ class Job(object):
     def postpone(self, result=None, seconds=None):
         """ Write an estimated time arrival to n seconds
         later than now. Used when an retryable exception
-        want to retry a job later. """
+        want to retry a job later. The delay is given by the
+        retry policy of the job when ``seconds`` is None. """
         if seconds is None:
-            seconds = RETRY_INTERVAL
+            seconds = self.retry_policy.delay(self.retry)
         self.eta = timedelta(seconds=seconds)
         self.exc_info = None
         if result is not None:
@@ -594,7 +1252,71 @@ class Job(object):
         return self.func.related_action(session, self)
 
 
-def job(func):
+class JobHandle(object):
+    """ Lightweight reference to a job kept in the queue of a worker
+
+    Holds only what the queue needs to sort and dispatch the job, the
+    job itself is loaded from the storage just before its execution.
+
+    The options of the function of the job are resolved once, when the
+    handle is built, so the queue never imports a function. When the
+    function cannot be imported, ``error`` holds the traceback and the
+    worker fails the job instead of enqueuing it.
+    """
+
+    __slots__ = ('uuid', 'func_name', 'priority', 'eta', 'date_created',
+                 'channel', 'user_id', 'rate_limit_key', 'circuit_key',
+                 'timeout', 'batch_size', 'execution', 'rate_limit',
+                 'circuit_breaker', 'error')
+
+    def __init__(self, uuid, func_name, priority=None, eta=None,
+                 date_created=None, channel=None, user_id=None,
+                 rate_limit_key=None, circuit_key=None, timeout=None):
+        self.uuid = uuid
+        self.func_name = func_name
+        self.priority = DEFAULT_PRIORITY if priority is None else priority
+        self.eta = eta
+        self.date_created = date_created or datetime.now()
+        self.channel = channel or ROOT_CHANNEL
+        self.user_id = user_id
+        self.rate_limit_key = rate_limit_key
+        self.circuit_key = circuit_key
+        self.timeout = timeout
+        self._resolve()
+
+    def _resolve(self):
+        """ Read the options of the function of the job """
+        self.error = None
+        try:
+            func = self.func
+        except Exception:
+            self.error = traceback.format_exc()
+            func = None
+        self.batch_size = func.batch_size if hasattr(func, 'batch') else 1
+        self.execution = getattr(func, 'execution', THREAD)
+        self.rate_limit = getattr(func, 'rate_limit', None)
+        self.circuit_breaker = getattr(func, 'circuit_breaker', None)
+
+    @classmethod
+    def from_job(cls, job):
+        return cls(job.uuid, job.func_name, priority=job.priority,
+                   eta=job.eta, date_created=job.date_created,
+                   channel=job.channel, user_id=job.user_id,
+                   rate_limit_key=job.rate_limit_key,
+                   circuit_key=job.circuit_key, timeout=job.timeout)
+
+    @property
+    def func(self):
+        return _import_func(self.func_name)
+
+    def __repr__(self):
+        return '<JobHandle %s, priority:%d>' % (self.uuid, self.priority)
+
+
+def job(func=None, batchable=False, batch=None,
+        batch_size=DEFAULT_BATCH_SIZE, execution=None, default_channel=None,
+        retry_policy=None, rate_limit=None, circuit_breaker=None,
+        timeout=None):
     """ Decorator for jobs.
 
    Add a ``delay`` attribute on the decorated function.
@@ -616,7 +1338,7 @@ def job(func):
      Arguments and keyword arguments which will be given to the called
      function once the job is executed. They should be ``pickle-able``.
 
-     There is 4 special and reserved keyword arguments that you can use:
+     There are special and reserved keyword arguments that you can use:
 
      * priority: priority of the job, the smaller is the higher priority.
                  Default is 10.
@@ -631,6 +1353,25 @@ def job(func):
                      (Default is the func.__doc__ or
                       'Function %s' % func.__name__)
 
+     * identity_key: key identifying the job, or function computing it
+                     from the job (see :py:func:`identity_exact`).
+                     No job is created when a pending or enqueued job
+                     has the same key, the uuid of the existing job is
+                     returned instead.
+
+     * coalesce: window in seconds. The job is executed at the end of the
+                 window and the jobs delayed during the window for the
+                 same function, model and record id (first argument)
+                 are merged into it: their list arguments (such as
+                 ``fields``) are unioned. Each merged job pushes the
+                 end of the window back, up to ``COALESCE_MAX_WINDOWS``
+                 windows after the first job. Cannot be used with
+                 ``identity_key``.
+
+     * channel: name of the channel of the job, overrides the
+                ``default_channel`` given to the decorator.
+                Default is ``root``.
+
     Example:
 
     .. code-block:: python
@@ -651,10 +1392,123 @@ def job(func):
         # => the job will be executed with a low priority and not before a
         # delay of 5 hours from now
 
+    Many jobs can be created at once with ``delay_many``, which takes
+    an iterable of arguments tuples instead of the ``*args``. The
+    keyword arguments are shared by all the jobs. The special keyword
+    argument ``chunk_size`` sets the number of jobs inserted per query.
+
+    .. code-block:: python
+
+        export_one_thing.delay_many(session, 'a.model',
+                                    [(thing,) for thing in things],
+                                    priority=30)
+        # => one job is created per thing, the uuids are returned
+
+    A job function can be ``batchable``: the worker then takes up to
+    ``batch_size`` of its ready jobs (with the same user) and executes
+    them with a single call of ``func.batch(session, jobs_arguments)``,
+    ``jobs_arguments`` being a list of ``(args, kwargs)`` tuples. The
+    batch handler returns the list of the results of the jobs, in the
+    same order, with an exception instance in place of the result of a
+    job which failed. The default batch handler calls the function for
+    each job in a savepoint, a custom one is given with ``batch``.
+
+    .. code-block:: python
+
+        def export_stock_levels(session, jobs_arguments):
+            product_ids = [args[1] for args, kwargs in jobs_arguments]
+            # one call to export all the stock levels
+            return [True] * len(product_ids)
+
+        @job(batch=export_stock_levels, batch_size=100)
+        def export_stock_level(session, model_name, product_id):
+            # export the stock level of one product
+
+    The jobs of CPU-bound functions can be executed in child processes
+    of the worker instead of its threads, with ``execution='process'``,
+    when the ``connector_processes`` option gives the number of
+    processes. The batches are always executed in the threads.
+
+    .. code-block:: python
+
+        @job(execution='process')
+        def import_big_order(session, model_name, order_data):
+            # map and import a huge order
+
+    The jobs are executed in channels, which limit the number of jobs
+    running at once (see :py:mod:`~connector8.queue.channel`). The
+    channel of the jobs of a function is given with ``default_channel``.
+
+    .. code-block:: python
+
+        @job(default_channel='root.images')
+        def export_image(session, model_name, image_id):
+            # export an image
+
+    A job raising a :py:class:`~connector8.exception.RetryableJobError`
+    is retried 10 minutes later by default. The delays between the
+    retries of the jobs of a function are given by a ``retry_policy``
+    (see :py:mod:`~connector8.queue.retry`), a list of delays in seconds
+    is a shortcut for a :py:class:`~connector8.queue.retry.TableRetry`.
+    A ``RetryableJobError(msg, seconds=n)`` retries its job after ``n``
+    seconds whatever the policy.
+
+    .. code-block:: python
+
+        @job(retry_policy=ExponentialRetry(10, max_delay=3600, jitter=True))
+        def export_product(session, model_name, product_id):
+            # export a product
+
+        @job(retry_policy=[60, 5 * 60, 30 * 60])
+        def import_partner(session, model_name, partner_id):
+            # import a partner
+
+    A ``rate_limit`` limits the number of jobs of the function started
+    per second for the same backend record, the jobs over the quota wait
+    in the queue of the worker while it starts the others (see
+    :py:mod:`~connector8.queue.ratelimit`).
+
+    .. code-block:: python
+
+        @job(rate_limit=RateLimit(10, period=1))
+        def export_stock_level(session, model_name, backend_id, product_id):
+            # call the backend
+
+    A ``circuit_breaker`` stops the execution of the jobs of a backend
+    record after consecutive failures, they are postponed until a probe
+    job succeeds (see :py:mod:`~connector8.queue.breaker`).
+
+    .. code-block:: python
+
+        @job(circuit_breaker=CircuitBreaker(failures=5, reset_timeout=60))
+        def export_stock_level(session, model_name, backend_id, product_id):
+            # call the backend
+
+    The execution of a job is limited to ``timeout`` seconds, or to the
+    ``connector_job_timeout`` option of the configuration file when the
+    function has no ``timeout``. A job over its time limit is retried
+    later, or failed when it reaches its max. retries, and the executor
+    running it is replaced.
+
+    .. code-block:: python
+
+        @job(timeout=5 * 60)
+        def import_catalog(session, model_name, backend_id):
+            # call the backend
+
     See also: :py:func:`related_action` a related action can be attached
     to a job
 
     """
+    if func is None:
+        return functools.partial(job, batchable=batchable, batch=batch,
+                                 batch_size=batch_size, execution=execution,
+                                 default_channel=default_channel,
+                                 retry_policy=retry_policy,
+                                 rate_limit=rate_limit,
+                                 circuit_breaker=circuit_breaker,
+                                 timeout=timeout)
+
     def delay(session, model_name, *args, **kwargs):
         """Enqueue the function. Return the uuid of the created job."""
         return OdooJobStorage(session).enqueue_resolve_args(
@@ -662,10 +1516,97 @@ def job(func):
             model_name=model_name,
             *args,
             **kwargs)
+
+    def delay_many(session, model_name, args_list, **kwargs):
+        """Enqueue the function once for each arguments tuple of
+        ``args_list``. Return the uuids of the created jobs."""
+        return OdooJobStorage(session).enqueue_many_resolve_args(
+            func,
+            args_list,
+            model_name=model_name,
+            **kwargs)
     func.delay = delay
+    func.delay_many = delay_many
+    if batchable or batch is not None:
+        func.batch = batch or _batch_one_by_one(func)
+        func.batch_size = batch_size
+    if execution is not None:
+        assert execution in (THREAD, PROCESS), (
+            "Unknown execution mode %s" % execution)
+        func.execution = execution
+    if default_channel is not None:
+        assert is_channel_name(default_channel), (
+            "Invalid channel name %s" % default_channel)
+        func.default_channel = default_channel
+    if isinstance(retry_policy, (list, tuple)):
+        retry_policy = TableRetry(retry_policy)
+    if retry_policy is not None:
+        assert isinstance(retry_policy, RetryPolicy), (
+            "Invalid retry policy %r" % retry_policy)
+        func.retry_policy = retry_policy
+    if rate_limit is not None:
+        assert isinstance(rate_limit, RateLimit), (
+            "Invalid rate limit %r" % rate_limit)
+        func.rate_limit = rate_limit
+    if circuit_breaker is not None:
+        assert isinstance(circuit_breaker, CircuitBreaker), (
+            "Invalid circuit breaker %r" % circuit_breaker)
+        func.circuit_breaker = circuit_breaker
+    if timeout is not None:
+        assert timeout > 0, "Invalid timeout %r" % timeout
+        func.timeout = timeout
     return func
 
 
+def _batch_one_by_one(func):
+    """ Default batch handler: call ``func`` for each job, each call in
+    its own savepoint so a failure does not abort the others """
+    def batch(session, jobs_arguments):
+        results = []
+        for args, kwargs in jobs_arguments:
+            try:
+                with session.cr.savepoint():
+                    results.append(func(session, *args, **kwargs))
+            except Exception as err:
+                results.append(err)
+        return results
+    return batch
+
+
+def perform_batch(session, jobs):
+    """ Execute jobs of the same batchable function with a single call
+    of its batch handler.
+
+    The jobs are executed with the user which has initiated them, they
+    must all have the same user.
+
+    :param session: session to execute the jobs
+    :type session: ConnectorSession
+    :param jobs: jobs to execute
+    :type jobs: list of :py:class:`Job`
+    :return: for each job, its result or the exception it raised
+    """
+    for job in jobs:
+        assert not job.canceled, "Canceled job"
+    func = jobs[0].func
+    with session.change_user(jobs[0].user_id):
+        for job in jobs:
+            job.retry += 1
+        results = func.batch(session,
+                             [(job.args, job.kwargs) for job in jobs])
+    assert len(results) == len(jobs), (
+        "The batch handler of %s returned %d results for %d jobs" %
+        (jobs[0].func_name, len(results), len(jobs)))
+    outcomes = []
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            result = job.error_for_retry(result)
+        else:
+            job.result = result
+        outcomes.append(result)
+    return outcomes
+
+
 def related_action(action=lambda session, job: None, **kwargs):
     """ Attach a *Related Action* to a job.
 
@@ -23,12 +23,17 @@ import os
 import logging
 from datetime import datetime, timedelta
 
-from openerp import models, fields
+from psycopg2.extensions import TransactionRollbackError
+
+from openerp import models, fields, api, SUPERUSER_ID
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.tools.translate import _
 
-from .job import STATES, DONE, PENDING, OdooJobStorage
-from .worker import WORKER_TIMEOUT, watcher
+from .archive import JobArchive
+from .channel import ROOT_CHANNEL
+from .job import (STATES, DONE, ENQUEUED, FAILED, PENDING, STARTED,
+                  NOTIFY_CHANNEL, OdooJobStorage, notify_new_jobs)
+from .worker import WORKER_TIMEOUT, QUEUE_LEAD, watcher
 from ..session import ConnectorSession
 
 _logger = logging.getLogger(__name__)
@@ -44,6 +49,15 @@ class QueueJob(models.Model):
     _order = 'date_created DESC, date_done DESC'
 
     _removal_interval = 30  # days
+    # days before the jobs are deleted, by state, the jobs in the other
+    # states are never deleted
+    _removal_interval_by_state = {DONE: _removal_interval}
+    # days before the jobs are deleted by function name and state,
+    # overrides ``_removal_interval_by_state``, for instance:
+    # {'openerp.addons.a_module.a_file.export_record': {'failed': 90}}
+    _removal_interval_by_func = {}
+    _removal_chunk_size = 1000  # jobs deleted per transaction
+    _archive_interval = 7  # days
 
     worker_id = fields.Many2one(
         comodel_name='queue.worker',
@@ -74,15 +88,21 @@ class QueueJob(models.Model):
         readonly=True
     )
 
+    detail_ids = fields.One2many(
+        comodel_name='queue.job.detail',
+        inverse_name='job_id',
+        string='Details',
+        readonly=True
+    )
+
     func_string = fields.Char(
         string='Task',
+        compute='_compute_detail',
+        search='_search_func_string',
         readonly=True
     )
 
-    func = fields.Binary(
-        string='Pickled Function',
-        readonly=True, required=True
-    )
+    func_name = fields.Char(string='Function', readonly=True, select=True)
 
     state = fields.Selection(
         selection=STATES,
@@ -95,10 +115,15 @@ class QueueJob(models.Model):
 
     exc_info = fields.Text(
         string='Exception Info',
+        compute='_compute_detail',
         readonly=True
     )
 
-    result = fields.Text(string='Result', readonly=True)
+    result = fields.Text(
+        string='Result',
+        compute='_compute_detail',
+        readonly=True
+    )
 
     date_created = fields.Datetime(string='Created Date', readonly=True)
 
@@ -123,10 +148,109 @@ class QueueJob(models.Model):
              "Retries are infinite when empty."
     )
 
+    identity_key = fields.Char(string='Identity Key', readonly=True)
+
+    channel = fields.Char(string='Channel', readonly=True, select=True)
+
+    rate_limit_key = fields.Char(string='Rate Limit Key', readonly=True)
+
+    circuit_key = fields.Char(string='Circuit Key', readonly=True,
+                              select=True)
+
+    timeout = fields.Integer(
+        string='Time Limit (s)',
+        readonly=True,
+        help="Maximum duration of the execution of the job in seconds.\n"
+             "The default of the worker (option connector_job_timeout) "
+             "applies when empty."
+    )
+
     _defaults = {
         'active': True,
+        'channel': ROOT_CHANNEL,
     }
 
+    @api.multi
+    def _compute_detail(self):
+        for job in self:
+            detail = job.detail_ids[:1]
+            job.func_string = detail.func_string
+            job.exc_info = detail.exc_info
+            job.result = detail.result
+
+    def _search_func_string(self, operator, value):
+        return [('detail_ids.func_string', operator, value)]
+
+    def _auto_init(self, cr, context=None):
+        res = super(QueueJob, self)._auto_init(cr, context=context)
+        # only the pending and enqueued jobs are looked up by identity
+        # key, keep the index small with a partial index
+        cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                   ('queue_job_identity_key_index',))
+        if not cr.fetchone():
+            cr.execute("CREATE INDEX queue_job_identity_key_index "
+                       "ON queue_job (identity_key) "
+                       "WHERE state IN ('pending', 'enqueued') "
+                       "AND identity_key IS NOT NULL")
+        self._init_notify_triggers(cr)
+        return res
+
+    def _init_notify_triggers(self, cr):
+        """ The workers listen to the notification sent when jobs are
+        to assign, to assign them as soon as they are committed
+
+        The triggers run once per statement and notify once when a row
+        becomes pending without worker. They read the rows in transition
+        tables, which need PostgreSQL 10. With older versions, the
+        storage notifies the workers after its writes, see
+        :py:func:`~connector8.queue.job.notify_new_jobs`.
+        """
+        # row trigger of the previous versions
+        cr.execute("DROP TRIGGER IF EXISTS queue_job_notify ON queue_job")
+        if cr._cnx.server_version < 100000:
+            cr.execute("DROP TRIGGER IF EXISTS queue_job_notify_insert "
+                       "ON queue_job")
+            cr.execute("DROP TRIGGER IF EXISTS queue_job_notify_update "
+                       "ON queue_job")
+            return
+        cr.execute("CREATE OR REPLACE FUNCTION queue_job_notify() "
+                   "RETURNS trigger AS $$ "
+                   "BEGIN "
+                   "  IF TG_OP = 'INSERT' THEN "
+                   "    PERFORM 1 FROM new_jobs "
+                   "    WHERE state = 'pending' AND worker_id IS NULL "
+                   "    LIMIT 1; "
+                   "  ELSE "
+                   "    PERFORM 1 FROM new_jobs n "
+                   "    JOIN old_jobs o ON o.id = n.id "
+                   "    WHERE n.state = 'pending' AND n.worker_id IS NULL "
+                   "    AND (o.state != 'pending' "
+                   "         OR o.worker_id IS NOT NULL) "
+                   "    LIMIT 1; "
+                   "  END IF; "
+                   "  IF FOUND THEN "
+                   "    PERFORM pg_notify('%s', ''); "
+                   "  END IF; "
+                   "  RETURN NULL; "
+                   "END; "
+                   "$$ LANGUAGE plpgsql" % NOTIFY_CHANNEL)
+        cr.execute("SELECT tgname FROM pg_trigger WHERE tgname IN %s",
+                   (('queue_job_notify_insert', 'queue_job_notify_update'),))
+        triggers = set(row[0] for row in cr.fetchall())
+        if 'queue_job_notify_insert' not in triggers:
+            cr.execute("CREATE TRIGGER queue_job_notify_insert "
+                       "AFTER INSERT ON queue_job "
+                       "REFERENCING NEW TABLE AS new_jobs "
+                       "FOR EACH STATEMENT "
+                       "EXECUTE PROCEDURE queue_job_notify()")
+        if 'queue_job_notify_update' not in triggers:
+            cr.execute("CREATE TRIGGER queue_job_notify_update "
+                       "AFTER UPDATE ON queue_job "
+                       "REFERENCING OLD TABLE AS old_jobs "
+                       "NEW TABLE AS new_jobs "
+                       "FOR EACH STATEMENT "
+                       "EXECUTE PROCEDURE queue_job_notify()")
+
     def open_related_action(self, cr, uid, ids, context=None):
         """ Open the related action associated to the job """
         if hasattr(ids, '__iter__'):
@@ -153,8 +277,9 @@ class QueueJob(models.Model):
 
         session = ConnectorSession(cr, uid, context=context)
         storage = OdooJobStorage(session)
-        for job in self.browse(cr, uid, ids, context=context):
-            job = storage.load(job.uuid)
+        job_uuids = [job['uuid'] for job
+                     in self.read(cr, uid, ids, ['uuid'], context=context)]
+        for job in storage.load_many(job_uuids):
             if state == DONE:
                 job.set_done(result=result)
             elif state == PENDING:
@@ -179,18 +304,26 @@ class QueueJob(models.Model):
         if vals.get('state') == 'failed':
             if not hasattr(ids, '__iter__'):
                 ids = [ids]
-            # subscribe the users now to avoid to subscribe them
-            # at every job creation
-            self._subscribe_users(cr, uid, ids, context=context)
-            for job_id in ids:
-                msg = self._message_failed_job(cr, uid, job_id,
-                                               context=context)
-                if msg:
-                    self.message_post(cr, uid, job_id, body=msg,
-                                      subtype='connector.mt_job_failed',
-                                      context=context)
+            self._notify_failed(cr, uid, ids, context=context)
         return res
 
+    def _notify_failed(self, cr, uid, ids, context=None):
+        """ Subscribe the managers and post a message on failed jobs.
+
+        Called when jobs are set to failed, through the ORM or by the
+        :py:class:`~connector8.queue.job.OdooJobStorage`.
+        """
+        # subscribe the users now to avoid to subscribe them
+        # at every job creation
+        self._subscribe_users(cr, uid, ids, context=context)
+        for job_id in ids:
+            msg = self._message_failed_job(cr, uid, job_id,
+                                           context=context)
+            if msg:
+                self.message_post(cr, uid, job_id, body=msg,
+                                  subtype='connector.mt_job_failed',
+                                  context=context)
+
     def _subscribe_users(self, cr, uid, ids, context=None):
         """ Subscribe all users having the 'Connector Manager' group """
         group_ref = self.pool.get('ir.model.data').get_object_reference(
@@ -228,22 +361,175 @@ class QueueJob(models.Model):
         return [('state', '=', 'failed')]
 
     def autovacuum(self, cr, uid, context=None):
-        """ Delete all jobs (active or not) done since more than
-        ``_removal_interval`` days.
+        """ Delete all jobs (active or not) according to the retention
+        policies: ``_removal_interval_by_state`` and
+        ``_removal_interval_by_func``. The age of a done job is counted
+        from its date done, the others from their creation date.
+
+        The jobs are deleted with SQL in chunks of
+        ``_removal_chunk_size`` jobs along with their messages and
+        followers.
 
         Called from a cron.
+
+        .. warning:: commit transaction
+           ``cr.commit()`` is called after each chunk.
         """
-        if context is None:
-            context = {}
-        context = dict(context, active_test=False)
-        deadline = datetime.now() - timedelta(days=self._removal_interval)
+        for state, func_name, days, excluded in self._removal_policies():
+            deadline = datetime.now() - timedelta(days=days)
+            deadline_fmt = deadline.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+            while True:
+                job_ids = self._removable_job_ids(
+                    cr, state, deadline_fmt, func_name=func_name,
+                    excluded_func_names=excluded,
+                    limit=self._removal_chunk_size)
+                if not job_ids:
+                    break
+                self._delete_jobs(cr, job_ids)
+                cr.commit()
+                _logger.debug('%d %s jobs deleted', len(job_ids), state)
+                if len(job_ids) < self._removal_chunk_size:
+                    break
+        return True
+
+    def archive_done_jobs(self, cr, uid, days=None, context=None):
+        """ Move the done jobs older than ``days`` (default is
+        ``_archive_interval``) from ``queue_job`` to the archive files
+        of the filestore, see :py:class:`~.archive.JobArchive`.
+
+        The jobs are processed in chunks of ``_removal_chunk_size``:
+        written in the archive, deleted then committed. A chunk is
+        archived again if its transaction fails after the write.
+
+        Called from a cron.
+
+        .. warning:: commit transaction
+           ``cr.commit()`` is called after each chunk.
+        """
+        if days is None:
+            days = self._archive_interval
+        deadline = datetime.now() - timedelta(days=days)
         deadline_fmt = deadline.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
-        job_ids = self.search(cr, uid,
-                              [('date_done', '<=', deadline_fmt)],
-                              context=context)
-        self.unlink(cr, uid, job_ids, context=context)
+        archive = JobArchive.for_db(cr.dbname)
+        while True:
+            job_ids = self._removable_job_ids(
+                cr, DONE, deadline_fmt, limit=self._removal_chunk_size)
+            if not job_ids:
+                break
+            archive.write(self._archive_values(cr, job_ids))
+            self._delete_jobs(cr, job_ids)
+            cr.commit()
+            _logger.debug('%d jobs archived', len(job_ids))
+            if len(job_ids) < self._removal_chunk_size:
+                break
         return True
 
+    def _archive_values(self, cr, job_ids):
+        """ Values of the jobs written in the archive """
+        cr.execute("SELECT j.uuid, j.name, j.state, j.func_name, "
+                   "       d.func_string, j.model_name, j.user_id, "
+                   "       j.company_id, j.priority, j.retry, "
+                   "       j.max_retries, j.date_created, j.date_enqueued, "
+                   "       j.date_started, j.date_done, j.eta, j.active, "
+                   "       d.result, d.exc_info "
+                   "FROM queue_job j "
+                   "JOIN queue_job_detail d ON d.job_id = j.id "
+                   "WHERE j.id IN %s "
+                   "ORDER BY j.date_done", (tuple(job_ids),))
+        return cr.dictfetchall()
+
+    def _removal_policies(self):
+        """ Return the retention policies as a list of tuples
+        ``(state, func_name, days, excluded_func_names)``
+
+        ``func_name`` is None for the policy of a state, which excludes
+        the functions having their own policy for the state.
+        """
+        policies = []
+        func_policies = {}
+        for func_name, intervals in self._removal_interval_by_func.items():
+            for state, days in intervals.items():
+                func_policies.setdefault(state, []).append(func_name)
+                policies.append((state, func_name, days, ()))
+        for state, days in self._removal_interval_by_state.items():
+            policies.append((state, None, days,
+                             tuple(func_policies.get(state, ()))))
+        return policies
+
+    def _removable_job_ids(self, cr, state, deadline, func_name=None,
+                           excluded_func_names=(), limit=None):
+        """ Ids of the jobs in ``state`` older than ``deadline`` """
+        sql = ("SELECT j.id FROM queue_job j "
+               "WHERE j.state = %s "
+               "AND COALESCE(j.date_done, j.date_created) <= %s ")
+        params = [state, deadline]
+        if func_name:
+            sql += "AND j.func_name = %s "
+            params.append(func_name)
+        if excluded_func_names:
+            sql += ("AND (j.func_name IS NULL "
+                    "     OR j.func_name NOT IN %s) ")
+            params.append(tuple(excluded_func_names))
+        if limit:
+            sql += "LIMIT %s"
+            params.append(limit)
+        cr.execute(sql, params)
+        return [row[0] for row in cr.fetchall()]
+
+    def _delete_jobs(self, cr, job_ids):
+        """ Delete jobs with SQL, along with their messages and
+        followers. The details are deleted by the foreign key. """
+        job_ids = tuple(job_ids)
+        cr.execute("DELETE FROM mail_message "
+                   "WHERE model = %s AND res_id IN %s",
+                   (self._name, job_ids))
+        cr.execute("DELETE FROM mail_followers "
+                   "WHERE res_model = %s AND res_id IN %s",
+                   (self._name, job_ids))
+        cr.execute("DELETE FROM queue_job WHERE id IN %s", (job_ids,))
+        self.invalidate_cache(cr, SUPERUSER_ID, ids=list(job_ids))
+
+
+class QueueJobDetail(models.Model):
+    """ Large values of a job, only read to execute or display it
+
+    They are kept out of ``queue_job`` so the rows scanned and updated
+    by the workers stay narrow.
+    """
+    _name = 'queue.job.detail'
+    _description = 'Queue Job Detail'
+    _log_access = False
+    _rec_name = 'job_id'
+
+    job_id = fields.Many2one(
+        comodel_name='queue.job',
+        string='Job',
+        ondelete='cascade',
+        readonly=True,
+        required=True
+    )
+
+    func_string = fields.Char(
+        string='Task',
+        readonly=True
+    )
+
+    func = fields.Binary(
+        string='Pickled Function',
+        readonly=True, required=True
+    )
+
+    exc_info = fields.Text(
+        string='Exception Info',
+        readonly=True
+    )
+
+    result = fields.Text(string='Result', readonly=True)
+
+    _sql_constraints = [
+        ('job_uniq', 'unique(job_id)', 'A job can have only one detail.'),
+    ]
+
 
 class QueueWorker(models.Model):
     """ Worker """
@@ -295,19 +581,80 @@ class QueueWorker(models.Model):
                        {'date_alive': now_fmt}, context=context)
 
     def _purge_dead_workers(self, cr, uid, context=None):
+        """ Delete the workers which are no longer alive and recover
+        their jobs, in one statement
+
+        The pending and enqueued jobs of the dead workers are set to
+        pending without worker, so they are notified and claimed at once
+        by the living workers. A started job was running when its worker
+        died: the attempt counts as a retry, and the job fails when it
+        reaches its max. retries, so a job killing its worker is not
+        retried forever.
+        """
         deadline = datetime.now() - timedelta(seconds=self.worker_timeout)
         deadline_fmt = deadline.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
-        dead_ids = self.search(cr, uid,
-                               [('date_alive', '<', deadline_fmt)],
-                               context=context)
-        dead_workers = self.read(cr, uid, dead_ids, ['uuid'], context=context)
-        for worker in dead_workers:
-            _logger.debug('Worker %s is dead', worker['uuid'])
+        cr.execute("SAVEPOINT queue_purge_dead_workers")
         try:
-            self.unlink(cr, uid, dead_ids, context=context)
+            cr.execute(
+                "WITH dead AS ("
+                "  DELETE FROM queue_worker WHERE date_alive < %(deadline)s "
+                "  RETURNING id, uuid"
+                "), recovered AS ("
+                "  UPDATE queue_job j "
+                "  SET worker_id = NULL, "
+                "      retry = CASE WHEN j.state = %(started)s "
+                "                   THEN j.retry + 1 ELSE j.retry END, "
+                "      state = CASE WHEN j.state = %(started)s "
+                "                    AND j.max_retries > 0 "
+                "                    AND j.retry + 1 >= j.max_retries "
+                "                   THEN %(failed)s ELSE %(pending)s END, "
+                "      date_enqueued = NULL, "
+                "      date_started = NULL "
+                "  FROM dead "
+                "  WHERE j.worker_id = dead.id "
+                "  AND j.state IN %(states)s "
+                "  RETURNING j.id, j.state, dead.uuid AS worker_uuid"
+                "), failed AS ("
+                "  UPDATE queue_job_detail d "
+                "  SET exc_info = 'Worker ' || recovered.worker_uuid || "
+                "                 ' died during the execution of the job' "
+                "  FROM recovered "
+                "  WHERE d.job_id = recovered.id "
+                "  AND recovered.state = %(failed)s "
+                "  RETURNING d.job_id"
+                ") "
+                "SELECT (SELECT array_agg(uuid) FROM dead), "
+                "       (SELECT array_agg(id) FROM recovered), "
+                "       (SELECT array_agg(id) FROM recovered "
+                "        WHERE state = %(failed)s)",
+                {'deadline': deadline_fmt,
+                 'started': STARTED,
+                 'failed': FAILED,
+                 'pending': PENDING,
+                 'states': (PENDING, ENQUEUED, STARTED)},
+                log_exceptions=False)
         except Exception:
-            _logger.debug("Failed attempt to unlink a dead worker, likely due "
-                          "to another transaction in progress.")
+            cr.execute("ROLLBACK TO SAVEPOINT queue_purge_dead_workers")
+            _logger.debug("Failed attempt to purge the dead workers, likely "
+                          "due to another transaction in progress.")
+            return
+        dead_uuids, recovered_ids, failed_ids = cr.fetchone()
+        cr.execute("RELEASE SAVEPOINT queue_purge_dead_workers")
+        if not dead_uuids:
+            return
+        for worker_uuid in dead_uuids:
+            _logger.debug('Worker %s is dead', worker_uuid)
+        if recovered_ids:
+            _logger.info('%d jobs of dead workers recovered, %d failed',
+                         len(recovered_ids), len(failed_ids or []))
+        # the records have been modified behind the ORM
+        self.invalidate_cache(cr, uid, context=context)
+        job_model = self.pool['queue.job']
+        job_model.invalidate_cache(cr, uid, context=context)
+        if failed_ids:
+            job_model._notify_failed(cr, uid, failed_ids, context=context)
+        if len(failed_ids or []) < len(recovered_ids or []):
+            notify_new_jobs(cr)
 
     def _worker_id(self, cr, uid, context=None):
         worker = watcher.worker_for_db(cr.dbname)
@@ -329,7 +676,8 @@ class QueueWorker(models.Model):
            this method in your own transaction, not in the main
            Odoo's transaction
 
-        :param max_jobs: maximal limit of jobs to assign on a worker
+        :param max_jobs: maximal limit of jobs to assign on a worker, see
+                         :py:meth:`assign_jobs`
         :type max_jobs: int
         """
         self.assign_jobs(cr, uid, max_jobs=max_jobs, context=context)
@@ -341,14 +689,27 @@ class QueueWorker(models.Model):
     def assign_jobs(self, cr, uid, max_jobs=None, context=None):
         """ Assign ``n`` jobs to the worker of the current process
 
-        ``n`` is ``max_jobs`` or unlimited if ``max_jobs`` is None
+        ``n`` is computed by the worker from its observed throughput,
+        its free executors and the jobs waiting in its queue (see
+        :py:meth:`~connector8.queue.worker.Worker.claim_size`), limited
+        to ``max_jobs`` when given. No job is assigned when the queue of
+        the worker is far enough ahead of the execution.
+
+        The worker is given the next ``eta`` of the jobs left unassigned,
+        so it assigns them when their ``eta`` is close, without waiting
+        for a notification or for the cron.
 
         :param max_jobs: maximal limit of jobs to assign on a worker
         :type max_jobs: int
         """
         worker = watcher.worker_for_db(cr.dbname)
         if worker:
-            self._assign_jobs(cr, uid, max_jobs=max_jobs, context=context)
+            size = worker.claim_size()
+            if max_jobs is not None:
+                size = min(size, max_jobs)
+            if size > 0:
+                self._assign_jobs(cr, uid, max_jobs=size, context=context)
+            worker.next_eta = self._next_eta(cr)
         else:
             _logger.debug('No worker started for process %s', os.getpid())
         return True
@@ -365,11 +726,99 @@ class QueueWorker(models.Model):
         return True
 
     def _assign_jobs(self, cr, uid, max_jobs=None, context=None):
+        """ Assign jobs to the worker of the current process
+
+        With PostgreSQL 9.5 or later, the jobs are claimed with
+        :py:meth:`_claim_jobs`, concurrent workers claim distinct jobs
+        without waiting for each other. Otherwise, the jobs are locked
+        with ``NOWAIT`` and none are assigned when one is already locked.
+
+        :return: ids of the assigned jobs
+        """
+        worker = watcher.worker_for_db(cr.dbname)
+        if cr._cnx.server_version < 90500:
+            return self._assign_jobs_nowait(cr, uid, max_jobs=max_jobs,
+                                            context=context)
+        worker_id = self._worker_id(cr, uid, context=context)
+        job_ids = self._claim_jobs(cr, worker_id, limit=max_jobs)
+        _logger.debug('Assign %d jobs to worker %s', len(job_ids),
+                      worker.uuid)
+        self.pool['queue.job'].invalidate_cache(
+            cr, uid, ['state', 'worker_id'], job_ids, context=context)
+        return job_ids
+
+    def _claim_jobs(self, cr, worker_id, limit=None):
+        """ Assign up to ``limit`` jobs to a worker in one statement
+
+        The ready jobs are claimed first, by priority. A job whose
+        ``eta`` is in the future is claimed ``QUEUE_LEAD`` seconds before
+        its ``eta``, it waits in the timers of the queue of the worker
+        until its ``eta``, so it starts on time but never fills the queue
+        while ready jobs wait in the database.
+
+        The candidates locked by another transaction are skipped, so
+        concurrent claims never wait and never return the same jobs. A
+        claim which conflicts with a claim committed during its
+        transaction assigns nothing, the jobs are assigned next time.
+
+        :param worker_id: id of the ``queue.worker``
+        :param limit: maximum number of jobs, unlimited when None
+        :return: ids of the claimed jobs
+        """
+        cr.execute("SAVEPOINT queue_claim_jobs")
+        try:
+            cr.execute("UPDATE queue_job "
+                       "SET state = 'pending', worker_id = %s "
+                       "WHERE id IN ("
+                       "  SELECT id FROM queue_job "
+                       "  WHERE worker_id IS NULL "
+                       "  AND state NOT IN ('failed', 'done') "
+                       "  AND active = true "
+                       "  AND (eta IS NULL "
+                       "       OR eta <= (now() AT TIME ZONE 'UTC') "
+                       "                 + %s * interval '1 second') "
+                       "  ORDER BY COALESCE("
+                       "    eta > (now() AT TIME ZONE 'UTC'), false), "
+                       "    priority, date_created "
+                       "  LIMIT %s "
+                       "  FOR UPDATE SKIP LOCKED"
+                       ") RETURNING id", (worker_id, QUEUE_LEAD, limit),
+                       log_exceptions=False)
+        except TransactionRollbackError:
+            cr.execute("ROLLBACK TO SAVEPOINT queue_claim_jobs")
+            _logger.debug("Failed attempt to claim jobs, they have been "
+                          "claimed by a concurrent transaction")
+            return []
+        job_ids = [row[0] for row in cr.fetchall()]
+        cr.execute("RELEASE SAVEPOINT queue_claim_jobs")
+        return job_ids
+
+    def _next_eta(self, cr):
+        """ Return the first ``eta`` (UTC) of the jobs not assigned to a
+        worker, None when they are all ready """
+        cr.execute("SELECT min(eta) FROM queue_job "
+                   "WHERE worker_id IS NULL "
+                   "AND state NOT IN ('failed', 'done') "
+                   "AND active = true "
+                   "AND eta > (now() AT TIME ZONE 'UTC')")
+        next_eta = cr.fetchone()[0]
+        if next_eta and not isinstance(next_eta, datetime):
+            # Odoo reads the timestamps as strings
+            next_eta = datetime.strptime(next_eta[:19],
+                                         DEFAULT_SERVER_DATETIME_FORMAT)
+        return next_eta
+
+    def _assign_jobs_nowait(self, cr, uid, max_jobs=None, context=None):
+        """ Assign jobs locked with ``FOR UPDATE NOWAIT``, for the
+        versions of PostgreSQL without ``SKIP LOCKED`` """
         sql = ("SELECT id FROM queue_job "
                "WHERE worker_id IS NULL "
                "AND state not in ('failed', 'done') "
                "AND active = true "
-               "ORDER BY eta NULLS LAST, priority, date_created ")
+               "AND (eta IS NULL OR eta <= (now() AT TIME ZONE 'UTC') "
+               "                          + interval '%d seconds') "
+               "ORDER BY COALESCE(eta > (now() AT TIME ZONE 'UTC'), false), "
+               "         priority, date_created " % QUEUE_LEAD)
         if max_jobs is not None:
             sql += ' LIMIT %d' % max_jobs
         sql += ' FOR UPDATE NOWAIT'
@@ -389,11 +838,11 @@ class QueueWorker(models.Model):
                           "another transaction in progress. "
                           "Trace of the failed assignment of jobs on worker "
                           "%s attempt: ", worker.uuid, exc_info=True)
-            return
+            return []
         job_rows = cr.fetchall()
         if not job_rows:
             _logger.debug('No job to assign to worker %s', worker.uuid)
-            return
+            return []
         job_ids = [id for id, in job_rows]
 
         worker_id = self._worker_id(cr, uid, context=context)
@@ -406,21 +855,19 @@ class QueueWorker(models.Model):
                                               'worker_id': worker_id},
                                              context=context)
         except Exception:
-            pass  # will be assigned to another worker
+            return []  # will be assigned to another worker
+        return job_ids
 
     def _enqueue_jobs(self, cr, uid, context=None):
         """ Add to the queue of the worker all the jobs not
         yet queued but already assigned."""
-        job_obj = self.pool.get('queue.job')
         db_worker_id = self._worker_id(cr, uid, context=context)
-        job_ids = job_obj.search(cr, uid,
-                                 [('worker_id', '=', db_worker_id),
-                                  ('state', '=', 'pending')],
-                                 context=context)
+        cr.execute("SELECT uuid FROM queue_job "
+                   "WHERE worker_id = %s AND state = 'pending' "
+                   "ORDER BY priority, date_created",
+                   (db_worker_id,))
         worker = watcher.worker_for_db(cr.dbname)
-        jobs = job_obj.read(cr, uid, job_ids, ['uuid'], context=context)
-        for job in jobs:
-            worker.enqueue_job_uuid(job['uuid'])
+        worker.enqueue_job_uuids([job_uuid for job_uuid, in cr.fetchall()])
 
 
 class requeue_job(models.TransientModel):
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Execution of the CPU-bound jobs in child processes.
+
+A job is executed in a child process when its function is decorated
+with ``@job(execution='process')`` or when its channel is configured
+with the ``process`` execution. The worker keeps the states of the
+jobs: it starts them, then the child loads the job, performs it and
+sets it to done in the same transaction, as the executor threads do.
+The worker records the error sent back by a child.
+
+The children are not forked from the worker: a fork of a process running
+threads inherits the sockets of their connections and the locks they
+hold. Each child is a new Python interpreter, which reads the
+configuration of the server, loads the registry of the database with
+its own connections and keeps it. The children are started on the first
+jobs to execute and live as long as the worker, unless their job exceeds
+its time limit: the child is then killed.
+
+The worker has an executor thread per child process, waiting for the
+results of the child, so the jobs executed in processes never take the
+executor threads of the other jobs. The number of children is given by
+the ``connector_processes`` option, none by default: the jobs are then
+executed in the threads of the worker.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import threading
+import traceback
+from cPickle import dump, dumps, load, PicklingError, UnpicklingError
+
+import openerp
+from openerp.modules.registry import RegistryManager
+from openerp.tools import config
+
+from ..exception import FailedJobError
+from ..session import ConnectorSessionHandler
+from .job import OdooJobStorage
+
+_logger = logging.getLogger(__name__)
+
+# run by a new interpreter: receive the setup of the server from the
+# worker, then serve the jobs with :py:func:`_serve`
+_BOOTSTRAP = """
+import sys
+from cPickle import load
+setup = load(sys.stdin)
+sys.path[:] = setup['path']
+import openerp
+openerp.multi_process = True  # no worker in the child
+openerp.tools.config.options.update(setup['options'])
+openerp.netsvc.init_logger()
+openerp.modules.module.initialize_sys_path()
+__import__(setup['module'])
+sys.modules[setup['module']]._serve(setup['db_name'])
+"""
+
+
+def _perform_job(db_name, job_uuid):
+    """ Load, perform and set to done a job in a child process, return
+    its result
+
+    The exceptions are sent back to the worker with the traceback of
+    the child in their ``child_traceback`` attribute.
+    """
+    session_hdl = ConnectorSessionHandler(db_name, openerp.SUPERUSER_ID)
+    try:
+        with session_hdl.session() as session:
+            storage = OdooJobStorage(session)
+            job = storage.load(job_uuid)
+            result = job.perform(session)
+            job.set_done()
+            storage.store(job)
+            return result
+    except Exception as err:
+        child_traceback = traceback.format_exc()
+        try:
+            dumps(err)
+        except (PicklingError, TypeError):
+            err = FailedJobError(unicode(err))
+        err.child_traceback = child_traceback
+        raise err
+
+
+def _serve(db_name):
+    """ Main loop of a child process: perform the jobs whose uuid is
+    read on stdin, write ``(True, result)`` or ``(False, exception)`` on
+    stdout for each of them, stop when the worker closes stdin """
+    # the jobs may print: keep stdout for the results
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    threading.current_thread().dbname = db_name
+    RegistryManager.get(db_name)
+    with openerp.api.Environment.manage():
+        while True:
+            try:
+                job_uuid = load(sys.stdin)
+            except EOFError:
+                break
+            try:
+                reply = (True, _perform_job(db_name, job_uuid))
+            except Exception as err:
+                reply = (False, err)
+            try:
+                data = dumps(reply, 2)
+            except (PicklingError, TypeError):
+                # the result is stored, only its representation is sent
+                data = dumps((True, repr(reply[1])), 2)
+            results.write(data)
+            results.flush()
+
+
+class _Child(object):
+    """ Child process of a :py:class:`ProcessPool`, see :py:func:`_serve`
+    """
+
+    command = [sys.executable, '-c', _BOOTSTRAP]
+
+    def __init__(self, db_name):
+        self.process = subprocess.Popen(self.command,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True)
+        setup = {'path': sys.path,
+                 'options': dict(config.options),
+                 'module': __name__,
+                 'db_name': db_name,
+                 }
+        try:
+            self._send(setup)
+        except IOError:
+            # the child died, noticed on its first job
+            pass
+
+    def _send(self, value):
+        dump(value, self.process.stdin, 2)
+        self.process.stdin.flush()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def perform(self, job_uuid):
+        """ Perform a job in the child, block until it is done """
+        try:
+            self._send(job_uuid)
+            succeeded, value = load(self.process.stdout)
+        except (EOFError, IOError, UnpicklingError):
+            self.kill()
+            raise FailedJobError('The process of the job died with exit '
+                                 'code %s' % self.process.returncode)
+        if not succeeded:
+            raise value
+        return value
+
+    def kill(self):
+        if self.is_alive():
+            try:
+                self.process.kill()
+            except OSError:
+                # died in between
+                pass
+        self.process.wait()
+
+
+class ProcessPool(object):
+    """ Pool of child processes executing jobs for a worker
+
+    :param db_name: database of the worker
+    :param processes: maximum number of child processes
+    """
+
+    child_class = _Child
+
+    def __init__(self, db_name, processes):
+        self.db_name = db_name
+        self.processes = processes
+        self._idle = []
+        self._running = {}  # child of each running job uuid
+        self._slots = threading.BoundedSemaphore(processes)
+        self._lock = threading.Lock()
+
+    def _acquire(self, job_uuid):
+        with self._lock:
+            child = None
+            while self._idle and child is None:
+                child = self._idle.pop()
+                if not child.is_alive():
+                    child.kill()
+                    child = None
+            if child is None:
+                _logger.info('Starting a job process for %s', self.db_name)
+                child = self.child_class(self.db_name)
+            self._running[job_uuid] = child
+            return child
+
+    def _release(self, job_uuid, child):
+        with self._lock:
+            self._running.pop(job_uuid, None)
+            if child.is_alive():
+                self._idle.append(child)
+                return
+        child.kill()
+
+    def perform(self, job):
+        """ Execute a job in a child process, same as
+        :py:meth:`~connector8.queue.job.Job.perform`, the child also sets
+        the job to done in its transaction
+
+        The calling thread is blocked until the job is done.
+        """
+        assert not job.canceled, "Canceled job"
+        job.retry += 1
+        with self._slots:
+            child = self._acquire(job.uuid)
+            try:
+                job.result = child.perform(job.uuid)
+            finally:
+                self._release(job.uuid, child)
+        return job.result
+
+    def terminate(self, job_uuid):
+        """ Kill the child process executing a job, return False when
+        no child executes it
+
+        The thread waiting for the job gets a
+        :py:class:`~connector8.exception.FailedJobError`.
+        """
+        with self._lock:
+            child = self._running.pop(job_uuid, None)
+        if child is None:
+            return False
+        child.kill()
+        return True
+
+    def close(self):
+        """ Stop the child processes """
+        with self._lock:
+            children = self._idle + self._running.values()
+            self._idle = []
+            self._running = {}
+        for child in children:
+            child.kill()
@@ -19,23 +19,324 @@
 #
 ##############################################################################
 from __future__ import absolute_import
-from Queue import PriorityQueue
+import heapq
+import itertools
+from collections import Counter
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .breaker import CircuitBreakers
+from .channel import ChannelTree, ROOT_CHANNEL, THREAD, PROCESS
+from .ratelimit import RateLimiter
+
+
+def _total_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
 
 
 class JobsQueue(object):
     """ Holds the jobs planned for execution in memory.
 
-    The Jobs are sorted, the higher the priority is,
-    the earlier the jobs are dequeued.
+    The jobs are dispatched in the channels of their ``channel``. In a
+    channel, the ready jobs are sorted, the higher the priority is, the
+    earlier the jobs are dequeued.
+
+    The jobs with an ``eta`` in the future are kept in a separate heap
+    sorted by ``eta`` and become ready in their channel when their
+    ``eta`` is reached, so they never delay the ready jobs. A dequeue
+    waits exactly until the next ``eta`` or the next enqueue.
+
+    A job is dequeued only from a channel having capacity, and the
+    channels are served by ascending load, so a channel full of jobs
+    does not starve the others. A dequeued job holds its place in its
+    channel until :py:meth:`done` is called.
+
+    A job whose rate limit has no token left or whose circuit breaker
+    is open stays in its channel, the next runnable job is dequeued
+    instead. When no job can start, a dequeue waits until a token is
+    available or a circuit is half-open.
+
+    A job is executed in a child process when its function or its
+    channel has the ``process`` execution mode, see
+    :py:meth:`execution`. A dequeue can be restricted to one execution
+    mode, so the executors of the processes only take such jobs.
+
+    The worker keeps only :py:class:`~connector8.queue.job.JobHandle` in
+    its queue. The queue is bounded by ``maxsize``: it never refuses a
+    job, but a full queue tells the worker to stop assigning new jobs
+    to itself, they stay in the database for the other workers.
+
+    :param channels: tree of the channels, by default only an unlimited
+                     ``root`` channel
+    :type channels: :py:class:`~connector8.queue.channel.ChannelTree`
+    :param maxsize: number of waiting jobs (ready or delayed) above which
+                    the queue is full, None for an unbounded queue
     """
 
-    def __init__(self):
-        self._queue = PriorityQueue()
+    def __init__(self, channels=None, maxsize=None):
+        if channels is None:
+            channels = ChannelTree()
+        self.channels = channels
+        self.maxsize = maxsize
+        self.limiter = RateLimiter()
+        self.breakers = CircuitBreakers()
+        self._cond = threading.Condition()
+        self._timers = []  # heap of (eta, sequence, job)
+        self._running = Counter()  # running jobs by execution mode
+        # keep the order of enqueue between equal jobs
+        self._sequence = itertools.count()
 
     def enqueue(self, job):
-        self._queue.put_nowait(job)
+        self.enqueue_many([job])
+
+    def enqueue_many(self, jobs):
+        """ Enqueue several jobs at once """
+        if not jobs:
+            return
+        now = datetime.now()
+        with self._cond:
+            for job in jobs:
+                if job.eta and job.eta > now:
+                    heapq.heappush(self._timers,
+                                   (job.eta, next(self._sequence), job))
+                else:
+                    self._push_ready(job)
+            self._cond.notify_all()
+
+    def _push_ready(self, job):
+        heapq.heappush(self.channels.get(job.channel).jobs,
+                       (job.priority, job.date_created,
+                        next(self._sequence), job))
+
+    def _release_timers(self):
+        """ Make ready the jobs whose ``eta`` is reached, return the
+        number of seconds before the next ``eta`` or None """
+        now = datetime.now()
+        while self._timers and self._timers[0][0] <= now:
+            __, __, job = heapq.heappop(self._timers)
+            self._push_ready(job)
+        if self._timers:
+            return _total_seconds(self._timers[0][0] - now)
+        return None
+
+    def _can_start(self, job, now):
+        return (self.limiter.can_start(job, now) and
+                self.breakers.can_start(job, now))
+
+    def _wait_time(self, job, now):
+        """ Seconds before a job can start, None when it waits for the
+        probe of its circuit """
+        breaker_wait = self.breakers.wait_time(job, now)
+        if breaker_wait is None:
+            return None
+        return max(self.limiter.wait_time(job, now), breaker_wait)
+
+    @staticmethod
+    def _execution(channel, job):
+        if PROCESS in (job.execution, channel.execution):
+            return PROCESS
+        return THREAD
+
+    def execution(self, job):
+        """ Execution mode of a job: ``PROCESS`` when its function or
+        its channel is executed in processes, ``THREAD`` otherwise """
+        return self._execution(self.channels.get(job.channel), job)
+
+    def _first_runnable(self, channel, now, execution=None):
+        """ First entry of the channel whose rate limit and circuit
+        breaker allow the start, None when all of them have to wait """
+        def runnable(entry):
+            return ((execution is None or
+                     self._execution(channel, entry[-1]) == execution) and
+                    self._can_start(entry[-1], now))
+        if runnable(channel.jobs[0]):
+            return channel.jobs[0]
+        for entry in sorted(channel.jobs):
+            if runnable(entry):
+                return entry
+        return None
+
+    def _next_entry(self, execution=None):
+        """ Channel and entry of the next job to dequeue, or None and
+        the number of seconds before a waiting job can start (None when
+        no job can start without an other event) """
+        now = time.time()
+        best = None
+        best_key = None
+        wait = None
+        for channel in self.channels:
+            if not channel.jobs or not channel.has_capacity():
+                continue
+            entry = self._first_runnable(channel, now, execution)
+            if entry is None:
+                waits = [self._wait_time(waiting[-1], now)
+                         for waiting in channel.jobs
+                         if execution is None or
+                         self._execution(channel, waiting[-1]) == execution]
+                waits = [seconds for seconds in waits if seconds is not None]
+                if waits:
+                    wait = min(waits) if wait is None else min(waits + [wait])
+                continue
+            key = (channel.load(), entry[:3])
+            if best_key is None or key < best_key:
+                best, best_key = (channel, entry), key
+        return best, wait
+
+    def _take(self, channel, entry):
+        """ Remove an entry from its channel and start its job """
+        if entry is channel.jobs[0]:
+            heapq.heappop(channel.jobs)
+        else:
+            channel.jobs.remove(entry)
+            heapq.heapify(channel.jobs)
+        now = time.time()
+        self.limiter.take(entry[-1], now)
+        self.breakers.start(entry[-1], now)
+        channel.start()
+        self._running[self._execution(channel, entry[-1])] += 1
+        return entry[-1]
+
+    def dequeue(self, timeout=None, execution=None):
+        """ Take the first ready job according to its priority
+        and return it
+
+        Block until a job is available or, when ``timeout`` is given,
+        at most ``timeout`` seconds and return None if no job came.
+        When ``execution`` is given, only the jobs of this execution
+        mode are dequeued.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                next_eta = self._release_timers()
+                best, rate_wait = self._next_entry(execution)
+                if best is not None:
+                    return self._take(*best)
+                wait = next_eta
+                if rate_wait is not None:
+                    wait = rate_wait if wait is None else min(wait,
+                                                              rate_wait)
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait,
+                                                              remaining)
+                self._cond.wait(wait)
+
+    def ready_count(self, execution=None):
+        """ Number of jobs waiting to be dequeued, without the delayed
+        ones, only the jobs of the ``execution`` mode when it is given """
+        with self._cond:
+            self._release_timers()
+            if execution is None:
+                return sum(len(channel.jobs) for channel in self.channels)
+            return sum(1 for channel in self.channels
+                       for entry in channel.jobs
+                       if self._execution(channel, entry[-1]) == execution)
+
+    def waiting_count(self):
+        """ Number of jobs waiting to be dequeued, with the delayed ones """
+        with self._cond:
+            return (len(self._timers) +
+                    sum(len(channel.jobs) for channel in self.channels))
+
+    def free_count(self):
+        """ Number of jobs which can be enqueued before the queue is full,
+        None when it is unbounded """
+        if self.maxsize is None:
+            return None
+        return max(self.maxsize - self.waiting_count(), 0)
+
+    def is_full(self):
+        return self.free_count() == 0
+
+    def running_count(self, execution=None):
+        """ Number of dequeued jobs not done yet, only the jobs of the
+        ``execution`` mode when it is given """
+        with self._cond:
+            if execution is None:
+                return self.channels.get(ROOT_CHANNEL).running
+            return self._running[execution]
+
+    def done(self, job):
+        """ Release the place taken in its channel by a dequeued job """
+        with self._cond:
+            channel = self.channels.get(job.channel)
+            channel.stop()
+            self._running[self._execution(channel, job)] -= 1
+            self.breakers.done(job)
+            # the executors may wait for jobs of other execution modes
+            self._cond.notify_all()
+
+    def circuit_success(self, job):
+        """ Close the circuit of a job which succeeded """
+        with self._cond:
+            self.breakers.success(job)
+            self._cond.notify_all()
+
+    def circuit_failure(self, job):
+        """ Count the failure of a job in its circuit
+
+        When the circuit opens, its ready jobs are delayed until it is
+        half-open.
+
+        :return: the datetime when the circuit becomes half-open if it
+                 has been opened, None otherwise
+        """
+        with self._cond:
+            circuit = self.breakers.failure(job, time.time())
+            if circuit is None:
+                return None
+            until = datetime.now() + timedelta(
+                seconds=circuit.breaker.reset_timeout)
+            for channel in self.channels:
+                delayed = [entry for entry in channel.jobs
+                           if self.breakers.circuit(entry[-1]) is circuit]
+                if not delayed:
+                    continue
+                taken = set(id(entry) for entry in delayed)
+                channel.jobs = [entry for entry in channel.jobs
+                                if id(entry) not in taken]
+                heapq.heapify(channel.jobs)
+                for entry in delayed:
+                    delayed_job = entry[-1]
+                    delayed_job.eta = until
+                    heapq.heappush(self._timers,
+                                   (until, next(self._sequence),
+                                    delayed_job))
+            self._cond.notify_all()
+            return until
 
-    def dequeue(self):
-        """ Take the first job according to its priority
-        and return it"""
-        return self._queue.get()
+    def dequeue_batch(self, job, limit):
+        """ Take up to ``limit`` ready jobs which can be executed in the
+        same batch than ``job``: same channel, same function and same
+        user, allowed by their rate limit and with a closed circuit. The
+        batch holds the place of ``job`` in the channel. Does not block,
+        the list can be empty.
+        """
+        with self._cond:
+            self._release_timers()
+            now = time.time()
+            channel = self.channels.get(job.channel)
+            candidates = [entry for entry in channel.jobs
+                          if entry[-1].func_name == job.func_name and
+                          entry[-1].user_id == job.user_id]
+            batch = []
+            for entry in sorted(candidates):
+                if len(batch) >= limit:
+                    break
+                # the probe of a half-open circuit is always the first
+                # job of a batch, released by ``done``
+                if (self.breakers.is_closed(entry[-1], now) and
+                        self._can_start(entry[-1], now)):
+                    self.limiter.take(entry[-1], now)
+                    batch.append(entry)
+            if batch:
+                taken = set(id(entry) for entry in batch)
+                channel.jobs = [entry for entry in channel.jobs
+                                if id(entry) not in taken]
+                heapq.heapify(channel.jobs)
+        return [entry[-1] for entry in batch]
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Rate limits of the jobs.
+
+A rate limit allows at most ``calls`` jobs to start per ``period``
+seconds for the same key, usually the backend record called by the
+jobs. It is declared on the function of the jobs with the ``rate_limit``
+argument of the ``@job`` decorator, the functions sharing a
+:py:class:`RateLimit` share its quotas::
+
+    AMAZON_QUOTA = RateLimit(10, period=1)
+
+    @job(rate_limit=AMAZON_QUOTA)
+    def export_stock_level(session, model_name, backend_id, product_id):
+        # call amazon
+
+The key of a job is computed when the job is created, by default with
+:py:func:`record_key`. Each worker keeps a token bucket per key: a job
+whose bucket is empty stays in the queue and the worker starts the next
+runnable job instead, so no executor sleeps waiting for the quota.
+The limits apply to each worker. The buckets left full and idle are
+dropped, a new bucket is full.
+"""
+
+import time
+
+SWEEP_INTERVAL = 60  # seconds between the drops of the idle buckets
+
+
+def record_key(job):
+    """ Key of the record targeted by a job: its model and the first
+    argument after the model, such as the id of a backend """
+    return ','.join(unicode(arg) for arg in job.args[:2])
+
+
+class RateLimit(object):
+    """ At most ``calls`` jobs started per ``period`` seconds for a key
+
+    :param calls: number of jobs started per period
+    :param period: period in seconds
+    :param burst: number of jobs which can start at once after an idle
+                  time, ``calls`` by default
+    :param key: function computing the key of a job, see
+                :py:func:`record_key`
+    """
+
+    def __init__(self, calls, period=1, burst=None, key=record_key):
+        assert calls > 0 and period > 0, "Invalid rate limit"
+        self.calls = calls
+        self.period = period
+        self.burst = calls if burst is None else burst
+        self.key = key
+
+    @property
+    def rate(self):
+        """ Tokens added per second """
+        return float(self.calls) / self.period
+
+    def key_for(self, job):
+        return self.key(job)
+
+
+class TokenBucket(object):
+    """ Tokens of a key, refilled at the rate of its limit """
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.stamp = time.time() if now is None else now
+        self.taken = self.stamp
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def available(self, now):
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+        self.taken = now
+
+    def idle(self, now):
+        """ No token taken during the time needed to refill the bucket,
+        which is full """
+        self._refill(now)
+        return (self.tokens >= self.capacity and
+                now - self.taken >= float(self.capacity) / self.rate)
+
+    def wait_time(self, now):
+        """ Seconds before a token is available """
+        self._refill(now)
+        return max((1 - self.tokens) / self.rate, 0)
+
+
+class RateLimiter(object):
+    """ Token buckets of the rate limits of a worker
+
+    The jobs are the handles of the queue, their ``rate_limit``,
+    resolved from their function when the handle is built, gives their
+    :py:class:`RateLimit` and their ``rate_limit_key`` their bucket.
+    Not thread-safe, the queue calls it under its lock.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._next_sweep = None
+
+    def _sweep(self, now):
+        """ Drop the idle buckets, at most every ``SWEEP_INTERVAL``
+        seconds """
+        if self._next_sweep is not None and now < self._next_sweep:
+            return
+        self._next_sweep = now + SWEEP_INTERVAL
+        for key, bucket in self._buckets.items():
+            if bucket.idle(now):
+                del self._buckets[key]
+
+    def _bucket(self, job, now):
+        rate_limit = job.rate_limit
+        if rate_limit is None:
+            return None
+        self._sweep(now)
+        key = (rate_limit, job.rate_limit_key)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(
+                rate_limit.rate, rate_limit.burst, now=now)
+        return bucket
+
+    def can_start(self, job, now=None):
+        """ The bucket of the job has a token """
+        now = time.time() if now is None else now
+        bucket = self._bucket(job, now)
+        return bucket is None or bucket.available(now)
+
+    def take(self, job, now=None):
+        """ Take a token for a starting job """
+        now = time.time() if now is None else now
+        bucket = self._bucket(job, now)
+        if bucket is not None:
+            bucket.take(now)
+
+    def wait_time(self, job, now=None):
+        """ Seconds before the job can start, 0 when it is not limited """
+        now = time.time() if now is None else now
+        bucket = self._bucket(job, now)
+        if bucket is None:
+            return 0
+        return bucket.wait_time(now)
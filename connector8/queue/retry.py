@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Retry policies of the jobs.
+
+A policy gives the number of seconds before the next try of a job which
+raised a :py:class:`~connector8.exception.RetryableJobError`, according
+to the number of tries already done. It is declared on the function of
+the jobs with the ``retry_policy`` argument of the ``@job`` decorator::
+
+    @job(retry_policy=ExponentialRetry(10, max_delay=3600, jitter=True))
+    def export_product(session, model_name, product_id):
+        # export a product
+
+With ``jitter``, the delay is drawn at random between 0 and the computed
+delay ("full jitter"), so the jobs which failed together because of an
+outage of a backend do not try again all at the same time.
+"""
+
+import random
+
+MAX_DELAY = 24 * 60 * 60  # seconds
+
+
+class RetryPolicy(object):
+    """ Base class of the retry policies
+
+    :param max_delay: maximum number of seconds before a retry, one day
+                      by default
+    :param jitter: draw the delay between 0 and the computed delay
+    """
+
+    def __init__(self, max_delay=MAX_DELAY, jitter=False):
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def interval(self, retry):
+        """ Seconds before the try following the ``retry``-th one, the
+        first being 1 """
+        raise NotImplementedError
+
+    def delay(self, retry):
+        """ Seconds before the next try of a job, at most ``max_delay``
+        whatever the number of tries
+
+        :param retry: number of tries already done
+        """
+        try:
+            delay = min(self.interval(max(retry, 1)), self.max_delay)
+        except OverflowError:
+            delay = self.max_delay
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class FixedRetry(RetryPolicy):
+    """ Same delay before each retry """
+
+    def __init__(self, seconds, **kwargs):
+        super(FixedRetry, self).__init__(**kwargs)
+        self.seconds = seconds
+
+    def interval(self, retry):
+        return self.seconds
+
+
+class LinearRetry(RetryPolicy):
+    """ Delay increased by ``step`` seconds at each retry """
+
+    def __init__(self, seconds, step=None, **kwargs):
+        super(LinearRetry, self).__init__(**kwargs)
+        self.seconds = seconds
+        self.step = seconds if step is None else step
+
+    def interval(self, retry):
+        return self.seconds + self.step * (retry - 1)
+
+
+class ExponentialRetry(RetryPolicy):
+    """ Delay multiplied by ``factor`` at each retry """
+
+    def __init__(self, seconds, factor=2, **kwargs):
+        super(ExponentialRetry, self).__init__(**kwargs)
+        self.seconds = seconds
+        self.factor = factor
+
+    def interval(self, retry):
+        return self.seconds * self.factor ** (retry - 1)
+
+
+class TableRetry(RetryPolicy):
+    """ Delays given by a list, the last one is used for the next
+    retries """
+
+    def __init__(self, intervals, **kwargs):
+        super(TableRetry, self).__init__(**kwargs)
+        assert intervals, "The table of the retry intervals is empty"
+        self.intervals = list(intervals)
+
+    def interval(self, retry):
+        return self.intervals[min(retry, len(self.intervals)) - 1]
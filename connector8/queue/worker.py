@@ -21,36 +21,393 @@
 
 import logging
 import os
+import select
 import threading
 import time
 import traceback
 import uuid
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from StringIO import StringIO
 
+import psycopg2
 from psycopg2 import OperationalError, ProgrammingError
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 import openerp
+from openerp.modules.registry import RegistryManager
 from openerp.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
 from openerp.service import db
 from openerp.tools import config
+from .channel import ChannelTree
 from .queue import JobsQueue
-from ..session import ConnectorSessionHandler
+from .process import ProcessPool
+from .retry import ExponentialRetry
+from ..session import ConnectorSession, ConnectorSessionHandler
 from .job import (OdooJobStorage,
+                  JobHandle,
                   PENDING,
-                  DONE)
+                  ENQUEUED,
+                  NOTIFY_CHANNEL,
+                  DONE,
+                  FAILED,
+                  THREAD,
+                  PROCESS,
+                  perform_batch)
 from ..exception import (NoSuchJobError,
                          NotReadableJobError,
                          RetryableJobError,
+                         JobTimeoutError,
                          FailedJobError,
                          NothingToDoJob)
 
 _logger = logging.getLogger(__name__)
 
 WAIT_CHECK_WORKER_ALIVE = 30  # seconds
-WAIT_WHEN_ONLY_AFTER_JOBS = 10  # seconds
+WAIT_DEQUEUE = 1  # seconds
 WORKER_TIMEOUT = 5 * 60  # seconds
 PG_RETRY = 5  # seconds
+# delays of the retries of the jobs which had a concurrency error, spread
+# so the conflicting jobs do not conflict again
+PG_RETRY_POLICY = ExponentialRetry(PG_RETRY, max_delay=5 * 60, jitter=True)
+DEFAULT_EXECUTORS = 1
+DEFAULT_QUEUE_SIZE = 1000  # jobs waiting in the queue of a worker
+DEFAULT_JOB_TIMEOUT = 60 * 60  # seconds
+MAX_CLAIM_SIZE = 500  # jobs assigned at once
+# seconds of work kept ahead of the execution in the queue of a worker
+QUEUE_LEAD = 10
+THROUGHPUT_WEIGHT = 0.2  # weight of the last job in the moving average
+LISTEN_RETRY = 60  # seconds
+
+
+class JobListener(object):
+    """ Wait for the notifications of new jobs
+
+    Listens to ``NOTIFY_CHANNEL`` on a dedicated connection, opened on
+    the first wait and reopened ``LISTEN_RETRY`` seconds after an error.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self._conn = None
+        self._retry_at = None
+
+    def _connect(self):
+        __, dsn = openerp.sql_db.dsn(self.db_name)
+        conn = psycopg2.connect(dsn)
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute('LISTEN %s' % NOTIFY_CHANNEL)
+        self._conn = conn
+
+    def wait(self, timeout):
+        """ Wait at most ``timeout`` seconds for a notification,
+        return True if jobs have been notified """
+        if self._retry_at and time.time() < self._retry_at:
+            time.sleep(timeout)
+            return False
+        try:
+            if self._conn is None:
+                self._connect()
+            if select.select([self._conn], [], [], timeout) == ([], [], []):
+                return False
+            self._conn.poll()
+        except (psycopg2.Error, select.error):
+            _logger.warning('Cannot listen to the new jobs of %s, '
+                            'they will be assigned by the cron',
+                            self.db_name, exc_info=True)
+            self.close()
+            self._retry_at = time.time() + LISTEN_RETRY
+            return False
+        self._retry_at = None
+        notified = bool(self._conn.notifies)
+        del self._conn.notifies[:]
+        return notified
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+
+class Throughput(object):
+    """ Observed throughput of the executors of a worker, as the moving
+    average of the duration of the jobs """
+
+    def __init__(self, weight=THROUGHPUT_WEIGHT):
+        self.weight = weight
+        self.duration = None
+        self._lock = threading.Lock()
+
+    def add(self, duration, count=1):
+        """ Record the execution of ``count`` jobs in ``duration``
+        seconds """
+        duration = float(duration) / count
+        with self._lock:
+            if self.duration is None:
+                self.duration = duration
+            else:
+                self.duration += self.weight * (duration - self.duration)
+
+    def jobs_per_second(self, executors):
+        """ Jobs executed per second by ``executors`` threads, None until
+        a job has been executed """
+        if self.duration is None:
+            return None
+        return executors / max(self.duration, 0.001)
+
+
+class Watchdog(object):
+    """ Deadlines of the jobs running in the executors of a worker
+
+    An executor is watched from the start of its jobs to their end. The
+    worker takes the executors whose jobs exceeded their deadline, they
+    are abandoned: their jobs are no longer their own.
+
+    The recovered jobs of an abandoned executor are enqueued again only
+    once the executor ended them, by the last of the executor
+    (:py:meth:`ended`) and the worker (:py:meth:`recovered`), so a job
+    never runs twice at the same time. An executor which does not end
+    them within their time limit again, blocked for good, gives them up
+    (:py:meth:`stranded`): they are released for the other workers.
+    """
+
+    def __init__(self):
+        self._running = {}
+        # jobs recovered from the abandoned executors, None until the
+        # worker recovered them
+        self._abandoned = {}
+        self._ended = set()
+        self._lock = threading.Lock()
+
+    def watch(self, executor, sessions, jobs, timeout, now=None):
+        """ The jobs start in the executor, with its sessions """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._running[executor] = (now + timeout, jobs, sessions,
+                                       timeout)
+
+    def release(self, executor):
+        """ The jobs of the executor ended, return False if they were
+        taken by :py:meth:`expired` before """
+        with self._lock:
+            self._running.pop(executor, None)
+            return executor not in self._abandoned
+
+    def ended(self, executor):
+        """ An abandoned executor ended its jobs, return the recovered
+        jobs to enqueue, an empty list when they are not recovered yet:
+        :py:meth:`recovered` returns them """
+        with self._lock:
+            entry = self._abandoned.pop(executor, None)
+            if entry is None:
+                self._ended.add(executor)
+                return []
+            return entry[0]
+
+    def recovered(self, executor, handles, timeout, now=None):
+        """ The worker recovered the jobs of an abandoned executor, return
+        the jobs to enqueue when the executor ended them, an empty list
+        otherwise: :py:meth:`ended` returns them, or :py:meth:`stranded`
+        when the executor did not end them ``timeout`` seconds later """
+        now = time.time() if now is None else now
+        with self._lock:
+            if executor in self._ended:
+                self._ended.remove(executor)
+                return handles
+            self._abandoned[executor] = (handles, now + timeout)
+            return []
+
+    def stranded(self, now=None):
+        """ Take the recovered jobs of the abandoned executors which did
+        not end them before their deadline, the executors no longer
+        return them when they end """
+        now = time.time() if now is None else now
+        stranded = []
+        with self._lock:
+            for executor, entry in self._abandoned.items():
+                if entry is not None and entry[0] and entry[1] <= now:
+                    self._abandoned[executor] = ([], entry[1])
+                    stranded += entry[0]
+        return stranded
+
+    def expired(self, now=None):
+        """ Take the executors whose jobs exceeded their deadline
+
+        Return a list of ``(executor, jobs, sessions, timeout)``.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        with self._lock:
+            for executor, entry in self._running.items():
+                deadline, jobs, sessions, timeout = entry
+                if deadline <= now:
+                    del self._running[executor]
+                    self._abandoned[executor] = None
+                    expired.append((executor, jobs, sessions, timeout))
+        return expired
+
+
+class JobSessions(object):
+    """ Sessions of an executor thread, opened on 2 cursors which are
+    kept for all the jobs of the thread
+
+    The state of the jobs is read and recorded in the sessions of
+    :py:meth:`session`, each of them committed at once. The jobs are
+    performed in the sessions of :py:meth:`work_session`, where their
+    final state is stored in the same transaction as their work.
+
+    Once abandoned, because the jobs exceeded their time limit, the
+    sessions raise :py:class:`~connector8.exception.JobTimeoutError` and
+    are never committed.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self._cursors = {}
+        self.abandoned = False
+
+    def _cursor(self, name):
+        cr = self._cursors.get(name)
+        if cr is None:
+            db = openerp.sql_db.db_connect(self.db_name)
+            cr = self._cursors[name] = db.cursor()
+        return cr
+
+    def _end(self, name, commit):
+        """ Commit or rollback a cursor, drop it if it is broken """
+        cr = self._cursors[name]
+        try:
+            if commit:
+                cr.commit()
+            else:
+                cr.rollback()
+        except Exception:
+            self._close(name)
+            raise
+        finally:
+            # the records cached in the environments of the thread
+            # belong to the ended transaction
+            openerp.api.Environment.reset()
+
+    def _close(self, name):
+        cr = self._cursors.pop(name, None)
+        if cr is not None:
+            try:
+                cr.close()
+            except Exception:
+                _logger.debug('Could not close a cursor of %s',
+                              self.db_name, exc_info=True)
+
+    def _check_abandoned(self):
+        if self.abandoned:
+            raise JobTimeoutError('The sessions of the job have been '
+                                  'abandoned after its time limit')
+
+    @contextmanager
+    def _session(self, name):
+        self._check_abandoned()
+        session = ConnectorSession(self._cursor(name), openerp.SUPERUSER_ID)
+        succeeded = False
+        try:
+            yield session
+            succeeded = True
+        except Exception:
+            # the error of an abandoned session comes from its cancel
+            self._check_abandoned()
+            raise
+        finally:
+            self._end(name, commit=succeeded and not self.abandoned)
+        self._check_abandoned()
+
+    @contextmanager
+    def session(self):
+        """ Context Manager: session to read and record the state of the
+        jobs, committed at the end of the ``with`` context when no error
+        occured, rollbacked otherwise """
+        with self._session('state') as session:
+            yield session
+
+    @contextmanager
+    def work_session(self):
+        """ Context Manager: session to perform the jobs, same as
+        :py:meth:`session` with the registry signaling """
+        RegistryManager.check_registry_signaling(self.db_name)
+        with self._session('work') as session:
+            yield session
+        RegistryManager.signal_caches_change(self.db_name)
+
+    def abandon(self):
+        """ Called from another thread when the jobs exceeded their time
+        limit: cancel the running query of the work session, the
+        transactions in progress will be rollbacked """
+        self.abandoned = True
+        cr = self._cursors.get('work')
+        if cr is not None:
+            try:
+                cr._cnx.cancel()
+            except Exception:
+                _logger.debug('Could not cancel the query of a job of %s',
+                              self.db_name, exc_info=True)
+
+    def close(self):
+        for name in self._cursors.keys():
+            self._close(name)
+
+
+class JobExecutor(threading.Thread):
+    """ Thread of the pool of a `Worker`, executing the jobs
+
+    The executors share the queue of their worker. Each of them opens
+    its own cursors and sessions to run the jobs.
+
+    An executor takes only the jobs of its ``execution`` mode, all the
+    jobs when it is None: the executors of the ``process`` mode wait for
+    the child processes executing their jobs.
+    """
+
+    def __init__(self, worker, index, execution=None):
+        if execution is None:
+            name = '%s-executor-%d' % (worker.db_name, index)
+        else:
+            name = '%s-%s-executor-%d' % (worker.db_name, execution, index)
+        super(JobExecutor, self).__init__(name=name)
+        self.worker = worker
+        self.execution = execution
+
+    def run(self):
+        """ Executor's main loop
+
+        Wait for jobs and execute them sequentially until the worker
+        stops. The queue is polled with a timeout so the executor
+        notices the stop even when no job comes. The executor exits when
+        it has been abandoned by the watchdog of the worker, which
+        already released its jobs.
+        """
+        threading.current_thread().dbname = self.worker.db_name
+        watchdog = self.worker.watchdog
+        with openerp.api.Environment.manage():
+            try:
+                while not self.worker.stopped():
+                    job = self.worker.queue.dequeue(
+                        timeout=WAIT_DEQUEUE, execution=self.execution)
+                    if job is None:
+                        continue
+                    released = True
+                    try:
+                        self.worker.execute(job)
+                    finally:
+                        released = watchdog.release(self)
+                        if released:
+                            self.worker.queue.done(job)
+                    if not released:
+                        _logger.warning('%s ended its abandoned jobs', self)
+                        self.worker.queue.enqueue_many(watchdog.ended(self))
+                        break
+            finally:
+                self.worker.release_sessions()
 
 
 class Worker(threading.Thread):
@@ -58,105 +415,298 @@ class Worker(threading.Thread):
 
     queue_class = JobsQueue
     job_storage_class = OdooJobStorage
+    listener_class = JobListener
 
     def __init__(self, db_name, watcher):
         super(Worker, self).__init__()
-        self.queue = self.queue_class()
+        self.queue = self.queue_class(
+            ChannelTree(config.get('connector_channels'),
+                        root_capacity=(self.executors_count() +
+                                       self.processes_count())),
+            maxsize=self.queue_size())
         self.db_name = db_name
         threading.current_thread().dbname = db_name
         self.uuid = unicode(uuid.uuid4())
         self.watcher = watcher
+        self.executors = []
+        self.process_pool = ProcessPool(db_name, self.processes_count())
+        self._local = threading.local()
+        self.throughput = Throughput()
+        # jobs executed in the child processes
+        self.process_throughput = Throughput()
+        self.watchdog = Watchdog()
+        # jobs have been released because the queue was full
+        self.spilled = False
+        # first eta (UTC) of the jobs left unassigned by the last claim
+        self.next_eta = None
 
-    def run_job(self, job):
-        """ Execute a job """
-        def retry_postpone(job, message, seconds=None):
-            with session_hdl.session() as session:
-                job.postpone(result=message, seconds=seconds)
-                job.set_enqueued(self)
-                self.job_storage_class(session).store(job)
-            self.queue.enqueue(job)
+    @staticmethod
+    def executors_count():
+        """ Number of executor threads for the jobs executed in the
+        worker, option ``connector_threads`` of the configuration file
+        """
+        return max(int(config.get('connector_threads') or
+                       DEFAULT_EXECUTORS), 1)
 
-        session_hdl = ConnectorSessionHandler(self.db_name,
-                                              openerp.SUPERUSER_ID)
+    @staticmethod
+    def processes_count():
+        """ Number of child processes for the jobs executed in
+        processes, option ``connector_processes`` of the configuration
+        file. Each of them has its own executor thread. None by default:
+        all the jobs are then executed in the threads. """
+        return max(int(config.get('connector_processes') or 0), 0)
+
+    @staticmethod
+    def queue_size():
+        """ Maximum number of jobs waiting in the queue, option
+        ``connector_queue_size`` of the configuration file """
+        return max(int(config.get('connector_queue_size') or
+                       DEFAULT_QUEUE_SIZE), 1)
+
+    @staticmethod
+    def job_timeout():
+        """ Time limit of the jobs whose function has no ``timeout``,
+        option ``connector_job_timeout`` of the configuration file """
+        return max(int(config.get('connector_job_timeout') or
+                       DEFAULT_JOB_TIMEOUT), 1)
+
+    def _sessions(self):
+        """ Sessions of the current thread, see :py:class:`JobSessions` """
+        sessions = getattr(self._local, 'sessions', None)
+        if sessions is None:
+            sessions = self._local.sessions = JobSessions(self.db_name)
+        return sessions
+
+    def release_sessions(self):
+        """ Close the cursors held by the current thread """
+        sessions = getattr(self._local, 'sessions', None)
+        if sessions is not None:
+            sessions.close()
+            self._local.sessions = None
+
+    def run_job(self, handle):
+        """ Execute a job
+
+        ``handle`` is the :py:class:`~connector8.queue.job.JobHandle`
+        taken from the queue. The job is loaded, checked and started in
+        one transaction, then performed and set to done in a second one.
+        """
+        sessions = self._sessions()
+        job = None
         try:
-            with session_hdl.session() as session:
-                job = self._load_job(session, job.uuid)
+            with sessions.session() as session:
+                job = self._load_job(session, handle.uuid)
                 if job is None:
                     return
 
-            # if the job has been manually set to DONE or PENDING
-            # before its execution, stop
-            if job.state in (DONE, PENDING):
-                return
-
-            # the job has been enqueued in this worker but has likely be
-            # modified in the database since its enqueue
-            if job.worker_uuid != self.uuid:
-                # put the job in pending so it can be requeued
-                _logger.error('Job %s was enqueued in worker %s but '
-                              'was linked to worker %s. Reset to pending.',
-                              job.uuid, self.uuid, job.worker_uuid)
-                with session_hdl.session() as session:
-                    job.set_pending()
-                    self.job_storage_class(session).store(job)
-                return
+                if not self._check_job(session, job):
+                    return
 
-            if job.eta and job.eta > datetime.now():
-                # The queue is sorted by 'eta' date first
-                # so if we dequeued a job expected to be run in
-                # the future, we have no jobs to do right now!
-                self.queue.enqueue(job)
-                # Wait some time just to avoid to loop over
-                # the same 'future' jobs
-                _logger.debug('Wait %s seconds because the delayed '
-                              'jobs have been reached',
-                              WAIT_WHEN_ONLY_AFTER_JOBS)
-                time.sleep(WAIT_WHEN_ONLY_AFTER_JOBS)
-                return
+                if job.eta and job.eta > datetime.now():
+                    # the eta has been changed since the job has been
+                    # enqueued, the queue keeps it until its eta
+                    self.queue.enqueue(JobHandle.from_job(job))
+                    return
 
-            with session_hdl.session() as session:
                 job.set_started()
                 self.job_storage_class(session).store(job)
 
             _logger.debug('%s started', job)
-            with session_hdl.session() as session:
-                job.perform(session)
+            self._perform(sessions, job)
+            self.queue.circuit_success(job)
             _logger.debug('%s done', job)
 
-            with session_hdl.session() as session:
-                job.set_done()
-                self.job_storage_class(session).store(job)
-
         except NothingToDoJob as err:
-            if unicode(err):
-                msg = unicode(err)
-            else:
-                msg = None
-            job.cancel(msg)
-            with session_hdl.session() as session:
-                self.job_storage_class(session).store(job)
+            self._cancel_job(sessions, job, err)
+
+        except JobTimeoutError:
+            # the job has been recovered by the worker
+            raise
 
         except RetryableJobError as err:
             # delay the job later, requeue
-            retry_postpone(job, unicode(err))
+            self._postpone_job(sessions, job, unicode(err),
+                               seconds=err.seconds)
             _logger.debug('%s postponed', job)
+            self._circuit_failure(sessions, job)
 
         except OperationalError as err:
             # Automatically retry the typical transaction serialization errors
             if err.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
                 raise
-            retry_postpone(job, unicode(err), seconds=PG_RETRY)
+            if job is None:
+                # the job has not been loaded, nothing has been written
+                # in its row: its handle is queued again by uuid
+                handle.eta = datetime.now() + timedelta(
+                    seconds=PG_RETRY_POLICY.delay(1))
+                self.queue.enqueue(handle)
+                _logger.debug('%s OperationalError on load, requeued',
+                              handle)
+                return
+            self._postpone_job(sessions, job, unicode(err),
+                               seconds=PG_RETRY_POLICY.delay(job.retry))
             _logger.debug('%s OperationalError, postponed', job)
 
-        except (FailedJobError, Exception):
+        except NotReadableJobError:
+            # the job could not be loaded, only its handle is known
+            with sessions.session() as session:
+                self.job_storage_class(session).set_failed_unreadable(
+                    handle.uuid, traceback.format_exc())
+            raise
+
+        except (FailedJobError, Exception) as err:
+            if job is None:
+                # the job has not been loaded, only its handle is known
+                raise
             buff = StringIO()
             traceback.print_exc(file=buff)
-            _logger.error(buff.getvalue())
+            exc_info = getattr(err, 'child_traceback', None)
+            self._fail_job(sessions, job, exc_info or buff.getvalue())
+            self._circuit_failure(sessions, job)
+            raise
 
-            job.set_failed(exc_info=buff.getvalue())
-            with session_hdl.session() as session:
+    def execution(self, job):
+        """ Execution mode of a job in the worker: the jobs of the
+        ``process`` mode are executed in the threads when the worker has
+        no child processes """
+        if self.processes_count():
+            return self.queue.execution(job)
+        return THREAD
+
+    def _perform(self, sessions, job):
+        """ Perform the job and set it to done in a work session, or in
+        a child process according to the execution mode of its function
+        or channel """
+        if self.execution(job) == PROCESS:
+            # stored as done by the child with the work of the job
+            self.process_pool.perform(job)
+            job.set_done()
+        else:
+            with sessions.work_session() as session:
+                job.perform(session)
+                job.set_done()
                 self.job_storage_class(session).store(job)
+
+    def run_batch(self, jobs):
+        """ Execute jobs of a batchable function with a single call of
+        their batch handler.
+
+        The jobs are performed in one transaction, but the outcome of
+        each job is recorded on its own: the batch handler returns an
+        exception in place of the result of a failed job. The done jobs
+        are stored in the transaction of the batch.
+        """
+        sessions = self._sessions()
+        with sessions.session() as session:
+            storage = self.job_storage_class(session)
+            loaded = storage.load_many([job.uuid for job in jobs])
+            jobs = []
+            for job in loaded:
+                if not self._check_job(session, job):
+                    continue
+                if job.eta and job.eta > datetime.now():
+                    self.queue.enqueue(JobHandle.from_job(job))
+                    continue
+                job.set_started()
+                storage.store(job)
+                jobs.append(job)
+        if not jobs:
+            return
+
+        _logger.debug('batch of %d jobs started: %s', len(jobs), jobs)
+        try:
+            with sessions.work_session() as session:
+                outcomes = perform_batch(session, jobs)
+                storage = self.job_storage_class(session)
+                for job, outcome in zip(jobs, outcomes):
+                    if not isinstance(outcome, Exception):
+                        job.set_done()
+                        storage.store(job)
+        except JobTimeoutError:
             raise
+        except Exception as err:
+            _logger.exception('batch of %d jobs failed', len(jobs))
+            outcomes = [job.error_for_retry(err) for job in jobs]
+
+        for job, outcome in zip(jobs, outcomes):
+            if not isinstance(outcome, Exception):
+                self.queue.circuit_success(job)
+            elif isinstance(outcome, NothingToDoJob):
+                self._cancel_job(sessions, job, outcome)
+            elif isinstance(outcome, RetryableJobError):
+                self._postpone_job(sessions, job, unicode(outcome),
+                                   seconds=outcome.seconds)
+                _logger.debug('%s postponed', job)
+                self._circuit_failure(sessions, job)
+            elif (isinstance(outcome, OperationalError) and
+                    outcome.pgcode in PG_CONCURRENCY_ERRORS_TO_RETRY):
+                self._postpone_job(
+                    sessions, job, unicode(outcome),
+                    seconds=PG_RETRY_POLICY.delay(job.retry))
+                _logger.debug('%s OperationalError, postponed', job)
+            else:
+                exc_info = ''.join(
+                    traceback.format_exception_only(type(outcome), outcome))
+                self._fail_job(sessions, job, exc_info)
+                self._circuit_failure(sessions, job)
+        _logger.debug('batch of %d jobs done', len(jobs))
+
+    def _check_job(self, session, job):
+        """ Return True if a job loaded from the storage has to be run """
+        # if the job has been manually set to DONE or PENDING
+        # before its execution, stop
+        if job.state in (DONE, PENDING):
+            return False
+
+        # the job has been enqueued in this worker but has likely be
+        # modified in the database since its enqueue
+        if job.worker_uuid != self.uuid:
+            # put the job in pending so it can be requeued
+            _logger.error('Job %s was enqueued in worker %s but '
+                          'was linked to worker %s. Reset to pending.',
+                          job.uuid, self.uuid, job.worker_uuid)
+            job.set_pending()
+            self.job_storage_class(session).store(job)
+            return False
+        return True
+
+    def _cancel_job(self, sessions, job, err):
+        """ The job had nothing to do """
+        if unicode(err):
+            msg = unicode(err)
+        else:
+            msg = None
+        job.cancel(msg)
+        with sessions.session() as session:
+            self.job_storage_class(session).store(job)
+
+    def _postpone_job(self, sessions, job, message, seconds=None):
+        """ Retry the job later """
+        with sessions.session() as session:
+            job.postpone(result=message, seconds=seconds)
+            job.set_enqueued(self)
+            self.job_storage_class(session).store(job)
+        self.queue.enqueue(JobHandle.from_job(job))
+
+    def _fail_job(self, sessions, job, exc_info):
+        """ Record the failure of the job """
+        _logger.error(exc_info)
+        job.set_failed(exc_info=exc_info)
+        with sessions.session() as session:
+            self.job_storage_class(session).store(job)
+
+    def _circuit_failure(self, sessions, job):
+        """ Count the failure of the job in its circuit breaker, when the
+        circuit opens, postpone the waiting jobs of the circuit in the
+        database until it is half-open """
+        until = self.queue.circuit_failure(job)
+        if until is None:
+            return
+        with sessions.session() as session:
+            count = self.job_storage_class(session).postpone_circuit(
+                job.circuit_key, until)
+        _logger.warning('Circuit %s open until %s, %d jobs postponed',
+                        job.circuit_key, until, count)
 
     def _load_job(self, session, job_uuid):
         """ Reload a job from the backend """
@@ -170,25 +720,254 @@ class Worker(threading.Thread):
             raise
         return job
 
+    def stopped(self):
+        """ The worker has to exit (db destroyed, connector uninstalled)
+        when it is no longer referenced by the watcher """
+        return self.watcher.worker_lost(self)
+
+    def _timeout(self, jobs):
+        """ Time limit of the execution of jobs, a batch has the time
+        limits of all its jobs """
+        default = self.job_timeout()
+        return sum(job.timeout or default for job in jobs)
+
+    def execute(self, job):
+        """ Execute a job dequeued by an executor, with the next jobs
+        of its batch if its function is batchable
+
+        The jobs are watched by the watchdog until the executor releases
+        them.
+        """
+        start = time.time()
+        jobs = [job]
+        try:
+            # a job whose function cannot be imported has a batch size
+            # of 1, it is failed by ``run_job``
+            if job.batch_size > 1:
+                jobs += self.queue.dequeue_batch(job, job.batch_size - 1)
+            self.watchdog.watch(threading.current_thread(), self._sessions(),
+                                jobs, self._timeout(jobs))
+            if job.batch_size > 1:
+                self.run_batch(jobs)
+            else:
+                self.run_job(job)
+        except JobTimeoutError:
+            _logger.warning('%s abandoned after their time limit', jobs)
+        except Exception:
+            _logger.exception('Could not execute %s', jobs)
+        if self.execution(job) == PROCESS:
+            throughput = self.process_throughput
+        else:
+            throughput = self.throughput
+        throughput.add(time.time() - start, count=len(jobs))
+
+    def claim_size(self):
+        """ Number of jobs to assign to the worker
+
+        Enough jobs to fill the free executors and to keep ``QUEUE_LEAD``
+        seconds of work waiting in the queue at the observed throughput,
+        minus the jobs already waiting. Until a job has been executed,
+        one job per executor is kept waiting. Nothing is claimed when the
+        queue is full.
+
+        The claim is sized for the executor threads, which execute most of
+        the jobs. The child processes only add ``QUEUE_LEAD`` seconds of
+        the jobs they execute, once some have been executed: their idle
+        executors do not count.
+        """
+        processes = self.processes_count()
+        execution = THREAD if processes else None
+        executors = self.executors_count()
+        free = max(executors - self.queue.running_count(execution), 0)
+        rate = self.throughput.jobs_per_second(executors)
+        if rate is None:
+            lead = executors
+        else:
+            lead = int(round(rate * QUEUE_LEAD))
+        size = max(free + lead - self.queue.ready_count(execution), 0)
+        rate = self.process_throughput.jobs_per_second(processes)
+        if processes and rate is not None:
+            lead = int(round(rate * QUEUE_LEAD))
+            size += max(lead - self.queue.ready_count(PROCESS), 0)
+        size = min(size, MAX_CLAIM_SIZE)
+        room = self.queue.free_count()
+        if room is not None:
+            size = min(size, room)
+        return size
+
+    def _start_executor(self, index):
+        """ Start the executor at ``index``: the executors of the jobs
+        executed in the worker come first, then the executors of the
+        child processes, if any """
+        if index >= self.executors_count():
+            executor = JobExecutor(self, index, execution=PROCESS)
+        elif self.processes_count():
+            executor = JobExecutor(self, index, execution=THREAD)
+        else:
+            executor = JobExecutor(self, index)
+        executor.daemon = True
+        executor.start()
+        return executor
+
     def run(self):
         """ Worker's main loop
 
-        Check if it still exists in the ``watcher``. When it does no
-        longer exist, it break the loop so the thread stops properly.
+        Start the pool of executors which wait for jobs and execute
+        them concurrently, then check if the worker still exists in the
+        ``watcher``. When it does no longer exist, it breaks the loop
+        and waits for the executors to finish their current job so the
+        thread stops properly. An executor which died is replaced.
 
-        Wait for jobs and execute them sequentially.
+        Between the checks, listen to the notifications of new jobs and
+        assign them right away. The ``ir_cron_enqueue_jobs`` cron still
+        assigns the jobs whose notification has been missed. When jobs
+        have been released because the queue was full, new jobs are
+        assigned as soon as the queue has room again. The delayed jobs
+        are assigned ``QUEUE_LEAD`` seconds before their ``eta``, see
+        :py:meth:`eta_reached`.
+
+        The worker is also the watchdog of the executors: an executor
+        whose jobs exceeded their time limit is replaced, see
+        :py:meth:`recycle`, and the jobs of an executor which never ends
+        are released, see :py:meth:`release_stranded`.
         """
         with openerp.api.Environment.manage():
-            while 1:
-                # check if the worker has to exit (db destroyed, connector
-                # uninstalled)
-                if self.watcher.worker_lost(self):
-                    break
-                job = self.queue.dequeue()
-                try:
-                    self.run_job(job)
-                except:
-                    continue
+            count = self.executors_count() + self.processes_count()
+            self.executors = [self._start_executor(index) for index
+                              in range(count)]
+            listener = self.listener_class(self.db_name)
+            while not self.stopped():
+                for index, executor in enumerate(self.executors):
+                    if not executor.is_alive():
+                        _logger.error('%s died, restarting it', executor)
+                        self.executors[index] = self._start_executor(index)
+                for expired in self.watchdog.expired():
+                    self.recycle(*expired)
+                stranded = self.watchdog.stranded()
+                if stranded:
+                    self.release_stranded(stranded)
+                notified = listener.wait(WAIT_DEQUEUE)
+                if notified or ((self.spilled or self.eta_reached()) and
+                                self.claim_size()):
+                    self.assign_then_enqueue()
+            listener.close()
+            for executor in self.executors:
+                executor.join()
+            self.process_pool.close()
+            self.release_sessions()
+
+    def eta_reached(self):
+        """ Indicate if the first ``eta`` of the unassigned jobs is
+        close enough to assign them
+
+        Their notification has been sent when they were created, the
+        ``eta`` of the jobs is not notified.
+        """
+        next_eta = self.next_eta
+        return (next_eta is not None and
+                next_eta <= datetime.utcnow() + timedelta(seconds=QUEUE_LEAD))
+
+    def recycle(self, executor, jobs, sessions, timeout):
+        """ Replace an executor whose jobs exceeded their time limit
+
+        A thread cannot be killed: the running query of the executor is
+        canceled and its sessions are abandoned, so it cannot commit
+        anymore, and it exits when its jobs return. The child process
+        executing its job, if any, is killed. A new executor takes its
+        place. The jobs still started are retried later, or failed once
+        their max. retries is reached. They are enqueued again when the
+        abandoned executor ended, or released when it did not end within
+        the time limit again, see :py:class:`Watchdog`.
+        """
+        _logger.error('%s exceeded the time limit of %d seconds, '
+                      'replacing %s', jobs, timeout, executor)
+        sessions.abandon()
+        for job in jobs:
+            if self.process_pool.terminate(job.uuid):
+                _logger.error('Killed the process of %s', job)
+        if executor in self.executors:
+            index = self.executors.index(executor)
+            self.executors[index] = self._start_executor(index)
+        self.queue.done(jobs[0])
+        handles = []
+        try:
+            handles = self._timeout_jobs(jobs, timeout)
+        except OperationalError as err:
+            if err.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                _logger.exception('Could not recover the jobs %s', jobs)
+            else:
+                # the jobs have been recorded by the executor meanwhile
+                _logger.info('%s ended during their recovery', jobs)
+        except Exception:
+            _logger.exception('Could not recover the jobs %s', jobs)
+        finally:
+            self.queue.enqueue_many(
+                self.watchdog.recovered(executor, handles, timeout))
+
+    def release_stranded(self, handles):
+        """ Release the jobs recovered from an executor which never
+        ended them, a call which hangs forever for instance
+
+        They are set to pending and unassigned, so they are retried by
+        any worker once their ``eta`` is reached.
+        """
+        _logger.error('%s not ended by their abandoned executor, '
+                      'releasing them', handles)
+        try:
+            with self._sessions().session() as session:
+                storage = self.job_storage_class(session)
+                storage.release_many([handle.uuid for handle in handles],
+                                     self.uuid, state=ENQUEUED)
+        except Exception:
+            _logger.exception('Could not release the jobs %s', handles)
+
+    def _timeout_jobs(self, jobs, timeout):
+        """ Retry or fail the jobs still started after their time limit,
+        the retry is counted as the work of the jobs has been
+        rollbacked
+
+        The jobs which ended in the meantime are left as they are: the
+        state of the jobs is checked by the update which takes them back.
+
+        :return: :py:class:`~connector8.queue.job.JobHandle` of the jobs
+                 to retry
+        """
+        message = 'Time limit of %d seconds exceeded' % timeout
+        sessions = self._sessions()
+        timed_out = []
+        with sessions.session() as session:
+            storage = self.job_storage_class(session)
+            job_uuids = storage.requeue_started([job.uuid for job in jobs],
+                                                self.uuid)
+            for job in storage.load_many(job_uuids):
+                job.retry += 1
+                err = job.error_for_retry(JobTimeoutError(message))
+                if isinstance(err, FailedJobError):
+                    _logger.error('%s: %s', job, err)
+                    job.set_failed(exc_info=unicode(err))
+                else:
+                    job.postpone(result=message)
+                    job.set_enqueued(self)
+                storage.store(job)
+                timed_out.append(job)
+        for job in timed_out:
+            self._circuit_failure(sessions, job)
+        return [JobHandle.from_job(job) for job in timed_out
+                if job.state != FAILED]
+
+    def assign_then_enqueue(self):
+        """ Assign the new jobs to the worker and enqueue them """
+        self.spilled = False
+        self.next_eta = None
+        session_hdl = ConnectorSessionHandler(self.db_name,
+                                              openerp.SUPERUSER_ID)
+        try:
+            with session_hdl.session() as session:
+                session.pool['queue.worker'].assign_then_enqueue(
+                    session.cr, session.uid, context=session.context)
+        except Exception:
+            _logger.exception('Could not assign the notified jobs to %s',
+                              self.uuid)
 
     def enqueue_job_uuid(self, job_uuid):
         """ Enqueue a job:
@@ -204,13 +983,57 @@ class Worker(threading.Thread):
                 # skip a deleted job
                 return
             job.set_enqueued(self)
-            self.job_storage_class(session).store(job)
+            storage = self.job_storage_class(session)
+            storage.store(job)
+            handles = self._readable_handles(storage,
+                                             [JobHandle.from_job(job)])
         # the change of state should be commited before
         # the enqueue otherwise we may have concurrent updates
         # if the job is started directly
-        self.queue.enqueue(job)
+        self.queue.enqueue_many(handles)
         _logger.debug('%s enqueued in %s', job, self)
 
+    def enqueue_job_uuids(self, job_uuids):
+        """ Enqueue jobs assigned to the worker
+
+        The pending jobs are set to enqueued in one transaction, then
+        their handles are pushed together in the queue. The jobs which
+        do not fit in the queue are released for the other workers.
+        """
+        job_uuids = list(job_uuids)
+        room = self.queue.free_count()
+        spilled = []
+        if room is not None and len(job_uuids) > room:
+            job_uuids, spilled = job_uuids[:room], job_uuids[room:]
+        session_hdl = ConnectorSessionHandler(self.db_name,
+                                              openerp.SUPERUSER_ID)
+        with session_hdl.session() as session:
+            storage = self.job_storage_class(session)
+            handles = storage.set_enqueued_many(job_uuids, self.uuid)
+            handles = self._readable_handles(storage, handles)
+            storage.release_many(spilled, self.uuid)
+        if spilled:
+            self.spilled = True
+            _logger.debug('queue of %s full, %d jobs released',
+                          self, len(spilled))
+        # as in ``enqueue_job_uuid``, the jobs are enqueued once their
+        # state is committed
+        self.queue.enqueue_many(handles)
+        _logger.debug('%d jobs enqueued in %s', len(handles), self)
+
+    def _readable_handles(self, storage, handles):
+        """ Fail the jobs whose function cannot be imported, return the
+        handles of the other jobs """
+        readable = []
+        for handle in handles:
+            if handle.error:
+                _logger.error('Could not import the function of job %s:\n%s',
+                              handle.uuid, handle.error)
+                storage.set_failed_unreadable(handle.uuid, handle.error)
+            else:
+                readable.append(handle)
+        return readable
+
 
 class WorkerWatcher(threading.Thread):
     """ Keep a sight on the workers and signal their aliveness.
@@ -245,9 +1068,11 @@ class WorkerWatcher(threading.Thread):
     def worker_lost(self, worker):
         """ Indicate if a worker is no longer referenced by the watcher.
 
-        Used by the worker threads to know if they have to exit.
+        Used by the worker threads to know if they have to exit. The
+        workers are changed by the watcher thread meanwhile, a single
+        lookup never iterates over them.
         """
-        return worker not in self._workers.itervalues()
+        return self._workers.get(worker.db_name) is not worker
 
     @staticmethod
     def available_db_names():
@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import test_session
+import test_codec
+import test_archive
 import test_event
 import test_job
+import test_channel
+import test_retry
+import test_ratelimit
+import test_breaker
 import test_queue
+import test_worker
+import test_claim
+import test_process
 import test_backend
 import test_producer
 import test_connector
@@ -16,9 +25,18 @@ fast_suite = [
 
 checks = [
     test_session,
+    test_codec,
+    test_archive,
     test_event,
     test_job,
+    test_channel,
+    test_retry,
+    test_ratelimit,
+    test_breaker,
     test_queue,
+    test_worker,
+    test_claim,
+    test_process,
     test_backend,
     test_producer,
     test_connector,
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import unittest2
+
+from ..queue.archive import JobArchive
+
+
+class test_archive(unittest2.TestCase):
+    """ Test the archive files of the jobs """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.archive = JobArchive(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _job(self, uuid, func_name, date_done):
+        return {'uuid': uuid,
+                'func_name': func_name,
+                'func_string': u"%s('res.partner', 1)" % func_name,
+                'date_created': date_done,
+                'date_done': date_done,
+                'result': u'ßø'}
+
+    def test_write_search(self):
+        self.archive.write([self._job('a', 'mod.export', '2014-01-01 10:00'),
+                            self._job('b', 'mod.import', '2014-01-01 11:00'),
+                            self._job('c', 'mod.export', '2014-01-02 10:00')])
+        # appending to a file of a day adds a gzip member
+        self.archive.write([self._job('d', 'mod.export', '2014-01-02 12:00')])
+        self.assertEqual(self.archive.days(), ['2014-01-01', '2014-01-02'])
+        found = list(self.archive.search(uuid='d'))
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0]['result'], u'ßø')
+        found = self.archive.search(func_name='mod.export')
+        self.assertEqual([job['uuid'] for job in found], ['a', 'c', 'd'])
+        found = self.archive.search(func_name='mod.export',
+                                    date_from='2014-01-02')
+        self.assertEqual([job['uuid'] for job in found], ['c', 'd'])
+        found = self.archive.search(func_name='mod.export',
+                                    date_to='2014-01-01 23:59')
+        self.assertEqual([job['uuid'] for job in found], ['a'])
+
+    def test_empty(self):
+        self.assertEqual(list(self.archive.search(uuid='a')), [])
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import unittest2
+from datetime import datetime, timedelta
+
+from ..queue.breaker import CircuitBreaker, CircuitBreakers, OPEN, HALF_OPEN
+from ..queue.job import Job, job
+from ..queue.queue import JobsQueue
+
+
+@job(circuit_breaker=CircuitBreaker(failures=2, reset_timeout=60))
+def backend_task(session, model_name, backend_id):
+    pass
+
+
+@job(circuit_breaker=CircuitBreaker(failures=2, reset_timeout=60),
+     batchable=True)
+def batch_backend_task(session, model_name, backend_id):
+    pass
+
+
+def plain_task(session, model_name, backend_id):
+    pass
+
+
+class test_circuit_breakers(unittest2.TestCase):
+    """ Test the states of the circuits """
+
+    def setUp(self):
+        self.breakers = CircuitBreakers()
+        self.job1 = Job(backend_task, model_name='a.backend', args=(1,))
+        self.job2 = Job(backend_task, model_name='a.backend', args=(1,))
+        self.other = Job(backend_task, model_name='a.backend', args=(2,))
+
+    def test_key(self):
+        self.assertEqual(self.job1.circuit_key, u'a.backend,1')
+        self.assertIsNone(Job(plain_task, model_name='a.backend',
+                              args=(1,)).circuit_key)
+
+    def test_open(self):
+        """ Consecutive failures open the circuit of the key """
+        self.assertIsNone(self.breakers.failure(self.job1, 0))
+        self.breakers.success(self.job2)
+        self.assertIsNone(self.breakers.failure(self.job1, 1))
+        circuit = self.breakers.failure(self.job2, 2)
+        self.assertEqual(circuit.state, OPEN)
+        self.assertFalse(self.breakers.can_start(self.job1, 3))
+        self.assertEqual(self.breakers.wait_time(self.job1, 12), 50)
+        self.assertTrue(self.breakers.can_start(self.other, 3))
+
+    def test_dropped(self):
+        """ A circuit is kept from the first failure of its key until it
+        is closed again """
+        self.assertTrue(self.breakers.can_start(self.job1, 0))
+        self.assertTrue(self.breakers.is_closed(self.job1, 0))
+        self.assertEqual(self.breakers.wait_time(self.job1, 0), 0)
+        self.breakers.start(self.job1, 0)
+        self.breakers.done(self.job1)
+        self.assertIsNone(self.breakers.circuit(self.job1))
+        self.breakers.failure(self.job1, 0)
+        self.assertEqual(self.breakers.circuit(self.job1).failures, 1)
+        self.breakers.success(self.job2)
+        self.assertIsNone(self.breakers.circuit(self.job1))
+        self.assertEqual(self.breakers._circuits, {})
+
+    def test_probe(self):
+        """ A single probe runs when the circuit is half-open """
+        self.breakers.failure(self.job1, 0)
+        self.breakers.failure(self.job1, 0)
+        self.assertTrue(self.breakers.can_start(self.job1, 60))
+        self.breakers.start(self.job1, 60)
+        self.assertEqual(self.breakers.circuit(self.job1).state, HALF_OPEN)
+        self.assertFalse(self.breakers.can_start(self.job2, 61))
+        self.assertIsNone(self.breakers.wait_time(self.job2, 61))
+        # the failure of the probe opens the circuit again
+        self.assertTrue(self.breakers.failure(self.job1, 62))
+        self.assertFalse(self.breakers.can_start(self.job2, 63))
+        self.breakers.start(self.job2, 122)
+        self.breakers.success(self.job2)
+        self.assertTrue(self.breakers.can_start(self.job1, 123))
+        self.assertTrue(self.breakers.can_start(self.job2, 123))
+
+    def test_probe_without_result(self):
+        """ A probe done without result lets another job probe """
+        self.breakers.failure(self.job1, 0)
+        self.breakers.failure(self.job1, 0)
+        self.breakers.start(self.job1, 60)
+        self.assertFalse(self.breakers.can_start(self.job2, 61))
+        self.breakers.done(self.job1)
+        self.assertTrue(self.breakers.can_start(self.job2, 61))
+
+
+class test_queue_circuit(unittest2.TestCase):
+    """ Test the circuit breakers in the queue """
+
+    def setUp(self):
+        self.queue = JobsQueue()
+
+    def test_open_circuit(self):
+        """ The ready jobs of an open circuit are delayed at once, the
+        others are dequeued """
+        failed = Job(backend_task, model_name='a.backend', args=(1,))
+        waiting = [Job(backend_task, model_name='a.backend', args=(1,),
+                       priority=priority) for priority in (1, 2)]
+        other = Job(backend_task, model_name='a.backend', args=(2,),
+                    priority=3)
+        self.queue.enqueue_many(waiting + [other])
+        self.assertIsNone(self.queue.circuit_failure(failed))
+        until = self.queue.circuit_failure(failed)
+        self.assertAlmostEqual(until, datetime.now() + timedelta(seconds=60),
+                               delta=timedelta(seconds=5))
+        for delayed in waiting:
+            self.assertEqual(delayed.eta, until)
+        self.assertEqual(self.queue.dequeue(timeout=0.01), other)
+        self.assertIsNone(self.queue.dequeue(timeout=0.01))
+        self.assertEqual(self.queue.waiting_count(), 2)
+
+    def test_probe(self):
+        """ In a half-open circuit, one job is dequeued at a time until
+        the probe succeeds """
+        failed = Job(backend_task, model_name='a.backend', args=(1,))
+        self.queue.circuit_failure(failed)
+        self.queue.circuit_failure(failed)
+        circuit = self.queue.breakers.circuit(failed)
+        circuit.opened_at -= 60
+        jobs = [Job(backend_task, model_name='a.backend', args=(1,))
+                for __ in range(3)]
+        self.queue.enqueue_many(jobs)
+        probe = self.queue.dequeue(timeout=0.01)
+        self.assertEqual(probe, jobs[0])
+        self.assertIsNone(self.queue.dequeue(timeout=0.01))
+        self.queue.circuit_success(probe)
+        self.queue.done(probe)
+        self.assertEqual(self.queue.dequeue(timeout=0.01), jobs[1])
+        self.assertEqual(self.queue.dequeue(timeout=0.01), jobs[2])
+
+    def test_batch_probe(self):
+        """ Only the first job of a batch can be the probe of a half-open
+        circuit, the probe is released when the batch is done """
+        failed = Job(batch_backend_task, model_name='a.backend', args=(1,))
+        self.queue.circuit_failure(failed)
+        self.queue.circuit_failure(failed)
+        circuit = self.queue.breakers.circuit(failed)
+        circuit.opened_at -= 60
+        jobs = [Job(batch_backend_task, model_name='a.backend', args=(1,))
+                for __ in range(3)]
+        self.queue.enqueue_many(jobs)
+        probe = self.queue.dequeue(timeout=0.01)
+        self.assertEqual(circuit.probe, probe.uuid)
+        self.assertEqual(self.queue.dequeue_batch(probe, 2), [])
+        # the batch ends without result for the probe
+        self.queue.done(probe)
+        self.assertIsNone(circuit.probe)
+        self.assertIsNotNone(self.queue.dequeue(timeout=0.01))
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import unittest2
+
+from ..queue.channel import ChannelTree, parse_channels, is_channel_name
+
+
+class test_channel(unittest2.TestCase):
+    """ Test the configuration of the channels """
+
+    def test_channel_name(self):
+        self.assertTrue(is_channel_name('root'))
+        self.assertTrue(is_channel_name('root.images'))
+        self.assertFalse(is_channel_name('images'))
+        self.assertFalse(is_channel_name('root..images'))
+
+    def test_parse(self):
+        self.assertEqual(
+            parse_channels('root:4, root.images:1,root.import:2:process,'
+                           'root.export'),
+            [('root', 4, None),
+             ('root.images', 1, None),
+             ('root.import', 2, 'process'),
+             ('root.export', None, None)])
+        self.assertEqual(parse_channels(None), [])
+        with self.assertRaises(ValueError):
+            parse_channels('images:1')
+        with self.assertRaises(ValueError):
+            parse_channels('root:one')
+        with self.assertRaises(ValueError):
+            parse_channels('root.cpu:2:proces')
+
+    def test_tree(self):
+        tree = ChannelTree('root.images.small:1,root.images:2',
+                           root_capacity=3)
+        root = tree.get('root')
+        self.assertEqual(root.capacity, 3)
+        images = tree.get('root.images')
+        self.assertIs(images.parent, root)
+        self.assertIs(tree.get('root.images.small').parent, images)
+        # not configured: nearest configured parent
+        self.assertIs(tree.get('root.images.big'), images)
+        self.assertIs(tree.get('root.orders'), root)
+
+    def test_capacity(self):
+        """ A job running in a subchannel counts in its parents """
+        tree = ChannelTree('root.images:1,root.orders', root_capacity=2)
+        images = tree.get('root.images')
+        orders = tree.get('root.orders')
+        images.start()
+        self.assertFalse(images.has_capacity())
+        self.assertTrue(orders.has_capacity())
+        orders.start()
+        self.assertFalse(orders.has_capacity())
+        images.stop()
+        self.assertTrue(orders.has_capacity())
+        self.assertEqual(tree.get('root').running, 1)
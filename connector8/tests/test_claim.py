@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+import unittest2
+import uuid
+from datetime import datetime, timedelta
+
+import openerp
+from openerp import SUPERUSER_ID
+import openerp.tests.common as common
+from ..queue.job import Job, OdooJobStorage, job
+from ..queue.worker import QUEUE_LEAD
+from ..session import ConnectorSession
+
+_logger = logging.getLogger(__name__)
+
+CLAIMERS = 4
+JOBS = 2000
+CLAIM_SIZE = 20
+
+
+@job
+def claimed_task(session, model_name, value):
+    pass
+
+
+class test_claim_jobs(common.TransactionCase):
+    """ Stress test of the claim of the jobs by concurrent workers
+
+    The jobs and workers are committed, each claimer uses its own
+    connection.
+    """
+
+    def setUp(self):
+        super(test_claim_jobs, self).setUp()
+        if self.cr._cnx.server_version < 90500:
+            raise unittest2.SkipTest('SKIP LOCKED needs PostgreSQL 9.5')
+        self.worker_model = self.registry('queue.worker')
+        self.worker_ids = []
+        with self.registry.cursor() as cr:
+            for __ in range(CLAIMERS):
+                self.worker_ids.append(self.worker_model.create(
+                    cr, SUPERUSER_ID, {'uuid': unicode(uuid.uuid4())}))
+            session = ConnectorSession(cr, SUPERUSER_ID)
+            self.job_uuids = OdooJobStorage(session).enqueue_many(
+                claimed_task, [(value,) for value in range(JOBS)],
+                model_name='res.users')
+        self.addCleanup(self._cleanup)
+
+    def _cleanup(self):
+        with self.registry.cursor() as cr:
+            cr.execute("DELETE FROM queue_job WHERE uuid IN %s",
+                       (tuple(self.job_uuids),))
+            cr.execute("DELETE FROM queue_worker WHERE id IN %s",
+                       (tuple(self.worker_ids),))
+
+    def _claim(self, worker_id, claimed):
+        with openerp.api.Environment.manage():
+            while True:
+                with self.registry.cursor() as cr:
+                    job_ids = self.worker_model._claim_jobs(
+                        cr, worker_id, limit=CLAIM_SIZE)
+                if not job_ids:
+                    # a claim conflicting with a concurrent one returns
+                    # nothing, stop only when nothing is left
+                    with self.registry.cursor() as cr:
+                        cr.execute("SELECT 1 FROM queue_job "
+                                   "WHERE uuid IN %s "
+                                   "AND worker_id IS NULL LIMIT 1",
+                                   (tuple(self.job_uuids),))
+                        if not cr.fetchone():
+                            return
+                claimed[worker_id].extend(job_ids)
+
+    def test_concurrent_claims(self):
+        """ Concurrent claimers get all the jobs, each job only once """
+        claimed = dict((worker_id, []) for worker_id in self.worker_ids)
+        threads = [threading.Thread(target=self._claim,
+                                    args=(worker_id, claimed))
+                   for worker_id in self.worker_ids]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+        all_claimed = [job_id for job_ids in claimed.itervalues()
+                       for job_id in job_ids]
+        _logger.info('%d jobs claimed by %d claimers in %.2fs '
+                     '(%d jobs/s), per claimer: %s',
+                     len(all_claimed), CLAIMERS, duration,
+                     len(all_claimed) / max(duration, 0.001),
+                     [len(job_ids) for job_ids in claimed.itervalues()])
+        self.assertEqual(len(all_claimed), JOBS)
+        self.assertEqual(len(set(all_claimed)), JOBS)
+        with self.registry.cursor() as cr:
+            cr.execute("SELECT worker_id, array_agg(id) FROM queue_job "
+                       "WHERE uuid IN %s GROUP BY worker_id",
+                       (tuple(self.job_uuids),))
+            stored = dict((worker_id, sorted(job_ids))
+                          for worker_id, job_ids in cr.fetchall())
+        self.assertEqual(stored, dict((worker_id, sorted(job_ids))
+                                      for worker_id, job_ids
+                                      in claimed.iteritems()
+                                      if job_ids))
+
+
+class test_claim_ready(common.TransactionCase):
+    """ Only the ready jobs and the jobs close to their eta are claimed """
+
+    def setUp(self):
+        super(test_claim_ready, self).setUp()
+        if self.cr._cnx.server_version < 90500:
+            raise unittest2.SkipTest('SKIP LOCKED needs PostgreSQL 9.5')
+        self.cr.execute('DELETE FROM queue_job')
+        self.worker_id = self.registry('queue.worker').create(
+            self.cr, self.uid, {'uuid': unicode(uuid.uuid4())})
+
+    def test_ready(self):
+        """ A delayed job is not claimed before its eta, whatever its
+        priority """
+        storage = OdooJobStorage(ConnectorSession(self.cr, self.uid))
+        delayed = Job(func=claimed_task, model_name='res.users', args=(1,),
+                      priority=1, eta=timedelta(hours=1))
+        ready = Job(func=claimed_task, model_name='res.users', args=(2,),
+                    priority=20)
+        reached = Job(func=claimed_task, model_name='res.users', args=(3,),
+                      priority=10,
+                      eta=datetime.now() - timedelta(minutes=1))
+        for job_ in (delayed, ready, reached):
+            storage.store(job_)
+        job_ids = self.registry('queue.worker')._claim_jobs(
+            self.cr, self.worker_id, limit=1)
+        self.cr.execute("SELECT uuid FROM queue_job WHERE id IN %s",
+                        (tuple(job_ids),))
+        self.assertEqual([row[0] for row in self.cr.fetchall()],
+                         [reached.uuid])
+        job_ids = self.registry('queue.worker')._claim_jobs(
+            self.cr, self.worker_id, limit=10)
+        self.cr.execute("SELECT uuid FROM queue_job WHERE id IN %s",
+                        (tuple(job_ids),))
+        self.assertEqual([row[0] for row in self.cr.fetchall()],
+                         [ready.uuid])
+
+    def test_near_eta(self):
+        """ A job is claimed ahead of its eta, the next eta of the jobs
+        left unclaimed is known """
+        storage = OdooJobStorage(ConnectorSession(self.cr, self.uid))
+        near = Job(func=claimed_task, model_name='res.users', args=(1,),
+                   eta=timedelta(seconds=QUEUE_LEAD // 2))
+        delayed = Job(func=claimed_task, model_name='res.users', args=(2,),
+                      eta=timedelta(hours=1))
+        for job_ in (near, delayed):
+            storage.store(job_)
+        worker_model = self.registry('queue.worker')
+        job_ids = worker_model._claim_jobs(self.cr, self.worker_id,
+                                           limit=10)
+        self.cr.execute("SELECT uuid FROM queue_job WHERE id IN %s",
+                        (tuple(job_ids),))
+        self.assertEqual([row[0] for row in self.cr.fetchall()],
+                         [near.uuid])
+        self.assertEqual(worker_model._next_eta(self.cr),
+                         delayed.eta.replace(microsecond=0))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import timeit
+import unittest2
+from cPickle import dumps
+
+from ..queue import codec
+from ..queue.codec import (encode_payload,
+                           decode_payload,
+                           plain_codec,
+                           compress_codec,
+                           COMPRESS_THRESHOLD)
+
+_logger = logging.getLogger(__name__)
+
+
+def small_payload():
+    return ('openerp.addons.connector8.tests.test_codec.task',
+            ('res.partner', 42),
+            {'fields': ['name', 'email']})
+
+
+def large_payload():
+    return ('openerp.addons.connector8.tests.test_codec.task',
+            ('product.product', range(20000)),
+            {})
+
+
+class test_codec(unittest2.TestCase):
+    """ Test the codecs of the job payloads """
+
+    def test_plain(self):
+        payload = small_payload()
+        data = encode_payload(payload)
+        self.assertEqual(data[:1], plain_codec.version)
+        self.assertEqual(decode_payload(data), payload)
+
+    def test_compressed(self):
+        payload = large_payload()
+        data = encode_payload(payload)
+        self.assertEqual(data[:1], compress_codec.version)
+        self.assertEqual(decode_payload(data), payload)
+
+    def test_explicit_codec(self):
+        payload = small_payload()
+        zlib_codec = codec.ZlibPickleCodec()
+        data = encode_payload(payload, codec=zlib_codec)
+        self.assertEqual(data[:1], zlib_codec.version)
+        self.assertEqual(decode_payload(data), payload)
+
+    def test_legacy(self):
+        """ Payloads stored before the codecs are raw pickles """
+        payload = small_payload()
+        self.assertEqual(decode_payload(dumps(payload)), payload)
+
+    def test_threshold(self):
+        self.assertLessEqual(len(encode_payload(small_payload())),
+                             COMPRESS_THRESHOLD + 1)
+
+    def test_benchmark(self):
+        """ Encode/decode throughput and bytes stored per job,
+        compared with the legacy pickle """
+        number = 20
+        for name, payload in (('small', small_payload()),
+                              ('large', large_payload())):
+            legacy = dumps(payload)
+            encoded = encode_payload(payload)
+            legacy_encode = timeit.timeit(lambda: dumps(payload),
+                                          number=number)
+            encode = timeit.timeit(lambda: encode_payload(payload),
+                                   number=number)
+            legacy_decode = timeit.timeit(lambda: decode_payload(legacy),
+                                          number=number)
+            decode = timeit.timeit(lambda: decode_payload(encoded),
+                                   number=number)
+            _logger.info('%s payload: legacy %d bytes, encode %.0f/s, '
+                         'decode %.0f/s; codec %d bytes, encode %.0f/s, '
+                         'decode %.0f/s',
+                         name, len(legacy),
+                         number / legacy_encode, number / legacy_decode,
+                         len(encoded),
+                         number / encode, number / decode)
+            self.assertLess(len(encoded), len(legacy))
@@ -1,25 +1,44 @@
 # -*- coding: utf-8 -*-
 
+import logging
 import mock
+import shutil
+import tempfile
 import unittest2
 from datetime import datetime, timedelta
 
 import openerp
 from openerp import SUPERUSER_ID
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 import openerp.tests.common as common
 from ..queue.job import (
+    DONE,
+    ENQUEUED,
+    FAILED,
+    COALESCE_MAX_WINDOWS,
+    IDENTITY_LOCK,
+    PENDING,
+    STARTED,
     Job,
+    JobHandle,
     OdooJobStorage,
     job,
+    identity_exact,
+    _merge_kwargs,
+    perform_batch,
 )
+from ..queue.archive import JobArchive
 from ..session import (
     ConnectorSession,
 )
 from ..exception import (
     RetryableJobError,
-    FailedJobError
+    FailedJobError,
+    NoSuchJobError,
 )
 
+_logger = logging.getLogger(__name__)
+
 
 def task_b(session, model_name):
     pass
@@ -39,6 +58,20 @@ def dummy_task_args(session, model_name, a, b, c=None):
     return a + b + c
 
 
+@job
+def coalesced_task(session, model_name, a, b):
+    pass
+
+
+@job(default_channel='root.images')
+def channel_task(session, model_name):
+    pass
+
+
+def invalid_channel_task(session, model_name):
+    pass
+
+
 def retryable_error_task(session):
     raise RetryableJobError
 
@@ -101,6 +134,32 @@ class test_job(unittest2.TestCase):
         job_a = Job(func=task_a, description=description)
         self.assertEqual(job_a.description, description)
 
+    def test_channel(self):
+        """ The channel is the one given, the default channel of the
+        function or root """
+        self.assertEqual(Job(func=task_a).channel, 'root')
+        self.assertEqual(Job(func=channel_task).channel, 'root.images')
+        self.assertEqual(Job(func=channel_task, channel='root.orders').channel,
+                         'root.orders')
+        with self.assertRaises(AssertionError):
+            job(invalid_channel_task, default_channel='images')
+
+    def test_handle(self):
+        """ The handle keeps what the queue needs to sort the job """
+        job_a = Job(func=task_a, priority=5, channel='root.a',
+                    eta=timedelta(hours=1))
+        job_a.user_id = 4
+        handle = JobHandle.from_job(job_a)
+        self.assertEqual(handle.uuid, job_a.uuid)
+        self.assertEqual(handle.func, task_a)
+        self.assertEqual(handle.priority, 5)
+        self.assertEqual(handle.eta, job_a.eta)
+        self.assertEqual(handle.date_created, job_a.date_created)
+        self.assertEqual(handle.channel, 'root.a')
+        self.assertEqual(handle.user_id, 4)
+        self.assertEqual(handle.batch_size, 1)
+        self.assertFalse(hasattr(handle, '__dict__'))
+
     def test_retryable_error(self):
         job = Job(func=retryable_error_task,
                   max_retries=3)
@@ -112,6 +171,82 @@ class test_job(unittest2.TestCase):
             job.perform(self.session)
 
 
+def batch_handler(session, jobs_arguments):
+    results = []
+    for args, kwargs in jobs_arguments:
+        if args[1] == 'retry':
+            results.append(RetryableJobError('retry'))
+        elif args[1] == 'fail':
+            results.append(ValueError('fail'))
+        else:
+            results.append(args[1])
+    return results
+
+
+def batch_task(session, model_name, value):
+    if value == 'fail':
+        raise ValueError('fail')
+    return value
+
+
+class test_job_batch(unittest2.TestCase):
+    """ Test the execution of jobs in batch """
+
+    def setUp(self):
+        self.session = mock.MagicMock()
+
+    def test_not_batchable(self):
+        job(task_a)
+        self.assertEqual(Job(func=task_a).batch_size, 1)
+
+    def test_perform_batch(self):
+        job(batch_task, batch=batch_handler, batch_size=10)
+        jobs = [Job(func=batch_task, model_name='res.users', args=(value,),
+                    max_retries=1)
+                for value in ('ok', 'retry', 'fail')]
+        self.assertEqual(jobs[0].batch_size, 10)
+        outcomes = perform_batch(self.session, jobs)
+        self.assertEqual(outcomes[0], 'ok')
+        self.assertEqual(jobs[0].result, 'ok')
+        # max. retries is 1, so the retryable error is a failure
+        self.assertIsInstance(outcomes[1], FailedJobError)
+        self.assertIsInstance(outcomes[2], ValueError)
+        self.assertEqual([batch_job.retry for batch_job in jobs], [1, 1, 1])
+
+    def test_perform_batch_one_by_one(self):
+        job(batch_task, batchable=True)
+        jobs = [Job(func=batch_task, model_name='res.users', args=(value,))
+                for value in ('ok', 'fail')]
+        outcomes = perform_batch(self.session, jobs)
+        self.assertEqual(outcomes[0], 'ok')
+        self.assertIsInstance(outcomes[1], ValueError)
+
+
+class test_merge_kwargs(unittest2.TestCase):
+    """ Test the merge of the keyword arguments of coalesced jobs """
+
+    def test_union(self):
+        merged = _merge_kwargs({'fields': ['name'], 'a': 1},
+                               {'fields': ['email', 'name'], 'a': 2})
+        self.assertEqual(merged, {'fields': ['name', 'email'], 'a': 2})
+
+    def test_all_fields(self):
+        merged = _merge_kwargs({'fields': None}, {'fields': ['name']})
+        self.assertEqual(merged, {'fields': None})
+        merged = _merge_kwargs({'fields': ['name']}, {'fields': None})
+        self.assertEqual(merged, {'fields': None})
+
+    def test_new_key(self):
+        merged = _merge_kwargs({}, {'fields': None})
+        self.assertEqual(merged, {'fields': None})
+
+    def test_scalar(self):
+        """ A None scalar is replaced like the other values """
+        merged = _merge_kwargs({'force': None, 'lang': 'fr_FR'},
+                               {'force': True, 'lang': None})
+        self.assertEqual(merged, {'force': True, 'lang': None})
+
+
 class test_job_storage(common.TransactionCase):
     """ Test storage of jobs """
 
@@ -170,6 +305,163 @@ class test_job_storage(common.TransactionCase):
         self.assertAlmostEqual(job.eta, job_read.eta,
                                delta=delta)
 
+    def test_func_name(self):
+        """ The name of the function is stored on the job """
+        storage = OdooJobStorage(self.session)
+        job_a = Job(func=task_a)
+        storage.store(job_a)
+        job_id = storage._odoo_id(job_a.uuid)
+        record = self.queue_job.browse(self.cr, self.uid, job_id)
+        self.assertEqual(record.func_name, job_a.func_name)
+
+    def test_load_many(self):
+        storage = OdooJobStorage(self.session)
+        job_a = Job(func=task_a)
+        job_b = Job(func=dummy_task_args,
+                    model_name='res.users',
+                    args=('o', 'k'),
+                    kwargs={'c': '!'})
+        storage.store(job_a)
+        storage.store(job_b)
+        count = self.cr.sql_log_count
+        jobs = storage.load_many([job_b.uuid, 'missing', job_a.uuid])
+        self.assertEqual(self.cr.sql_log_count - count, 1)
+        self.assertEqual([job.uuid for job in jobs], [job_b.uuid, job_a.uuid])
+        self.assertEqual(jobs[0].args, job_b.args)
+        self.assertEqual(jobs[0].kwargs, job_b.kwargs)
+        self.assertEqual(jobs[1].func, task_a)
+        self.assertIsNone(jobs[1].worker_uuid)
+
+    def test_set_enqueued_many(self):
+        """ The pending jobs of the worker are enqueued in 1 query which
+        returns their handles """
+        worker_uuid = 'test-worker-uuid'
+        self.registry('queue.worker').create(self.cr, self.uid,
+                                             {'uuid': worker_uuid})
+        storage = OdooJobStorage(self.session)
+        jobs = [Job(func=task_a, priority=priority, channel='root.a')
+                for priority in (5, 15, 10)]
+        for job_ in jobs:
+            job_.worker_uuid = worker_uuid
+        jobs[2].state = DONE
+        other = Job(func=task_a)
+        for job_ in jobs + [other]:
+            storage.store(job_)
+        count = self.cr.sql_log_count
+        handles = storage.set_enqueued_many(
+            [job_.uuid for job_ in jobs + [other]], worker_uuid)
+        self.assertEqual(self.cr.sql_log_count - count, 1)
+        self.assertEqual([handle.uuid for handle in handles],
+                         [jobs[0].uuid, jobs[1].uuid])
+        for handle, job_ in zip(handles, jobs):
+            self.assertIsInstance(handle, JobHandle)
+            self.assertEqual(handle.func_name, job_.func_name)
+            self.assertEqual(handle.priority, job_.priority)
+            self.assertEqual(handle.channel, 'root.a')
+            self.assertEqual(handle.user_id, self.uid)
+            loaded = storage.load(handle.uuid)
+            self.assertEqual(loaded.state, ENQUEUED)
+            self.assertEqual(loaded.worker_uuid, worker_uuid)
+            self.assertTrue(loaded.date_enqueued)
+        self.assertEqual(storage.load(other.uuid).state, PENDING)
+
+    def test_requeue_started(self):
+        """ Only the jobs still started by the worker are enqueued """
+        worker_uuid = 'test-worker-uuid'
+        self.registry('queue.worker').create(self.cr, self.uid,
+                                             {'uuid': worker_uuid})
+        storage = OdooJobStorage(self.session)
+        jobs = [Job(func=task_a) for __ in range(3)]
+        for job_ in jobs:
+            job_.worker_uuid = worker_uuid
+            job_.state = STARTED
+        jobs[1].state = DONE
+        jobs[2].worker_uuid = None
+        for job_ in jobs:
+            storage.store(job_)
+        self.assertEqual(
+            storage.requeue_started([job_.uuid for job_ in jobs],
+                                    worker_uuid),
+            [jobs[0].uuid])
+        self.assertEqual(storage.load(jobs[0].uuid).state, ENQUEUED)
+        self.assertEqual(storage.load(jobs[1].uuid).state, DONE)
+        self.assertEqual(storage.load(jobs[2].uuid).state, STARTED)
+
+    def test_rate_limit_key(self):
+        """ The key of the rate limit is stored and kept in the handle """
+        worker_uuid = 'test-worker-uuid'
+        self.registry('queue.worker').create(self.cr, self.uid,
+                                             {'uuid': worker_uuid})
+        storage = OdooJobStorage(self.session)
+        job_ = Job(func=task_a, rate_limit_key=u'a.backend,1')
+        job_.worker_uuid = worker_uuid
+        storage.store(job_)
+        self.assertEqual(storage.load(job_.uuid).rate_limit_key,
+                         u'a.backend,1')
+        handle, = storage.set_enqueued_many([job_.uuid], worker_uuid)
+        self.assertEqual(handle.rate_limit_key, u'a.backend,1')
+
+    def test_postpone_circuit(self):
+        """ The waiting jobs of the circuit are postponed at once """
+        storage = OdooJobStorage(self.session)
+        eta = datetime.now().replace(microsecond=0) + timedelta(minutes=1)
+        jobs = [Job(func=task_a, circuit_key=key)
+                for key in (u'a.backend,1', u'a.backend,1', u'a.backend,2')]
+        jobs[1].state = DONE
+        for job_ in jobs:
+            storage.store(job_)
+        self.assertEqual(storage.postpone_circuit(u'a.backend,1', eta), 1)
+        self.assertEqual(storage.load(jobs[0].uuid).eta, eta)
+        self.assertIsNone(storage.load(jobs[1].uuid).eta)
+        self.assertIsNone(storage.load(jobs[2].uuid).eta)
+        self.assertEqual(storage.load(jobs[0].uuid).retry, 0)
+
+    def test_release_many(self):
+        """ The released jobs are no longer assigned to the worker """
+        worker_uuid = 'test-worker-uuid'
+        self.registry('queue.worker').create(self.cr, self.uid,
+                                             {'uuid': worker_uuid})
+        storage = OdooJobStorage(self.session)
+        jobs = [Job(func=task_a) for __ in range(2)]
+        for job_ in jobs:
+            job_.worker_uuid = worker_uuid
+            storage.store(job_)
+        storage.release_many([jobs[0].uuid], worker_uuid)
+        self.assertIsNone(storage.load(jobs[0].uuid).worker_uuid)
+        self.assertEqual(storage.load(jobs[1].uuid).worker_uuid,
+                         worker_uuid)
+
+    def test_release_many_enqueued(self):
+        """ The released enqueued jobs are pending again """
+        worker_uuid = 'test-worker-uuid'
+        self.registry('queue.worker').create(self.cr, self.uid,
+                                             {'uuid': worker_uuid})
+        storage = OdooJobStorage(self.session)
+        job_ = Job(func=task_a)
+        job_.state = ENQUEUED
+        job_.worker_uuid = worker_uuid
+        storage.store(job_)
+        storage.release_many([job_.uuid], worker_uuid)
+        self.assertEqual(storage.load(job_.uuid).state, ENQUEUED)
+        storage.release_many([job_.uuid], worker_uuid, state=ENQUEUED)
+        job_ = storage.load(job_.uuid)
+        self.assertEqual(job_.state, PENDING)
+        self.assertIsNone(job_.worker_uuid)
+
+    def test_set_failed_unreadable(self):
+        storage = OdooJobStorage(self.session)
+        job = Job(func=task_a)
+        storage.store(job)
+        storage.set_failed_unreadable(job.uuid, 'Traceback')
+        job = storage.load(job.uuid)
+        self.assertEqual(job.state, FAILED)
+        self.assertEqual(job.exc_info, 'Traceback')
+
+    def test_load_missing(self):
+        storage = OdooJobStorage(self.session)
+        with self.assertRaises(NoSuchJobError):
+            storage.load('missing')
+
     def test_unicode(self):
         job = Job(func=dummy_task_args,
                   model_name='res.users',
@@ -228,6 +520,251 @@ class test_job_storage(common.TransactionCase):
         stored = self.queue_job.search(self.cr, self.uid, [])
         self.assertEqual(len(stored), 1)
 
+    def test_job_delay_identity_key(self):
+        self.cr.execute('delete from queue_job')
+        job(dummy_task_args)
+        job_uuid = dummy_task_args.delay(self.session, 'res.users', 'o', 'k',
+                                         c='!', identity_key=identity_exact)
+        same_uuid = dummy_task_args.delay(self.session, 'res.users', 'o',
+                                          'k', c='!',
+                                          identity_key=identity_exact)
+        other_uuid = dummy_task_args.delay(self.session, 'res.users', 'o',
+                                           'k', c='?',
+                                           identity_key=identity_exact)
+        self.assertEqual(job_uuid, same_uuid)
+        self.assertNotEqual(job_uuid, other_uuid)
+        stored = self.queue_job.search(self.cr, self.uid, [])
+        self.assertEqual(len(stored), 2)
+        # a done job does not prevent to create a new one
+        storage = OdooJobStorage(self.session)
+        job_read = storage.load(job_uuid)
+        job_read.set_done()
+        storage.store(job_read)
+        new_uuid = dummy_task_args.delay(self.session, 'res.users', 'o', 'k',
+                                         c='!', identity_key=identity_exact)
+        self.assertNotEqual(job_uuid, new_uuid)
+
+    def test_job_delay_identity_lock(self):
+        """ The identity key is locked until the end of the transaction
+        so concurrent jobs with the same key are not duplicated """
+        job(dummy_task_args)
+        dummy_task_args.delay(self.session, 'res.users', 'o', 'k',
+                              c='!', identity_key='key1')
+        self.cr.execute("SELECT count(*) FROM pg_locks "
+                        "WHERE locktype = 'advisory' "
+                        "AND pid = pg_backend_pid() "
+                        "AND classid = %s AND objsubid = 2",
+                        (IDENTITY_LOCK,))
+        self.assertEqual(self.cr.fetchone()[0], 1)
+
+    def test_job_delay_many_identity_key(self):
+        self.cr.execute('delete from queue_job')
+        job(dummy_task_args)
+        job_uuid = dummy_task_args.delay(self.session, 'res.users', 'o', 'k',
+                                         c='!', identity_key='key1')
+        job_uuids = dummy_task_args.delay_many(
+            self.session, 'res.users', [('o', 'k'), ('o', 'k')], c='!',
+            identity_key=lambda job: 'key%s' % job.args[2])
+        self.assertEqual(len(job_uuids), 2)
+        self.assertNotIn(job_uuid, job_uuids)
+        self.assertEqual(job_uuids[0], job_uuids[1])
+        stored = self.queue_job.search(self.cr, self.uid, [])
+        self.assertEqual(len(stored), 2)
+
+    def test_job_delay_coalesce(self):
+        self.cr.execute('delete from queue_job')
+        job(dummy_task_args)
+        job_uuid = dummy_task_args.delay(self.session, 'res.users', 1, 'k',
+                                         c=['name'], coalesce=60)
+        same_uuid = dummy_task_args.delay(self.session, 'res.users', 1, 'k',
+                                          c=['email', 'name'], coalesce=60)
+        other_uuid = dummy_task_args.delay(self.session, 'res.users', 2, 'k',
+                                           c=['name'], coalesce=60)
+        self.assertEqual(job_uuid, same_uuid)
+        self.assertNotEqual(job_uuid, other_uuid)
+        stored = self.queue_job.search(self.cr, self.uid, [])
+        self.assertEqual(len(stored), 2)
+        job_read = OdooJobStorage(self.session).load(job_uuid)
+        self.assertEqual(job_read.kwargs, {'c': ['name', 'email']})
+        self.assertAlmostEqual(job_read.eta,
+                               datetime.now() + timedelta(seconds=60),
+                               delta=timedelta(seconds=5))
+
+    def _shift_coalesced(self, job_uuid, eta_seconds, created_seconds):
+        """ Move the eta and the creation of a stored job from now """
+        fmt = DEFAULT_SERVER_DATETIME_FORMAT
+        now = datetime.now()
+        self.cr.execute(
+            "UPDATE queue_job SET eta = %s, date_created = %s "
+            "WHERE uuid = %s",
+            ((now + timedelta(seconds=eta_seconds)).strftime(fmt),
+             (now + timedelta(seconds=created_seconds)).strftime(fmt),
+             job_uuid))
+
+    def test_job_delay_coalesce_debounce(self):
+        """ Each coalesced job pushes the eta back, up to a limit """
+        self.cr.execute('delete from queue_job')
+        storage = OdooJobStorage(self.session)
+        job_uuid = coalesced_task.delay(self.session, 'res.users', 1, 'k',
+                                        coalesce=60)
+        # 50 seconds later
+        self._shift_coalesced(job_uuid, 10, -50)
+        coalesced_task.delay(self.session, 'res.users', 1, 'k',
+                             coalesce=60)
+        self.assertAlmostEqual(storage.load(job_uuid).eta,
+                               datetime.now() + timedelta(seconds=60),
+                               delta=timedelta(seconds=5))
+        # the burst goes on since almost COALESCE_MAX_WINDOWS windows
+        max_seconds = 60 * COALESCE_MAX_WINDOWS
+        self._shift_coalesced(job_uuid, 10, 20 - max_seconds)
+        coalesced_task.delay(self.session, 'res.users', 1, 'k',
+                             coalesce=60)
+        self.assertAlmostEqual(storage.load(job_uuid).eta,
+                               datetime.now() + timedelta(seconds=20),
+                               delta=timedelta(seconds=5))
+
+    def test_job_delay_coalesce_identity(self):
+        """ A coalesced job has no identity key of its own """
+        with self.assertRaises(ValueError):
+            coalesced_task.delay(self.session, 'res.users', 1, 'k',
+                                 coalesce=60, identity_key='key')
+        with self.assertRaises(ValueError):
+            coalesced_task.delay_many(self.session, 'res.users',
+                                      [(1, 'k')], coalesce=60,
+                                      identity_key='key')
+
+    def test_job_delay_channel(self):
+        storage = OdooJobStorage(self.session)
+        job_uuid = channel_task.delay(self.session, 'res.users')
+        self.assertEqual(storage.load(job_uuid).channel, 'root.images')
+        job_uuid = channel_task.delay(self.session, 'res.users',
+                                      channel='root.orders')
+        self.assertEqual(storage.load(job_uuid).channel, 'root.orders')
+        job_uuids = channel_task.delay_many(self.session, 'res.users',
+                                            [(), ()], channel='root.orders')
+        self.assertEqual([job_read.channel for job_read
+                          in storage.load_many(job_uuids)],
+                         ['root.orders', 'root.orders'])
+
+    def test_job_delay_many(self):
+        self.cr.execute('delete from queue_job')
+        job(dummy_task_args)
+        args_list = [('o', 'k%d' % i) for i in range(5)]
+        job_uuids = dummy_task_args.delay_many(self.session, 'res.users',
+                                               args_list, c='!',
+                                               priority=15, chunk_size=2)
+        self.assertEqual(len(job_uuids), 5)
+        stored = self.queue_job.search(self.cr, self.uid, [])
+        self.assertEqual(len(stored), 5)
+        storage = OdooJobStorage(self.session)
+        for job_uuid, args in zip(job_uuids, args_list):
+            job_read = storage.load(job_uuid)
+            self.assertEqual(job_read.args, ('res.users',) + args)
+            self.assertEqual(job_read.kwargs, {'c': '!'})
+            self.assertEqual(job_read.priority, 15)
+            self.assertEqual(job_read.user_id, self.uid)
+            self.assertEqual(job_read.company_id,
+                             self.ref("base.main_company"))
+
+
+class test_job_storage_queries(common.TransactionCase):
+    """ Benchmark the number of queries needed to store a job """
+
+    def setUp(self):
+        super(test_job_storage_queries, self).setUp()
+        self.session = ConnectorSession(self.cr, self.uid)
+        self.queue_job = self.registry('queue.job')
+        self.queue_job_detail = self.registry('queue.job.detail')
+        self.storage = OdooJobStorage(self.session)
+
+    def _legacy_store(self, job):
+        """ Store a job like the storage did before the SQL upsert:
+        search the job twice then write or create through the ORM """
+        vals = self.storage._job_values(job)
+        detail_vals = self.storage._detail_values(job)
+        if self.storage.exists(job.uuid):
+            job_id = self.storage.odoo_id(job)
+            self.queue_job.write(self.cr, self.uid, job_id, vals)
+            self.queue_job_detail.write(
+                self.cr, self.uid,
+                self.queue_job_detail.search(self.cr, self.uid,
+                                             [('job_id', '=', job_id)]),
+                detail_vals)
+        else:
+            vals.update(self.storage._job_create_values(job))
+            job_id = self.queue_job.create(self.cr, SUPERUSER_ID, vals)
+            detail_vals.update(self.storage._detail_create_values(job))
+            detail_vals['job_id'] = job_id
+            self.queue_job_detail.create(self.cr, SUPERUSER_ID, detail_vals)
+
+    def _count_lifecycle_queries(self, store):
+        job = Job(func=task_a)
+        job.user_id = self.uid
+        worker = mock.Mock(uuid=None)
+        transitions = [lambda: None,
+                       lambda: job.set_enqueued(worker),
+                       job.set_started,
+                       job.set_done]
+        queries = []
+        for transition in transitions:
+            transition()
+            count = self.cr.sql_log_count
+            store(job)
+            queries.append(self.cr.sql_log_count - count)
+        return queries
+
+    def test_store_queries(self):
+        """ Each store of a job is a single query """
+        legacy = self._count_lifecycle_queries(self._legacy_store)
+        upsert = self._count_lifecycle_queries(self.storage.store)
+        _logger.info('Queries per job (create, enqueued, started, done): '
+                     'before %s (%d), after %s (%d)',
+                     legacy, sum(legacy), upsert, sum(upsert))
+        self.assertEqual(upsert, [1, 1, 1, 1])
+        self.assertLess(sum(upsert), sum(legacy))
+
+    def test_store_update(self):
+        """ Storing a job twice updates the same record """
+        job = Job(func=task_a)
+        self.storage.store(job)
+        job.set_started()
+        self.storage.store(job)
+        stored = self.queue_job.search(self.cr, self.uid,
+                                       [('uuid', '=', job.uuid)])
+        self.assertEqual(len(stored), 1)
+        record = self.queue_job.browse(self.cr, self.uid, stored[0])
+        self.assertEqual(record.state, 'started')
+        self.assertEqual(len(record.detail_ids), 1)
+
+    def test_store_cache(self):
+        """ Storing a job keeps the cache of the other records """
+        user = self.env['res.users'].browse(self.uid)
+        user.name
+        name_field = user._fields['name']
+        self.assertIn(user.id, self.env.cache[name_field])
+        self.storage.store(Job(func=task_a))
+        self.assertIn(user.id, self.env.cache[name_field])
+
+    def test_store_detail(self):
+        """ The result and the traceback are stored in the details """
+        job = Job(func=task_a)
+        self.storage.store(job)
+        job.set_failed(exc_info='Traceback')
+        self.storage.store(job)
+        stored = self.queue_job.search(self.cr, self.uid,
+                                       [('uuid', '=', job.uuid)])
+        record = self.queue_job.browse(self.cr, self.uid, stored[0])
+        self.assertEqual(record.exc_info, 'Traceback')
+        self.assertEqual(record.func_string, job.func_string)
+        found = self.queue_job.search(
+            self.cr, self.uid, [('func_string', '=', job.func_string)])
+        self.assertIn(stored[0], found)
+        job.set_done(result='ok')
+        self.storage.store(job)
+        record.refresh()
+        self.assertFalse(record.exc_info)
+        self.assertEqual(record.result, 'ok')
+
 
 class test_job_storage_multi_company(common.TransactionCase):
     """ Test storage of jobs """
@@ -363,3 +900,70 @@ class test_job_storage_multi_company(common.TransactionCase):
         followers_id = [f.id for f in stored_brw.message_follower_ids]
         self.assertIn(self.other_partner_id_a, followers_id)
         self.assertNotIn(self.other_partner_id_b, followers_id)
+
+
+class test_autovacuum(common.TransactionCase):
+    """ Test the deletion of the old jobs """
+
+    def setUp(self):
+        super(test_autovacuum, self).setUp()
+        self.session = ConnectorSession(self.cr, self.uid)
+        self.queue_job = self.registry('queue.job')
+        self.storage = OdooJobStorage(self.session)
+        self.cr.execute('delete from queue_job')
+
+    def _create_job(self, func, state, days):
+        job = Job(func=func)
+        job.date_created = datetime.now() - timedelta(days=days)
+        if state == 'done':
+            job.set_done()
+            job.date_done = job.date_created
+        elif state == 'failed':
+            job.set_failed(exc_info='Traceback')
+        self.storage.store(job)
+        return job.uuid
+
+    def _remaining(self):
+        job_ids = self.queue_job.search(self.cr, self.uid, [],
+                                        context={'active_test': False})
+        return set(job['uuid'] for job in
+                   self.queue_job.read(self.cr, self.uid, job_ids, ['uuid']))
+
+    def test_autovacuum(self):
+        old_done = [self._create_job(task_a, 'done', 40) for __ in range(3)]
+        recent_done = self._create_job(task_a, 'done', 10)
+        old_failed = self._create_job(task_a, 'failed', 100)
+        old_failed_b = self._create_job(task_b, 'failed', 100)
+        recent_failed_b = self._create_job(task_b, 'failed', 40)
+        old_done_b = self._create_job(task_b, 'done', 40)
+        old_pending = self._create_job(task_a, 'pending', 100)
+        func_b = Job(func=task_b).func_name
+        policies = {'_removal_interval_by_func': {func_b: {'failed': 60,
+                                                           'done': 50}},
+                    '_removal_chunk_size': 2}
+        with mock.patch.multiple(self.queue_job, **policies):
+            with mock.patch.object(self.cr, 'commit') as commit:
+                self.queue_job.autovacuum(self.cr, self.uid)
+        self.assertEqual(commit.call_count, 3)
+        self.assertEqual(self._remaining(),
+                         set([recent_done, old_failed, recent_failed_b,
+                              old_done_b, old_pending]))
+        self.assertNotIn(old_failed_b, self._remaining())
+        self.assertFalse(set(old_done) & self._remaining())
+
+    def test_archive_done_jobs(self):
+        old_done = self._create_job(task_a, 'done', 40)
+        recent_done = self._create_job(task_a, 'done', 3)
+        path = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(JobArchive, 'for_db',
+                                   return_value=JobArchive(path)):
+                with mock.patch.object(self.cr, 'commit'):
+                    self.queue_job.archive_done_jobs(self.cr, self.uid)
+            self.assertEqual(self._remaining(), set([recent_done]))
+            archived = list(JobArchive(path).search(uuid=old_done))
+            self.assertEqual(len(archived), 1)
+            self.assertEqual(archived[0]['func_name'],
+                             Job(func=task_a).func_name)
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import sys
+import unittest2
+from cPickle import dumps, loads
+
+from ..queue.job import Job, job, THREAD, PROCESS
+from ..queue.process import ProcessPool, _Child, _perform_job
+from ..exception import FailedJobError
+
+
+@job(execution=PROCESS)
+def cpu_task(session, model_name):
+    return 'computed'
+
+
+@job
+def thread_task(session, model_name):
+    pass
+
+
+def invalid_task(session, model_name):
+    pass
+
+
+class UnpicklableError(Exception):
+
+    def __init__(self, message, data):
+        super(UnpicklableError, self).__init__(message)
+        self.data = data
+
+
+# replaces the bootstrap of the children: echoes the job uuids
+ECHO_CHILD = """
+import sys
+from cPickle import dump, load
+load(sys.stdin)
+while True:
+    try:
+        job_uuid = load(sys.stdin)
+    except EOFError:
+        break
+    if job_uuid == 'fail':
+        dump((False, ValueError('failed')), sys.stdout, 2)
+    else:
+        dump((True, job_uuid.upper()), sys.stdout, 2)
+    sys.stdout.flush()
+"""
+
+
+class EchoChild(_Child):
+
+    command = [sys.executable, '-c', ECHO_CHILD]
+
+
+class DyingChild(_Child):
+
+    command = [sys.executable, '-c', 'import sys; sys.exit(3)']
+
+
+class FakeChild(object):
+    """ Child process performing the jobs in the calling thread """
+
+    started = []
+
+    def __init__(self, db_name):
+        self.alive = True
+        self.started.append(self)
+
+    def is_alive(self):
+        return self.alive
+
+    def perform(self, job_uuid):
+        if job_uuid.startswith('fail'):
+            self.alive = False
+            raise ValueError('boom')
+        return 'computed'
+
+    def kill(self):
+        self.alive = False
+
+
+class test_process(unittest2.TestCase):
+    """ Test the execution of jobs in child processes """
+
+    def setUp(self):
+        FakeChild.started = []
+        self.pool = ProcessPool('db', 2)
+        self.pool.child_class = FakeChild
+
+    def test_execution(self):
+        self.assertEqual(Job(func=cpu_task).execution, PROCESS)
+        self.assertEqual(Job(func=thread_task).execution, THREAD)
+        with self.assertRaises(AssertionError):
+            job(invalid_task, execution='fork')
+
+    def test_perform(self):
+        """ The job is performed by a child, the worker keeps its state """
+        test_job = Job(func=cpu_task, model_name='res.users')
+        self.assertEqual(self.pool.perform(test_job), 'computed')
+        self.assertEqual(test_job.result, 'computed')
+        self.assertEqual(test_job.retry, 1)
+        # the child is kept for the next jobs
+        self.pool.perform(Job(func=cpu_task, model_name='res.users'))
+        self.assertEqual(len(FakeChild.started), 1)
+
+    def test_perform_error(self):
+        """ A child which died is replaced """
+        test_job = Job(func=cpu_task, model_name='res.users',
+                       job_uuid='fail')
+        with self.assertRaises(ValueError):
+            self.pool.perform(test_job)
+        self.assertEqual(test_job.retry, 1)
+        self.pool.perform(Job(func=cpu_task, model_name='res.users'))
+        self.assertEqual(len(FakeChild.started), 2)
+
+    def test_child_error(self):
+        """ The errors of a child are sent with their traceback """
+        handler = _perform_job.__module__ + '.ConnectorSessionHandler'
+        with mock.patch(handler) as session_hdl:
+            session_hdl.return_value.session.side_effect = (
+                UnpicklableError('not sent', lambda: None))
+            with self.assertRaises(FailedJobError) as cm:
+                _perform_job('db', 'uuid')
+        err = loads(dumps(cm.exception))
+        self.assertIn('not sent', unicode(err))
+        self.assertIn('UnpicklableError', err.child_traceback)
+
+    def test_terminate(self):
+        """ The child of a job exceeding its time limit is killed """
+        child = FakeChild('db')
+        self.pool._running['uuid'] = child
+        self.assertTrue(self.pool.terminate('uuid'))
+        self.assertFalse(child.alive)
+        self.assertFalse(self.pool.terminate('uuid'))
+
+    def test_close(self):
+        self.pool.perform(Job(func=cpu_task, model_name='res.users'))
+        self.pool.close()
+        self.assertFalse(FakeChild.started[0].alive)
+
+
+class test_child(unittest2.TestCase):
+    """ Test the exchanges with a child process """
+
+    def test_perform(self):
+        child = EchoChild('db')
+        try:
+            self.assertEqual(child.perform('abc'), 'ABC')
+            with self.assertRaises(ValueError):
+                child.perform('fail')
+            self.assertEqual(child.perform('def'), 'DEF')
+        finally:
+            child.kill()
+        self.assertFalse(child.is_alive())
+
+    def test_died(self):
+        child = DyingChild('db')
+        with self.assertRaises(FailedJobError) as cm:
+            child.perform('abc')
+        self.assertIn('exit code 3', unicode(cm.exception))
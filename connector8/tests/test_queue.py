@@ -1,16 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import threading
+import time
 import unittest2
-from datetime import timedelta
+from datetime import datetime, timedelta
 
+from ..queue.channel import ChannelTree, THREAD, PROCESS
 from ..queue.queue import JobsQueue
-from ..queue.job import Job
+from ..queue.job import Job, JobHandle, job
+from ..queue.ratelimit import RateLimit
 
 
 def dummy_task(session):
     pass
 
 
+def other_task(session):
+    pass
+
+
+@job(rate_limit=RateLimit(1, period=0.2), batchable=True)
+def limited_task(session, model_name, backend_id):
+    pass
+
+
 class test_queue(unittest2.TestCase):
     """ Test Queue """
 
@@ -19,7 +32,8 @@ class test_queue(unittest2.TestCase):
 
     def test_sort(self):
         """ Sort: the lowest priority number has the highest priority.
-        A job with a `eta` datetime is less priority in any case.
+        A job with a `eta` datetime in the future is not dequeued before
+        its `eta`, whatever its priority.
         """
         job1 = Job(dummy_task, priority=10)
         job2 = Job(dummy_task, priority=5)
@@ -29,13 +43,213 @@ class test_queue(unittest2.TestCase):
                    eta=timedelta(hours=1))
         job5 = Job(dummy_task, priority=1,
                    eta=timedelta(hours=2))
+        job6 = Job(dummy_task, priority=20,
+                   eta=datetime.now() - timedelta(hours=1))
         self.queue.enqueue(job1)
         self.queue.enqueue(job2)
         self.queue.enqueue(job3)
         self.queue.enqueue(job4)
         self.queue.enqueue(job5)
+        self.queue.enqueue(job6)
         self.assertEqual(self.queue.dequeue(), job2)
         self.assertEqual(self.queue.dequeue(), job1)
-        self.assertEqual(self.queue.dequeue(), job4)
-        self.assertEqual(self.queue.dequeue(), job3)
+        self.assertEqual(self.queue.dequeue(), job6)
+        self.assertIsNone(self.queue.dequeue(timeout=0.01))
+
+    def test_eta(self):
+        """ A delayed job is dequeued when its `eta` is reached, a
+        dequeue waits for it """
+        delayed = Job(dummy_task, priority=1,
+                      eta=datetime.now() + timedelta(milliseconds=200))
+        self.queue.enqueue(delayed)
+        self.assertIsNone(self.queue.dequeue(timeout=0.01))
+        start = time.time()
+        self.assertEqual(self.queue.dequeue(timeout=5), delayed)
+        self.assertLess(time.time() - start, 1)
+
+    def test_eta_wake_up(self):
+        """ A job enqueued while waiting for an `eta` is dequeued at
+        once """
+        delayed = Job(dummy_task, eta=timedelta(hours=1))
+        self.queue.enqueue(delayed)
+        ready = Job(dummy_task)
+        timer = threading.Timer(0.1, self.queue.enqueue, args=(ready,))
+        timer.start()
+        self.assertEqual(self.queue.dequeue(timeout=5), ready)
+        timer.join()
+
+    def test_enqueue_many(self):
+        jobs = [Job(dummy_task, priority=priority) for priority in (3, 1)]
+        delayed = Job(dummy_task, eta=timedelta(hours=1))
+        self.queue.enqueue_many(jobs + [delayed])
+        self.assertEqual(self.queue.dequeue(), jobs[1])
+        self.assertEqual(self.queue.dequeue(), jobs[0])
+        self.assertIsNone(self.queue.dequeue(timeout=0.01))
+
+    def test_dequeue_batch(self):
+        """ Take the ready jobs of the same function and user """
+        job1 = Job(dummy_task, priority=10)
+        job2 = Job(dummy_task, priority=5)
+        job3 = Job(dummy_task, priority=1)
+        job4 = Job(dummy_task, priority=1, eta=timedelta(hours=1))
+        job5 = Job(other_task, priority=1)
+        job6 = Job(dummy_task, priority=1)
+        job6.user_id = 2
+        for job_ in (job2, job3, job4, job5, job6):
+            self.queue.enqueue(job_)
+        batch = self.queue.dequeue_batch(job1, 5)
+        self.assertEqual(batch, [job3, job2])
         self.assertEqual(self.queue.dequeue(), job5)
+        self.assertEqual(self.queue.dequeue(), job6)
+        self.assertIsNone(self.queue.dequeue(timeout=0.01))
+
+    def test_dequeue_batch_limit(self):
+        jobs = [Job(dummy_task, priority=priority)
+                for priority in (3, 1, 2)]
+        for job_ in jobs:
+            self.queue.enqueue(job_)
+        batch = self.queue.dequeue_batch(jobs[0], 2)
+        self.assertEqual(batch, [jobs[1], jobs[2]])
+        self.assertEqual(self.queue.dequeue(), jobs[0])
+
+    def test_dequeue_timeout(self):
+        """ Dequeue with a timeout returns None when no job comes """
+        self.assertIsNone(self.queue.dequeue(timeout=0.01))
+        job = Job(dummy_task)
+        self.queue.enqueue(job)
+        self.assertEqual(self.queue.dequeue(timeout=0.01), job)
+
+    def test_handles(self):
+        """ The queue sorts the handles of the jobs as the jobs """
+        jobs = [Job(dummy_task, priority=priority) for priority in (3, 1)]
+        self.queue.enqueue_many([JobHandle.from_job(job) for job in jobs])
+        self.assertEqual(self.queue.dequeue().uuid, jobs[1].uuid)
+        self.assertEqual(self.queue.dequeue().uuid, jobs[0].uuid)
+
+    def test_bounded(self):
+        """ The waiting jobs, delayed or not, fill the queue """
+        queue = JobsQueue(maxsize=3)
+        self.assertEqual(queue.free_count(), 3)
+        queue.enqueue(Job(dummy_task))
+        queue.enqueue(Job(dummy_task, eta=timedelta(hours=1)))
+        self.assertEqual(queue.free_count(), 1)
+        self.assertFalse(queue.is_full())
+        queue.enqueue_many([Job(dummy_task), Job(dummy_task)])
+        # the jobs are never refused
+        self.assertEqual(queue.waiting_count(), 4)
+        self.assertEqual(queue.free_count(), 0)
+        self.assertTrue(queue.is_full())
+        queue.dequeue()
+        queue.dequeue()
+        self.assertEqual(queue.free_count(), 1)
+
+    def test_unbounded(self):
+        self.queue.enqueue(Job(dummy_task))
+        self.assertIsNone(self.queue.free_count())
+        self.assertFalse(self.queue.is_full())
+
+    def test_rate_limit(self):
+        """ A job without token is skipped, the next runnable job is
+        dequeued """
+        job1 = Job(limited_task, model_name='a.backend', args=(1,),
+                   priority=1)
+        job2 = Job(limited_task, model_name='a.backend', args=(1,),
+                   priority=2)
+        job3 = Job(limited_task, model_name='a.backend', args=(2,),
+                   priority=3)
+        job4 = Job(dummy_task, priority=4)
+        self.queue.enqueue_many([job1, job2, job3, job4])
+        self.assertEqual(self.queue.dequeue(), job1)
+        self.assertEqual(self.queue.dequeue(), job3)
+        self.assertEqual(self.queue.dequeue(), job4)
+        # job2 waits for a token of its backend
+        start = time.time()
+        self.assertEqual(self.queue.dequeue(timeout=5), job2)
+        self.assertGreater(time.time() - start, 0.1)
+        self.assertLess(time.time() - start, 1)
+
+    def test_unimportable(self):
+        """ A handle whose function cannot be imported does not break
+        the queue """
+        bad = JobHandle('bad-uuid', 'connector_missing_module.task')
+        self.assertIn('ImportError', bad.error)
+        self.assertIsNone(bad.rate_limit)
+        good = JobHandle.from_job(Job(limited_task, model_name='a.backend',
+                                      args=(1,)))
+        self.assertIsNone(good.error)
+        self.queue.enqueue_many([bad, good])
+        dequeued = [self.queue.dequeue(timeout=0.01) for __ in range(2)]
+        self.assertEqual(set(handle.uuid for handle in dequeued),
+                         set(['bad-uuid', good.uuid]))
+
+    def test_rate_limit_batch(self):
+        """ A batch takes only the jobs having a token """
+        jobs = [Job(limited_task, model_name='a.backend', args=(backend,))
+                for backend in (1, 1, 2)]
+        self.queue.enqueue_many(jobs[1:])
+        first = self.queue.dequeue_batch(jobs[0], 5)
+        self.assertEqual(first, [jobs[1], jobs[2]])
+        self.queue.enqueue(jobs[0])
+        self.assertEqual(self.queue.dequeue_batch(jobs[1], 5), [])
+
+
+class test_queue_channels(unittest2.TestCase):
+    """ Test the scheduling of the jobs across channels """
+
+    def setUp(self):
+        channels = ChannelTree('root.images:2,root.orders:2',
+                               root_capacity=3)
+        self.queue = JobsQueue(channels)
+
+    def test_capacity(self):
+        """ A full channel does not give jobs """
+        jobs = [Job(dummy_task, channel='root.images') for __ in range(3)]
+        for job_ in jobs:
+            self.queue.enqueue(job_)
+        self.assertIsNotNone(self.queue.dequeue(timeout=0.01))
+        self.assertIsNotNone(self.queue.dequeue(timeout=0.01))
+        self.assertIsNone(self.queue.dequeue(timeout=0.01))
+        self.queue.done(jobs[0])
+        self.assertIsNotNone(self.queue.dequeue(timeout=0.01))
+
+    def test_fair(self):
+        """ A busy channel does not starve the others, whatever the
+        priorities """
+        for __ in range(10):
+            self.queue.enqueue(Job(dummy_task, priority=1,
+                                   channel='root.images'))
+        order = Job(dummy_task, priority=50, channel='root.orders')
+        self.queue.enqueue(order)
+        first = self.queue.dequeue(timeout=0.01)
+        self.assertEqual(first.channel, 'root.images')
+        self.assertEqual(self.queue.dequeue(timeout=0.01), order)
+
+    def test_parent_capacity(self):
+        """ The subchannels share the capacity of root """
+        for channel in ('root.images', 'root.orders'):
+            for __ in range(2):
+                self.queue.enqueue(Job(dummy_task, channel=channel))
+        for __ in range(3):
+            self.assertIsNotNone(self.queue.dequeue(timeout=0.01))
+        self.assertIsNone(self.queue.dequeue(timeout=0.01))
+
+    def test_execution(self):
+        """ A dequeue can take only the jobs of an execution mode """
+        queue = JobsQueue(ChannelTree('root.cpu:2:process'))
+        cpu_job = Job(dummy_task, channel='root.cpu')
+        thread_job = Job(dummy_task, priority=50)
+        queue.enqueue_many([cpu_job, thread_job])
+        self.assertEqual(queue.execution(cpu_job), PROCESS)
+        self.assertEqual(queue.execution(thread_job), THREAD)
+        self.assertEqual(queue.ready_count(PROCESS), 1)
+        self.assertEqual(queue.dequeue(timeout=0.01, execution=THREAD),
+                         thread_job)
+        self.assertIsNone(queue.dequeue(timeout=0.01, execution=THREAD))
+        self.assertEqual(queue.running_count(THREAD), 1)
+        self.assertEqual(queue.running_count(PROCESS), 0)
+        self.assertEqual(queue.dequeue(timeout=0.01, execution=PROCESS),
+                         cpu_job)
+        queue.done(thread_job)
+        self.assertEqual(queue.running_count(THREAD), 0)
+        self.assertEqual(queue.running_count(PROCESS), 1)
+        self.assertEqual(queue.running_count(), 1)
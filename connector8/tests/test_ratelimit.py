@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import unittest2
+
+from ..queue.job import Job, JobHandle, job
+from ..queue import ratelimit as ratelimit_module
+from ..queue.ratelimit import RateLimit, RateLimiter, TokenBucket, record_key
+
+
+def limited_task(session, model_name, backend_id):
+    pass
+
+
+def unlimited_task(session, model_name, backend_id):
+    pass
+
+
+class test_token_bucket(unittest2.TestCase):
+    """ Test the token buckets """
+
+    def test_bucket(self):
+        bucket = TokenBucket(2, 2, now=0)
+        self.assertTrue(bucket.available(0))
+        bucket.take(0)
+        bucket.take(0)
+        self.assertFalse(bucket.available(0))
+        self.assertAlmostEqual(bucket.wait_time(0), 0.5)
+        self.assertFalse(bucket.available(0.25))
+        self.assertTrue(bucket.available(0.5))
+        # never more tokens than the capacity
+        self.assertAlmostEqual(bucket.wait_time(100), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_idle(self):
+        """ Idle once full and unused during its refill time """
+        bucket = TokenBucket(2, 4, now=0)
+        bucket.take(0)
+        self.assertFalse(bucket.idle(1))
+        self.assertTrue(bucket.idle(2))
+
+
+class test_rate_limiter(unittest2.TestCase):
+    """ Test the rate limits of the jobs """
+
+    def setUp(self):
+        job(limited_task, rate_limit=RateLimit(1, period=10))
+
+    def test_key(self):
+        """ The key of a job is computed by the rate limit of its
+        function """
+        self.assertEqual(Job(limited_task, model_name='a.backend',
+                             args=(3,)).rate_limit_key, u'a.backend,3')
+        self.assertIsNone(Job(unlimited_task, model_name='a.backend',
+                              args=(3,)).rate_limit_key)
+        self.assertEqual(record_key(Job(unlimited_task, args=(1, 2, 3))),
+                         u'1,2')
+
+    def test_limiter(self):
+        """ Each key has its bucket """
+        limiter = RateLimiter()
+        job1 = Job(limited_task, model_name='a.backend', args=(1,))
+        job2 = Job(limited_task, model_name='a.backend', args=(2,))
+        job3 = Job(unlimited_task, model_name='a.backend', args=(1,))
+        self.assertTrue(limiter.can_start(job1, now=0))
+        limiter.take(job1, now=0)
+        self.assertFalse(limiter.can_start(job1, now=1))
+        self.assertAlmostEqual(limiter.wait_time(job1, now=1), 9)
+        self.assertTrue(limiter.can_start(job2, now=1))
+        self.assertTrue(limiter.can_start(job3, now=1))
+        self.assertEqual(limiter.wait_time(job3, now=1), 0)
+        self.assertTrue(limiter.can_start(job1, now=10))
+
+    def test_sweep(self):
+        """ The idle buckets are dropped """
+        limiter = RateLimiter()
+        job1 = Job(limited_task, model_name='a.backend', args=(1,))
+        job2 = Job(limited_task, model_name='a.backend', args=(2,))
+        limiter.take(job1, now=0)
+        sweep = ratelimit_module.SWEEP_INTERVAL
+        limiter.take(job2, now=sweep - 5)
+        self.assertEqual(len(limiter._buckets), 2)
+        self.assertFalse(limiter.can_start(job2, now=sweep))
+        self.assertEqual(len(limiter._buckets), 1)
+
+    def test_handle(self):
+        """ The rate limit of a handle is resolved when it is built, a
+        function which cannot be imported has no limit """
+        limiter = RateLimiter()
+        handle = JobHandle.from_job(Job(limited_task, model_name='a.backend',
+                                        args=(1,)))
+        self.assertIs(handle.rate_limit, limited_task.rate_limit)
+        bad = JobHandle('bad-uuid', 'connector_missing_module.task')
+        self.assertIn('ImportError', bad.error)
+        self.assertIsNone(bad.rate_limit)
+        self.assertTrue(limiter.can_start(bad, now=0))
+        self.assertEqual(limiter.wait_time(bad, now=0), 0)
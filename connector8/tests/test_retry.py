@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import cPickle
+import mock
+import unittest2
+from datetime import datetime, timedelta
+
+from ..exception import RetryableJobError
+from ..queue import retry as retry_module
+from ..queue.job import Job, job, RETRY_INTERVAL
+from ..queue.retry import (ExponentialRetry,
+                           FixedRetry,
+                           LinearRetry,
+                           TableRetry)
+
+
+def default_task(session):
+    pass
+
+
+def exponential_task(session):
+    pass
+
+
+def table_task(session):
+    pass
+
+
+class test_retry_policy(unittest2.TestCase):
+    """ Test the delays of the retry policies """
+
+    def test_fixed(self):
+        policy = FixedRetry(30)
+        self.assertEqual([policy.delay(retry) for retry in (1, 2, 3)],
+                         [30, 30, 30])
+
+    def test_linear(self):
+        policy = LinearRetry(10, step=20)
+        self.assertEqual([policy.delay(retry) for retry in (1, 2, 3)],
+                         [10, 30, 50])
+
+    def test_exponential(self):
+        policy = ExponentialRetry(10, max_delay=100)
+        self.assertEqual([policy.delay(retry) for retry in (1, 2, 3, 4, 5)],
+                         [10, 20, 40, 80, 100])
+
+    def test_table(self):
+        policy = TableRetry([5, 60, 600])
+        self.assertEqual([policy.delay(retry) for retry in (0, 1, 2, 3, 4)],
+                         [5, 5, 60, 600, 600])
+
+    def test_jitter(self):
+        """ The delay is drawn between 0 and the computed delay """
+        policy = ExponentialRetry(10, max_delay=100, jitter=True)
+        with mock.patch.object(retry_module.random, 'uniform',
+                               return_value=42) as uniform:
+            self.assertEqual(policy.delay(5), 42)
+            uniform.assert_called_once_with(0, 100)
+        delays = set(policy.delay(3) for __ in range(20))
+        self.assertGreater(len(delays), 1)
+        self.assertTrue(all(0 <= delay <= 40 for delay in delays))
+
+    def test_max_delay(self):
+        """ The delay is limited to one day by default, whatever the
+        number of tries """
+        for policy in (ExponentialRetry(10), ExponentialRetry(10.0),
+                       LinearRetry(3600)):
+            self.assertEqual(policy.delay(5000), retry_module.MAX_DELAY)
+
+
+class test_job_retry(unittest2.TestCase):
+    """ Test the retry policy of the jobs """
+
+    def test_default(self):
+        job_ = Job(func=default_task)
+        job_.retry = 3
+        job_.postpone()
+        eta = datetime.now() + timedelta(seconds=RETRY_INTERVAL)
+        self.assertAlmostEqual(job_.eta, eta, delta=timedelta(seconds=5))
+
+    def test_function_policy(self):
+        job(exponential_task, retry_policy=ExponentialRetry(10))
+        job_ = Job(func=exponential_task)
+        job_.retry = 3
+        job_.postpone()
+        eta = datetime.now() + timedelta(seconds=40)
+        self.assertAlmostEqual(job_.eta, eta, delta=timedelta(seconds=5))
+        job_.postpone(seconds=2)
+        eta = datetime.now() + timedelta(seconds=2)
+        self.assertAlmostEqual(job_.eta, eta, delta=timedelta(seconds=1))
+
+    def test_infinite_retries(self):
+        """ A job retried forever is postponed by one day at most """
+        job(exponential_task, retry_policy=ExponentialRetry(10))
+        job_ = Job(func=exponential_task, max_retries=0)
+        job_.retry = 5000
+        job_.postpone()
+        eta = datetime.now() + timedelta(seconds=retry_module.MAX_DELAY)
+        self.assertAlmostEqual(job_.eta, eta, delta=timedelta(seconds=5))
+
+    def test_table_shortcut(self):
+        job(table_task, retry_policy=[60, 600])
+        self.assertIsInstance(table_task.retry_policy, TableRetry)
+        self.assertEqual(table_task.retry_policy.intervals, [60, 600])
+        with self.assertRaises(AssertionError):
+            job(table_task, retry_policy=60)
+
+    def test_retryable_error_seconds(self):
+        """ The delay of the error survives the pickling, as when it is
+        sent back by a child process """
+        err = RetryableJobError('Too many requests', seconds=30)
+        self.assertEqual(unicode(err), u'Too many requests')
+        err = cPickle.loads(cPickle.dumps(err))
+        self.assertEqual(err.seconds, 30)
+        self.assertEqual(unicode(err), u'Too many requests')
+        self.assertIsNone(RetryableJobError('error').seconds)
@@ -0,0 +1,881 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import mock
+import select
+import threading
+import time
+import unittest2
+from datetime import datetime, timedelta
+
+from psycopg2 import OperationalError
+
+import openerp
+from openerp import SUPERUSER_ID
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
+import openerp.tests.common as common
+from ..queue import worker as worker_module
+from ..exception import JobTimeoutError, RetryableJobError
+from ..queue.breaker import CircuitBreaker
+from ..queue.job import (Job, JobHandle, OdooJobStorage, job,
+                         THREAD, PROCESS)
+from ..queue.worker import Worker, JobListener
+from ..session import ConnectorSession, ConnectorSessionHandler
+from .. import session as session_module
+
+_logger = logging.getLogger(__name__)
+
+
+def dummy_task(session):
+    pass
+
+
+def notified_task(session, model_name):
+    pass
+
+
+@job(execution=PROCESS)
+def process_task(session):
+    pass
+
+
+class FakeListener(object):
+
+    def __init__(self, db_name):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class FakeWatcher(object):
+
+    def __init__(self):
+        self.lost = False
+
+    def worker_lost(self, worker):
+        return self.lost
+
+
+class PoolWorker(Worker):
+    """ Worker recording the executors running the jobs, a job is
+    finished only when all the executors are running one """
+
+    listener_class = FakeListener
+
+    def __init__(self, db_name, watcher, size, processes=0):
+        self.size = size
+        self.processes = processes
+        super(PoolWorker, self).__init__(db_name, watcher)
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.executions = {}
+        self.all_running = threading.Event()
+
+    def executors_count(self):
+        return self.size
+
+    def processes_count(self):
+        return self.processes
+
+    def execute(self, job):
+        executor = threading.current_thread()
+        with self.lock:
+            self.threads.add(executor.name)
+            self.executions[job.uuid] = executor.execution
+            if len(self.threads) == self.size + self.processes:
+                self.all_running.set()
+        self.all_running.wait(5)
+
+
+class test_worker(unittest2.TestCase):
+    """ Test the pool of executors of the Worker """
+
+    def setUp(self):
+        self.watcher = FakeWatcher()
+        self.worker = PoolWorker('db', self.watcher, 3)
+        self.worker.daemon = True
+
+    def tearDown(self):
+        self.watcher.lost = True
+        if self.worker.is_alive():
+            self.worker.join(10)
+
+    def test_pool(self):
+        """ The jobs are executed concurrently by the executors """
+        for __ in range(3):
+            self.worker.queue.enqueue(Job(dummy_task))
+        self.worker.start()
+        self.assertTrue(self.worker.all_running.wait(5))
+        self.assertEqual(len(self.worker.executors), 3)
+        self.assertEqual(len(self.worker.threads), 3)
+
+    def test_no_processes(self):
+        """ Without child processes, the jobs of the process mode are
+        executed by the executor threads """
+        self.assertEqual(Worker.processes_count(), 0)
+        process_job = Job(process_task)
+        self.assertEqual(self.worker.execution(process_job), THREAD)
+        self.worker.queue.enqueue_many(
+            [process_job, Job(dummy_task), Job(dummy_task)])
+        self.worker.start()
+        self.assertTrue(self.worker.all_running.wait(5))
+        self.assertEqual(len(self.worker.threads), 3)
+        self.assertEqual(set(self.worker.executions.values()), set([None]))
+
+    def test_processes(self):
+        """ The jobs executed in processes have their own executors """
+        self.worker = PoolWorker('db', self.watcher, 1, processes=2)
+        self.worker.daemon = True
+        process_jobs = [Job(process_task) for __ in range(2)]
+        thread_job = Job(dummy_task)
+        self.worker.queue.enqueue_many(process_jobs + [thread_job])
+        self.worker.start()
+        self.assertTrue(self.worker.all_running.wait(5))
+        self.assertEqual(len(self.worker.threads), 3)
+        self.assertEqual(self.worker.executions,
+                         {thread_job.uuid: THREAD,
+                          process_jobs[0].uuid: PROCESS,
+                          process_jobs[1].uuid: PROCESS})
+
+    def test_eta_reached(self):
+        """ The delayed jobs are assigned when their eta is close,
+        without notification """
+        assigned = threading.Event()
+        self.worker.assign_then_enqueue = assigned.set
+        self.worker.next_eta = datetime.utcnow() + timedelta(hours=1)
+        self.assertFalse(self.worker.eta_reached())
+        self.worker.next_eta = datetime.utcnow() + timedelta(seconds=1)
+        self.assertTrue(self.worker.eta_reached())
+        self.worker.start()
+        self.assertTrue(assigned.wait(5))
+
+    def test_stop(self):
+        """ The worker and its executors stop when the worker is lost """
+        self.worker.start()
+        self.watcher.lost = True
+        self.worker.join(10)
+        self.assertFalse(self.worker.is_alive())
+        self.assertTrue(self.worker.executors)
+        for executor in self.worker.executors:
+            self.assertFalse(executor.is_alive())
+
+
+class FakeStorage(object):
+    """ Job storage keeping the jobs in memory """
+
+    jobs = {}
+
+    def __init__(self, session):
+        self.session = session
+
+    def load(self, job_uuid):
+        return self.jobs[job_uuid]
+
+    def load_many(self, job_uuids):
+        return [self.jobs[job_uuid] for job_uuid in job_uuids]
+
+    def store(self, job):
+        self.jobs[job.uuid] = job
+
+    def requeue_started(self, job_uuids, worker_uuid):
+        started = [job_uuid for job_uuid in job_uuids
+                   if self.jobs[job_uuid].state == 'started' and
+                   self.jobs[job_uuid].worker_uuid == worker_uuid]
+        for job_uuid in started:
+            self.jobs[job_uuid].state = 'enqueued'
+        return started
+
+    def release_many(self, job_uuids, worker_uuid, state='pending'):
+        for job_uuid in job_uuids:
+            job_ = self.jobs[job_uuid]
+            if job_.state == state and job_.worker_uuid == worker_uuid:
+                job_.state = 'pending'
+                job_.worker_uuid = None
+
+
+class SerializationFailure(OperationalError):
+    pgcode = '40001'
+
+
+class LifecycleWorker(Worker):
+    job_storage_class = FakeStorage
+
+    def legacy_run_job(self, job):
+        """ ``run_job`` with a new session for each step, as it was """
+        session_hdl = ConnectorSessionHandler(self.db_name, SUPERUSER_ID)
+        with session_hdl.session() as session:
+            job = self._load_job(session, job.uuid)
+        with session_hdl.session() as session:
+            job.set_started()
+            self.job_storage_class(session).store(job)
+        with session_hdl.session() as session:
+            job.perform(session)
+        with session_hdl.session() as session:
+            job.set_done()
+            self.job_storage_class(session).store(job)
+
+
+class LifecycleCase(unittest2.TestCase):
+    """ Run jobs stored in memory with mocked cursors """
+
+    worker_class = LifecycleWorker
+
+    def setUp(self):
+        self.cursors = []
+        db = mock.Mock()
+        db.cursor.side_effect = self._new_cursor
+        patchers = [
+            mock.patch.object(openerp.sql_db, 'db_connect',
+                              return_value=db, create=True),
+            mock.patch.object(worker_module, 'RegistryManager'),
+            mock.patch.object(session_module, 'RegistryManager'),
+            mock.patch.object(openerp.api.Environment, 'reset',
+                              create=True),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.registry_managers = [worker_module.RegistryManager,
+                                  session_module.RegistryManager]
+        self.worker = self.worker_class('db', FakeWatcher())
+        self.addCleanup(self.worker.release_sessions)
+
+    def _new_cursor(self):
+        cursor = mock.Mock()
+        self.cursors.append(cursor)
+        return cursor
+
+
+class test_job_lifecycle(LifecycleCase):
+    """ Benchmark of the cursors and commits used to run jobs """
+
+    jobs_count = 50
+
+    def _new_jobs(self):
+        jobs = []
+        for __ in range(self.jobs_count):
+            job = Job(dummy_task)
+            job.set_enqueued(self.worker)
+            FakeStorage.jobs[job.uuid] = job
+            jobs.append(job)
+        return jobs
+
+    def _run(self, run_job):
+        """ Run the jobs, return the cursors, commits and registry
+        signaling checks per job """
+        del self.cursors[:]
+        for manager in self.registry_managers:
+            manager.reset_mock()
+        jobs = self._new_jobs()
+        for job_ in jobs:
+            run_job(job_)
+        self.assertTrue(all(job_.state == 'done' for job_ in jobs))
+        commits = sum(cursor.commit.call_count for cursor in self.cursors)
+        checks = sum(manager.check_registry_signaling.call_count
+                     for manager in self.registry_managers)
+        count = float(self.jobs_count)
+        return (len(self.cursors) / count, commits / count, checks / count)
+
+    def test_lifecycle(self):
+        """ The cursors are kept, 2 commits and 1 registry check
+        per job """
+        legacy = self._run(self.worker.legacy_run_job)
+        lean = self._run(self.worker.run_job)
+        _logger.info('per job: %.2f cursors, %.2f commits, %.2f registry '
+                     'checks instead of %.2f cursors, %.2f commits, '
+                     '%.2f registry checks', *(lean + legacy))
+        self.assertEqual(legacy, (4, 4, 4))
+        self.assertEqual(lean, (2 / float(self.jobs_count), 2, 1))
+
+
+class test_execute(LifecycleCase):
+    """ Test the execution of the jobs dequeued by an executor """
+
+    def test_not_importable(self):
+        """ A job whose function cannot be imported is failed """
+        job_ = Job(dummy_task)
+        job_.func_name = 'connector_missing_module.dummy_task'
+        job_.set_enqueued(self.worker)
+        FakeStorage.jobs[job_.uuid] = job_
+        self.worker.execute(JobHandle.from_job(job_))
+        self.assertEqual(job_.state, 'failed')
+        self.assertIn('ImportError', job_.exc_info)
+
+    def test_concurrent_load(self):
+        """ A job whose load fails on a concurrent update is untouched,
+        its handle is queued again """
+        job_ = Job(dummy_task)
+        job_.set_enqueued(self.worker)
+        FakeStorage.jobs[job_.uuid] = job_
+        handle = JobHandle.from_job(job_)
+        with mock.patch.object(FakeStorage, 'load',
+                               side_effect=SerializationFailure()):
+            self.worker.run_job(handle)
+        self.assertEqual(job_.state, 'enqueued')
+        self.assertEqual(job_.retry, 0)
+        self.assertGreater(handle.eta, datetime.now())
+        self.assertEqual(self.worker.queue.ready_count(), 0)
+        self.assertEqual(self.worker.queue.waiting_count(), 1)
+
+
+@job(circuit_breaker=CircuitBreaker(failures=2, reset_timeout=60))
+def failing_task(session, model_name, backend_id):
+    raise RetryableJobError('Backend down')
+
+
+class CircuitStorage(FakeStorage):
+    """ Job storage recording the postponed circuits """
+
+    postponed = []
+
+    def postpone_circuit(self, circuit_key, eta):
+        self.postponed.append((circuit_key, eta))
+        return 0
+
+
+class CircuitWorker(LifecycleWorker):
+    job_storage_class = CircuitStorage
+
+
+class test_circuit_breaker(LifecycleCase):
+    """ Test the circuit breakers in the execution of the jobs """
+
+    worker_class = CircuitWorker
+
+    def setUp(self):
+        super(test_circuit_breaker, self).setUp()
+        CircuitStorage.postponed = []
+
+    def _job(self, func):
+        job_ = Job(func, model_name='a.backend', args=(1,))
+        job_.set_enqueued(self.worker)
+        CircuitStorage.jobs[job_.uuid] = job_
+        return job_
+
+    def test_open(self):
+        """ The jobs of an open circuit are postponed in bulk, without
+        their retries """
+        waiting = self._job(failing_task)
+        self.worker.queue.enqueue(JobHandle.from_job(waiting))
+        self.worker.run_job(self._job(failing_task))
+        self.assertEqual(CircuitStorage.postponed, [])
+        self.worker.run_job(self._job(failing_task))
+        self.assertEqual(len(CircuitStorage.postponed), 1)
+        circuit_key, eta = CircuitStorage.postponed[0]
+        self.assertEqual(circuit_key, u'a.backend,1')
+        self.assertGreater(eta, datetime.now() + timedelta(seconds=50))
+        self.assertEqual(waiting.retry, 0)
+        self.assertIsNone(self.worker.queue.dequeue(timeout=0.01))
+
+
+class SizedWorker(Worker):
+    """ Worker with 4 executor threads and 2 child processes """
+
+    def executors_count(self):
+        return 4
+
+    def processes_count(self):
+        return 2
+
+
+class test_claim_size(unittest2.TestCase):
+    """ Test the number of jobs assigned to a worker """
+
+    def setUp(self):
+        self.worker = SizedWorker('db', FakeWatcher())
+
+    def test_no_throughput(self):
+        """ Fill the executor threads and keep one job per thread
+        waiting, the idle processes do not count """
+        self.assertEqual(self.worker.claim_size(), 8)
+
+    def test_process_throughput(self):
+        """ Keep QUEUE_LEAD seconds of work for the processes """
+        self.worker.process_throughput.add(4)
+        # 2 processes running jobs of 4 seconds: 0.5 job per second
+        lead = int(round(0.5 * worker_module.QUEUE_LEAD))
+        self.assertEqual(self.worker.claim_size(), 8 + lead)
+        self.worker.queue.enqueue(Job(process_task))
+        self.assertEqual(self.worker.claim_size(), 8 + lead - 1)
+
+    def test_throughput(self):
+        """ Keep QUEUE_LEAD seconds of work in the queue """
+        self.worker.throughput.add(2)
+        # 4 executors running jobs of 2 seconds: 2 jobs per second
+        self.assertEqual(self.worker.claim_size(),
+                         4 + 2 * worker_module.QUEUE_LEAD)
+        self.worker.throughput.add(1000, count=10)
+        self.assertAlmostEqual(self.worker.throughput.duration, 21.6)
+        # slow jobs, only the free executors are filled
+        self.assertEqual(self.worker.claim_size(), 6)
+
+    def test_queue(self):
+        """ The running and waiting jobs reduce the claim """
+        queue = self.worker.queue
+        queue.enqueue_many([Job(dummy_task) for __ in range(5)])
+        self.assertEqual(self.worker.claim_size(), 3)
+        queue.dequeue()
+        queue.dequeue()
+        self.assertEqual(self.worker.claim_size(), 3)
+        queue.enqueue_many([Job(dummy_task) for __ in range(10)])
+        self.assertEqual(self.worker.claim_size(), 0)
+        # delayed jobs are not waiting for an executor
+        queue.enqueue(Job(dummy_task, eta=timedelta(hours=1)))
+        self.assertEqual(self.worker.claim_size(), 0)
+
+    def test_max(self):
+        self.worker.throughput.add(0.0001)
+        self.assertEqual(self.worker.claim_size(),
+                         worker_module.MAX_CLAIM_SIZE)
+
+    def test_full(self):
+        """ The claim is limited to the room left in the queue """
+        queue = self.worker.queue
+        queue.maxsize = 6
+        queue.enqueue_many([Job(dummy_task, eta=timedelta(hours=1))
+                            for __ in range(4)])
+        self.assertEqual(self.worker.claim_size(), 2)
+        queue.enqueue_many([Job(dummy_task, eta=timedelta(hours=1))
+                            for __ in range(2)])
+        self.assertEqual(self.worker.claim_size(), 0)
+
+
+class HandleStorage(object):
+    """ Job storage recording the enqueued and released jobs """
+
+    enqueued = []
+    released = []
+    failed = []
+
+    def __init__(self, session):
+        self.session = session
+
+    def set_enqueued_many(self, job_uuids, worker_uuid):
+        self.enqueued.extend(job_uuids)
+        return [JobHandle(job_uuid, 'connector_missing_module.task'
+                          if job_uuid.startswith('bad') else
+                          __name__ + '.dummy_task')
+                for job_uuid in job_uuids]
+
+    def release_many(self, job_uuids, worker_uuid):
+        self.released.extend(job_uuids)
+
+    def set_failed_unreadable(self, job_uuid, exc_info):
+        self.failed.append(job_uuid)
+
+
+class SpillWorker(SizedWorker):
+    job_storage_class = HandleStorage
+
+
+class test_enqueue_spill(unittest2.TestCase):
+    """ Test the jobs released by a worker whose queue is full """
+
+    def setUp(self):
+        patcher = mock.patch.object(worker_module, 'ConnectorSessionHandler')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.worker = SpillWorker('db', FakeWatcher())
+        self.worker.queue.maxsize = 3
+        HandleStorage.enqueued = []
+        HandleStorage.released = []
+        HandleStorage.failed = []
+
+    def test_spill(self):
+        """ Only the handles fitting in the queue are kept """
+        self.worker.enqueue_job_uuids(['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(HandleStorage.enqueued, ['a', 'b', 'c'])
+        self.assertEqual(HandleStorage.released, ['d', 'e'])
+        self.assertTrue(self.worker.spilled)
+        self.assertTrue(self.worker.queue.is_full())
+        handle = self.worker.queue.dequeue()
+        self.assertIsInstance(handle, JobHandle)
+        self.assertEqual(handle.uuid, 'a')
+
+    def test_no_spill(self):
+        self.worker.enqueue_job_uuids(['a', 'b'])
+        self.assertEqual(HandleStorage.released, [])
+        self.assertFalse(self.worker.spilled)
+
+    def test_unimportable(self):
+        """ The jobs whose function cannot be imported are failed """
+        self.worker.enqueue_job_uuids(['a', 'bad'])
+        self.assertEqual(HandleStorage.failed, ['bad'])
+        self.assertEqual(self.worker.queue.dequeue(timeout=0.01).uuid, 'a')
+        self.assertIsNone(self.worker.queue.dequeue(timeout=0.01))
+
+
+class test_watchdog(unittest2.TestCase):
+    """ Test the deadlines of the running jobs """
+
+    def setUp(self):
+        self.watchdog = worker_module.Watchdog()
+
+    def test_release(self):
+        """ Jobs ended in time are no longer watched """
+        self.watchdog.watch('executor', None, ['job'], 10, now=100)
+        self.assertEqual(self.watchdog.expired(now=109), [])
+        self.assertTrue(self.watchdog.release('executor'))
+        self.assertEqual(self.watchdog.expired(now=200), [])
+
+    def test_expired(self):
+        """ The executor of expired jobs is taken once, then abandoned """
+        self.watchdog.watch('executor', 'sessions', ['job'], 10, now=100)
+        self.watchdog.watch('other', 'sessions', ['job2'], 60, now=100)
+        self.assertEqual(self.watchdog.expired(now=110),
+                         [('executor', ['job'], 'sessions', 10)])
+        self.assertEqual(self.watchdog.expired(now=111), [])
+        self.assertFalse(self.watchdog.release('executor'))
+        self.assertTrue(self.watchdog.release('other'))
+
+    def test_recovered(self):
+        """ The recovered jobs are returned once the executor ended """
+        self.watchdog.watch('executor', 'sessions', ['job'], 10, now=100)
+        self.watchdog.expired(now=110)
+        self.assertEqual(
+            self.watchdog.recovered('executor', ['job'], 10, now=111), [])
+        self.assertEqual(self.watchdog.stranded(now=120), [])
+        self.assertFalse(self.watchdog.release('executor'))
+        self.assertEqual(self.watchdog.ended('executor'), ['job'])
+
+    def test_ended(self):
+        """ The executor ended before the recovery of its jobs """
+        self.watchdog.watch('executor', 'sessions', ['job'], 10, now=100)
+        self.watchdog.expired(now=110)
+        self.assertFalse(self.watchdog.release('executor'))
+        self.assertEqual(self.watchdog.ended('executor'), [])
+        self.assertEqual(self.watchdog.recovered('executor', ['job'], 10),
+                         ['job'])
+
+    def test_stranded(self):
+        """ The recovered jobs are taken once when the executor does not
+        end them in time, it gets nothing when it ends """
+        self.watchdog.watch('executor', 'sessions', ['job'], 10, now=100)
+        self.watchdog.expired(now=110)
+        self.watchdog.recovered('executor', ['job'], 10, now=111)
+        self.assertEqual(self.watchdog.stranded(now=121), ['job'])
+        self.assertEqual(self.watchdog.stranded(now=200), [])
+        self.assertFalse(self.watchdog.release('executor'))
+        self.assertEqual(self.watchdog.ended('executor'), [])
+
+
+@job(timeout=5)
+def slow_task(session):
+    pass
+
+
+class test_job_timeout(LifecycleCase):
+    """ Test the recycling of the executors whose jobs are too long """
+
+    def setUp(self):
+        super(test_job_timeout, self).setUp()
+        patcher = mock.patch.object(self.worker, '_start_executor',
+                                    return_value='new executor')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _start(self, job_):
+        """ Start a job in an executor, already past its deadline """
+        job_.set_enqueued(self.worker)
+        job_.set_started()
+        FakeStorage.jobs[job_.uuid] = job_
+        self.worker.queue.enqueue(JobHandle.from_job(job_))
+        handle = self.worker.queue.dequeue()
+        self.worker.executors = ['executor']
+        sessions = worker_module.JobSessions('db')
+        self.worker.watchdog.watch('executor', sessions, [handle],
+                                   job_.timeout, now=time.time() - 10)
+        return sessions
+
+    def _recycle(self):
+        for expired in self.worker.watchdog.expired():
+            self.worker.recycle(*expired)
+
+    def test_timeout(self):
+        """ The time limit is given by the function or by the worker """
+        job_ = Job(slow_task)
+        self.assertEqual(job_.timeout, 5)
+        self.assertEqual(JobHandle.from_job(job_).timeout, 5)
+        self.assertIsNone(Job(dummy_task).timeout)
+        self.assertEqual(
+            self.worker._timeout([job_, Job(dummy_task)]),
+            5 + worker_module.DEFAULT_JOB_TIMEOUT)
+
+    def test_recycle(self):
+        """ The executor is replaced, the job is retried later, once the
+        abandoned executor ended it """
+        job_ = Job(slow_task)
+        sessions = self._start(job_)
+        self._recycle()
+        self.assertTrue(sessions.abandoned)
+        self.assertEqual(self.worker.executors, ['new executor'])
+        self.assertEqual(self.worker.queue.running_count(), 0)
+        self.assertEqual(job_.state, 'enqueued')
+        self.assertEqual(job_.retry, 1)
+        self.assertGreater(job_.eta, datetime.now())
+        self.assertEqual(self.worker.queue.waiting_count(), 0)
+        self.assertFalse(self.worker.watchdog.release('executor'))
+        self.worker.queue.enqueue_many(
+            self.worker.watchdog.ended('executor'))
+        self.assertEqual(self.worker.queue.waiting_count(), 1)
+
+    def test_ended(self):
+        """ The job is retried at once when the executor already ended """
+        job_ = Job(slow_task)
+        self._start(job_)
+        expired = self.worker.watchdog.expired()
+        self.assertFalse(self.worker.watchdog.release('executor'))
+        self.assertEqual(self.worker.watchdog.ended('executor'), [])
+        self.worker.recycle(*expired[0])
+        self.assertEqual(self.worker.queue.waiting_count(), 1)
+
+    def test_never_ended(self):
+        """ The job is released when the abandoned executor does not end
+        within the time limit again, then retried by any worker """
+        job_ = Job(slow_task)
+        self._start(job_)
+        self._recycle()
+        self.assertEqual(job_.state, 'enqueued')
+        self.assertEqual(self.worker.watchdog.stranded(), [])
+        stranded = self.worker.watchdog.stranded(now=time.time() + 10)
+        self.assertEqual([handle.uuid for handle in stranded], [job_.uuid])
+        self.worker.release_stranded(stranded)
+        self.assertEqual(job_.state, 'pending')
+        self.assertIsNone(job_.worker_uuid)
+        self.assertEqual(job_.retry, 1)
+        self.assertFalse(self.worker.watchdog.release('executor'))
+        self.assertEqual(self.worker.watchdog.ended('executor'), [])
+        self.assertEqual(self.worker.queue.waiting_count(), 0)
+
+    def test_done_meanwhile(self):
+        """ A job done before its recovery is left done """
+        job_ = Job(slow_task)
+        self._start(job_)
+        job_.set_done()
+        self._recycle()
+        self.assertEqual(job_.state, 'done')
+        self.assertEqual(job_.retry, 0)
+        self.assertEqual(self.worker.watchdog.ended('executor'), [])
+
+    def test_process(self):
+        """ The child process executing the job is killed """
+        job_ = Job(slow_task)
+        self._start(job_)
+        with mock.patch.object(self.worker.process_pool,
+                               'terminate') as terminate:
+            self._recycle()
+        terminate.assert_called_once_with(job_.uuid)
+
+    def test_max_retries(self):
+        """ The job fails at its max. retries """
+        job_ = Job(slow_task, max_retries=2)
+        job_.retry = 1
+        self._start(job_)
+        self._recycle()
+        self.assertEqual(job_.state, 'failed')
+        self.assertEqual(job_.retry, 2)
+        self.assertIn('Time limit of 5 seconds', job_.exc_info)
+        self.assertEqual(self.worker.queue.waiting_count(), 0)
+
+    def test_abandoned_sessions(self):
+        """ The abandoned sessions cancel the work and never commit """
+        sessions = worker_module.JobSessions('db')
+        with self.assertRaises(JobTimeoutError):
+            with sessions.work_session():
+                sessions.abandon()
+        cursor = self.cursors[-1]
+        cursor._cnx.cancel.assert_called_once_with()
+        self.assertFalse(cursor.commit.called)
+        self.assertTrue(cursor.rollback.called)
+        with self.assertRaises(JobTimeoutError):
+            with sessions.session():
+                pass
+
+
+class test_job_listener(common.TransactionCase):
+    """ Test the notification of the new jobs """
+
+    def test_notify(self):
+        """ A committed job wakes up the listener """
+        listener = JobListener(self.cr.dbname)
+        self.addCleanup(listener.close)
+        self.assertFalse(listener.wait(0.1))
+        with self.registry.cursor() as cr:
+            session = ConnectorSession(cr, SUPERUSER_ID)
+            job_uuid = OdooJobStorage(session).enqueue(notified_task,
+                                                       model_name='res.users')
+        try:
+            self.assertTrue(listener.wait(5))
+        finally:
+            with self.registry.cursor() as cr:
+                cr.execute("DELETE FROM queue_job WHERE uuid = %s",
+                           (job_uuid,))
+
+    def test_notify_many(self):
+        """ A multi-row insert sends one notification, from a trigger
+        run once for the statement """
+        if self.cr._cnx.server_version >= 100000:
+            triggers = ['queue_job_notify_insert', 'queue_job_notify_update']
+            # the first bit of tgtype is set for the row triggers
+            self.cr.execute("SELECT tgname FROM pg_trigger "
+                            "WHERE tgname IN %s AND tgtype & 1 = 0",
+                            (tuple(triggers),))
+            self.assertEqual(sorted(row[0] for row in self.cr.fetchall()),
+                             triggers)
+        listener = JobListener(self.cr.dbname)
+        self.addCleanup(listener.close)
+        listener._connect()
+        with self.registry.cursor() as cr:
+            session = ConnectorSession(cr, SUPERUSER_ID)
+            job_uuids = OdooJobStorage(session).enqueue_many(
+                notified_task, [() for __ in range(3)],
+                model_name='res.users')
+        try:
+            conn = listener._conn
+            deadline = time.time() + 5
+            while not conn.notifies and time.time() < deadline:
+                select.select([conn], [], [], 0.1)
+                conn.poll()
+            time.sleep(0.2)
+            conn.poll()
+            self.assertEqual(len(conn.notifies), 1)
+        finally:
+            with self.registry.cursor() as cr:
+                cr.execute("DELETE FROM queue_job WHERE uuid IN %s",
+                           (tuple(job_uuids),))
+
+
+class HeartbeatWorker(object):
+    """ Worker only notifying it is alive """
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+    def is_alive(self):
+        return True
+
+
+class test_dead_workers(common.TransactionCase):
+    """ Test the recovery of the jobs of the dead workers """
+
+    def setUp(self):
+        super(test_dead_workers, self).setUp()
+        self.session = ConnectorSession(self.cr, self.uid)
+        self.storage = OdooJobStorage(self.session)
+        self.worker_model = self.registry('queue.worker')
+        timeout = self.worker_model.worker_timeout
+        fmt = DEFAULT_SERVER_DATETIME_FORMAT
+        self.dead_uuid = 'dead-worker-uuid'
+        self.alive_uuid = 'alive-worker-uuid'
+        self.worker_model.create(self.cr, self.uid, {
+            'uuid': self.dead_uuid,
+            'date_alive': (datetime.now() -
+                           timedelta(seconds=timeout + 1)).strftime(fmt)})
+        self.alive_id = self.worker_model.create(self.cr, self.uid, {
+            'uuid': self.alive_uuid,
+            'date_alive': datetime.now().strftime(fmt)})
+
+    def _job(self, worker_uuid, state, retry=0, max_retries=5):
+        job = Job(dummy_task, max_retries=max_retries)
+        job.worker_uuid = worker_uuid
+        job.state = state
+        job.retry = retry
+        self.storage.store(job)
+        return job
+
+    def test_recover(self):
+        """ The jobs of a dead worker are set to pending without worker,
+        the running ones count a retry """
+        pending = self._job(self.dead_uuid, 'pending')
+        enqueued = self._job(self.dead_uuid, 'enqueued', retry=2)
+        started = self._job(self.dead_uuid, 'started', retry=2)
+        done = self._job(self.dead_uuid, 'done')
+        alive = self._job(self.alive_uuid, 'started')
+        self.worker_model._purge_dead_workers(self.cr, self.uid)
+        self.assertFalse(self.worker_model.search(
+            self.cr, self.uid, [('uuid', '=', self.dead_uuid)]))
+        for job_, retry in ((pending, 0), (enqueued, 2), (started, 3)):
+            job_ = self.storage.load(job_.uuid)
+            self.assertEqual(job_.state, 'pending')
+            self.assertIsNone(job_.worker_uuid)
+            self.assertIsNone(job_.date_started)
+            self.assertEqual(job_.retry, retry)
+        self.assertEqual(self.storage.load(done.uuid).state, 'done')
+        alive = self.storage.load(alive.uuid)
+        self.assertEqual(alive.state, 'started')
+        self.assertEqual(alive.worker_uuid, self.alive_uuid)
+
+    def test_max_retries(self):
+        """ A job killing its worker fails at its max. retries """
+        job = self._job(self.dead_uuid, 'started', retry=4)
+        self.worker_model._purge_dead_workers(self.cr, self.uid)
+        job = self.storage.load(job.uuid)
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.retry, 5)
+        self.assertIn(self.dead_uuid, job.exc_info)
+
+    def _heartbeat(self, worker):
+        """ Check of the workers by the watcher of ``worker``, in the
+        transaction of the test """
+        watcher = worker_module.WorkerWatcher()
+        watcher._notify_alive(self.session, worker)
+        watcher._purge_dead_workers(self.session)
+
+    def _killed_during_job(self, retry, max_retries):
+        """ Start a job on a worker, kill the worker, then let another
+        worker check the workers once the heartbeat interval elapsed """
+        victim = HeartbeatWorker('victim-worker-uuid')
+        survivor = HeartbeatWorker('survivor-worker-uuid')
+        self._heartbeat(victim)
+        self._heartbeat(survivor)
+        job_ = Job(dummy_task, max_retries=max_retries)
+        job_.retry = retry
+        job_.set_enqueued(victim)
+        job_.set_started()
+        self.storage.store(job_)
+        # killed: the victim no longer notifies it is alive
+        timeout = self.worker_model.worker_timeout
+        self.cr.execute("UPDATE queue_worker SET date_alive = %s "
+                        "WHERE uuid = %s",
+                        ((datetime.now() - timedelta(seconds=timeout + 1)
+                          ).strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+                         victim.uuid))
+        self.worker_model.invalidate_cache(self.cr, self.uid)
+        self._heartbeat(survivor)
+        self.assertFalse(self.worker_model.search(
+            self.cr, self.uid, [('uuid', '=', victim.uuid)]))
+        survivor_id, = self.worker_model.search(
+            self.cr, self.uid, [('uuid', '=', survivor.uuid)])
+        return self.storage.load(job_.uuid), survivor_id
+
+    def test_killed_worker(self):
+        """ The job of a worker killed during its execution is recovered
+        at the next check of the workers, with a retry, and claimed by
+        another worker """
+        if self.cr._cnx.server_version < 90500:
+            raise unittest2.SkipTest('SKIP LOCKED needs PostgreSQL 9.5')
+        job_, survivor_id = self._killed_during_job(retry=1, max_retries=5)
+        self.assertEqual(job_.state, 'pending')
+        self.assertEqual(job_.retry, 2)
+        self.assertIsNone(job_.worker_uuid)
+        job_ids = self.worker_model._claim_jobs(self.cr, survivor_id)
+        self.assertIn(self.storage._odoo_id(job_.uuid), job_ids)
+        self.assertEqual(self.storage.load(job_.uuid).worker_uuid,
+                         'survivor-worker-uuid')
+
+    def test_killed_worker_max_retries(self):
+        """ The job of a worker killed at its last try is failed, it is
+        not claimed again """
+        if self.cr._cnx.server_version < 90500:
+            raise unittest2.SkipTest('SKIP LOCKED needs PostgreSQL 9.5')
+        job_, survivor_id = self._killed_during_job(retry=2, max_retries=3)
+        self.assertEqual(job_.state, 'failed')
+        self.assertEqual(job_.retry, 3)
+        self.assertIn('victim-worker-uuid', job_.exc_info)
+        job_ids = self.worker_model._claim_jobs(self.cr, survivor_id)
+        self.assertNotIn(self.storage._odoo_id(job_.uuid), job_ids)